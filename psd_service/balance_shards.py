@@ -0,0 +1,81 @@
+import os
+import random
+from decimal import Decimal
+
+import psd_service.utils_cache as cache_u
+import psd_service.utils_dynamo as dynamo_u
+
+DYNAMODB_BALANCE_SHARDS = os.getenv('DYNAMODB_BALANCE_SHARDS')
+MIN_BALANCE_SHARDS = 2
+MAX_BALANCE_SHARDS = 32  # a sweep moves every shard in one transaction, far under its 100 items limit
+SHARD_BALANCE_CACHE_TTL_SECONDS = float(os.getenv('SHARD_BALANCE_CACHE_TTL_SECONDS', '1'))
+SHARD_COUNT_CACHE_TTL_SECONDS = float(os.getenv('SHARD_COUNT_CACHE_TTL_SECONDS', '300'))
+dynamodb = dynamo_u.get_dynamo_client()
+
+# the credited shards are not tracked, so the sum of a hot account is served from memory for a short while
+shard_balance_cache = cache_u.LRUCache(ttl_seconds=SHARD_BALANCE_CACHE_TTL_SECONDS)
+shard_count_cache = cache_u.LRUCache(ttl_seconds=SHARD_COUNT_CACHE_TTL_SECONDS)
+
+
+def remember_shard_count(user_id, shard_count):
+    shard_count_cache.put(user_id, shard_count)
+
+
+def get_known_shard_count(user_id):
+    return shard_count_cache.get(user_id)
+
+
+def build_shard_credit(user_id, shard_count, amount):
+    # concurrent credits land on different items, so they do not conflict with each other
+    return {
+        'TableName': DYNAMODB_BALANCE_SHARDS,
+        'Key': {'userId': {'S': user_id}, 'shard': {'N': str(random.randrange(shard_count))}},
+        'UpdateExpression': 'ADD balance :amount',
+        'ExpressionAttributeValues': {':amount': {'N': dynamo_u.encode_float_for_dynamo(float(amount))}}
+    }
+
+
+def get_shard_balances(user_id, consistent_read=False):
+    query_kwargs = {
+        'TableName': DYNAMODB_BALANCE_SHARDS,
+        'KeyConditionExpression': 'userId = :user_id',
+        'ExpressionAttributeValues': {':user_id': {'S': user_id}},
+        'ConsistentRead': consistent_read
+    }
+    shard_balances = {}
+    for page in dynamo_u.iterate_query_pages(dynamodb, **query_kwargs):
+        for item in page.get('Items', []):
+            shard_balances[item['shard']['N']] = item['balance']['N']  # kept as sent, sweeps compare them exactly
+    return shard_balances
+
+
+def sum_shard_balances(shard_balances):
+    return sum((Decimal(balance) for balance in shard_balances.values()), Decimal(0))
+
+
+def get_shard_balance_sum(user_id, consistent_read=False):
+    if not consistent_read:
+        cached_sum = shard_balance_cache.get(user_id)
+        if cached_sum is not None:
+            return cached_sum
+    shard_sum = float(sum_shard_balances(get_shard_balances(user_id, consistent_read=consistent_read)))
+    shard_balance_cache.put(user_id, shard_sum)
+    return shard_sum
+
+
+def build_shard_sweep(user_id, shard_balances):
+    # empties the shards as they were read, a credit landing meanwhile cancels the sweep
+    return [
+        {
+            'TableName': DYNAMODB_BALANCE_SHARDS,
+            'Key': {'userId': {'S': user_id}, 'shard': {'N': shard}},
+            'UpdateExpression': 'ADD balance :swept',
+            'ConditionExpression': 'balance = :balance',
+            'ExpressionAttributeValues': {':swept': {'N': str(-Decimal(balance))}, ':balance': {'N': balance}}
+        }
+        for shard, balance in shard_balances.items() if Decimal(balance) != 0
+    ]
+
+
+def invalidate_shard_balance(user_id):
+    shard_balance_cache.invalidate(user_id)
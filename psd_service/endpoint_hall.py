@@ -1,16 +1,32 @@
+import io
+import json
 import os
+from datetime import datetime as dt
 
-import requests
 from flask import Flask, request
 
+import psd_service.balance_shards as balance_shards
+import psd_service.health as health
+import psd_service.idempotency as idempotency
 import psd_service.log as log
+import psd_service.snapshots as snapshots
+import psd_service.summaries as summaries
 import psd_service.transactions as transactions
+import psd_service.transfer_queue as transfer_queue
+import psd_service.transfer_worker as transfer_worker
 import psd_service.users as users
 import psd_service.utils_http as http_u
+import psd_service.utils_retry as retry_u
 import psd_service.utils_uuid as uuid_u
 import xray
 from psd_service.exceptions import NotFoundException, BadRequestException, CannotSaveException, BadCredentialsException, \
-    NotEnoughBalanceException
+    NotEnoughBalanceException, ConcurrencyException, PayloadTooLargeException
+from psd_service.records import User, Transfer
+
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_TRANSFERS = 1000
+MAX_TRANSFORM_BODY_BYTES = int(os.getenv('MAX_TRANSFORM_BODY_BYTES', str(5 * 1024 * 1024)))  # lambda takes up to 6 MB
+ASYNC_TRANSFERS = os.getenv('ASYNC_TRANSFERS', 'False').lower() in ('true', '1', 't', 'y', 'yes')
 
 app = Flask(__name__)
 logger = log.setup_and_get_logger()
@@ -18,6 +34,26 @@ logger = log.setup_and_get_logger()
 xray.configure_xray(app)
 
 
+@app.before_request
+def set_request_deadline():
+    # retries give up before the lambda runs out of time
+    retry_u.set_deadline_from_lambda_context(request.environ.get('serverless.context'))
+
+
+@app.teardown_request
+def clear_request_deadline(exception=None):
+    retry_u.clear_deadline()
+
+
+@app.teardown_request
+def flush_ledger(exception=None):
+    # ledger rows left pending by a failed write are tried again once the response is ready
+    try:
+        transactions.flush_ledger()
+    except Exception as e:
+        logger.error(f'Could not flush the ledger: {e}')
+
+
 @app.route("/", methods=('GET', 'POST',))
 def index():
     page = f'<h1>Index page! :D</h1>'
@@ -27,49 +63,53 @@ def index():
     page += f'<br> Query string: {request.query_string.decode()}'
     page += f'<br> Request body: {request.json}'
     page += f'<br> Request method: {request.method}'
-    try:
-        res = requests.get("https://aws.amazon.com")
-        if res.status_code != 200:
-            raise Exception()
-        page += f'<br> Aws is up'
-    except:
-        page += f'<br> Aws is down'
-
-    prod_url = os.getenv('PROD_URL', None)
-    if prod_url is not None:
-        string_to_convert_to_lower = 'Some STRING to CONVERT remotely'
-        string_converted_to_lower = 'Failed'
-        try:
-            query_string = f'?string={string_to_convert_to_lower.replace(" ", "%20")}'
-            res = requests.get(prod_url + '/lower_case' + query_string)
-            string_converted_to_lower = http_u.parse_http_response_to_json(res)['string']
-        except:
-            pass
-        page += f'<br> Converted `{string_to_convert_to_lower}` to lower: {string_converted_to_lower}'
-
-        string_to_convert_to_upper = 'The OTHER str to CONVERT remotely'
-        string_converted_to_upper = 'Failed'
-        try:
-            query_string = f'?string={string_to_convert_to_upper.replace(" ", "%20")}'
-            res = requests.get(prod_url + '/upper_case' + query_string)
-            string_converted_to_upper = http_u.parse_http_response_to_json(res)['string']
-        except:
-            pass
-        page += f'<br> Converted `{string_to_convert_to_upper}` to upper: {string_converted_to_upper}'
-
+    probes = health.get_health()['probes']
+    page += f'<br> Aws is {probes["aws"]["status"]}'
+    if 'lower_case' in probes:
+        string_converted_to_lower = (probes['lower_case'].get('details') or {}).get('output', 'Failed')
+        page += f'<br> Converted `{health.STRING_TO_CONVERT_TO_LOWER}` to lower: {string_converted_to_lower}'
+    if 'upper_case' in probes:
+        string_converted_to_upper = (probes['upper_case'].get('details') or {}).get('output', 'Failed')
+        page += f'<br> Converted `{health.STRING_TO_CONVERT_TO_UPPER}` to upper: {string_converted_to_upper}'
     return page
 
 
+@app.route("/health", methods=('GET',))
+def get_health():
+    refresh = http_u.get_bool_query_param(dict(request.args), 'refresh')
+    logger.debug(f'Received get health, refresh `{refresh}`')
+
+    try:
+        report = health.get_health(refresh=refresh)
+        status_code = 200 if report['status'] == health.UP else 503
+        return http_u.generate_response(status_code, {**report, 'outboundHttp': http_u.get_http_stats(),
+                                                     'userCache': users.get_user_cache_stats()})
+    except Exception as e:
+        logger.error(f'{e}')
+        return http_u.generate_error_response(500)
+
+
 @app.route("/users/<string:user_id>", methods=('GET',))
 def get_user(user_id):
     if user_id is None or not uuid_u.check_if_valid_uuid(user_id):
         return http_u.generate_error_response(400, 'Provide a valid user id!')
 
+    try:
+        fields = http_u.get_fields_query_param(dict(request.args), User.PUBLIC_FIELDS)
+    except BadRequestException as e:
+        return http_u.generate_error_response(400, e)
+
     logger.debug(f'Received get user for `{user_id}`')
 
     try:
-        user = users.get_user_from_id(user_id)
-        return http_u.generate_ok_response(user)
+        if 'If-None-Match' in request.headers:
+            etag = users.get_user_etag(user_id)  # a projection, the user is read only when it changed
+            if http_u.is_not_modified(request.headers, etag=etag):
+                return http_u.generate_not_modified_response(etag=etag)
+        # a single read, with the version and balance the etag is derived from
+        user = users.get_user_from_id(user_id, fields=None if fields is None else fields + ('version', 'balance'))
+        etag = users.compute_user_etag(user)
+        return http_u.add_validators(http_u.generate_ok_response(user.to_dict(fields=fields)), etag=etag)
     except NotFoundException as e:
         return http_u.generate_error_response(404, e)
     except Exception as e:
@@ -77,7 +117,32 @@ def get_user(user_id):
         return http_u.generate_error_response(500)
 
 
+@app.route("/users", methods=('GET',))
+def get_users():
+    query_params = dict(request.args)
+    user_ids = [user_id for user_id in query_params.get('ids', '').split(',') if user_id != '']
+    if len(user_ids) == 0 or len(user_ids) > MAX_PAGE_SIZE:
+        return http_u.generate_error_response(400, f'Provide up to {MAX_PAGE_SIZE} comma separated user ids!')
+    for user_id in user_ids:
+        if not uuid_u.check_if_valid_uuid(user_id):
+            return http_u.generate_error_response(400, f'Provide a valid user id instead of `{user_id}`!')
+
+    logger.debug(f'Received get users for `{len(user_ids)}` ids')
+
+    try:
+        found_users = users.get_users_by_ids(user_ids)
+        response = {
+            'users': [found_users[user_id].to_dict() for user_id in dict.fromkeys(user_ids) if user_id in found_users],
+            'not_found': [user_id for user_id in dict.fromkeys(user_ids) if user_id not in found_users]
+        }
+        return http_u.generate_ok_response(response)
+    except Exception as e:
+        logger.error(f'{e}')
+        return http_u.generate_error_response(500)
+
+
 @app.route("/users", methods=('POST',))
+@idempotency.idempotent('users')
 def create_user():
     request_body = request.json
     required_fields = ['name', 'surname', 'username', 'password']
@@ -106,16 +171,75 @@ def create_user():
         return http_u.generate_error_response(500)
 
 
+@app.route("/users/<string:user_id>/balance_shards", methods=('POST',))
+def enable_balance_shards(user_id):
+    if user_id is None or not uuid_u.check_if_valid_uuid(user_id):
+        return http_u.generate_error_response(400, 'Provide a valid user id!')
+
+    request_body = request.json
+    required_fields = ['shards']
+    try:
+        http_u.validate_request(request_body, required_fields)
+    except BadRequestException as e:
+        return http_u.generate_error_response(400, e)
+    except Exception as e:
+        logger.error(f'{e}')
+        return http_u.generate_error_response(500)
+
+    shard_count = request_body['shards']
+    if type(shard_count) is not int or \
+            not balance_shards.MIN_BALANCE_SHARDS <= shard_count <= balance_shards.MAX_BALANCE_SHARDS:
+        return http_u.generate_error_response(400, f'Provide `shards` between {balance_shards.MIN_BALANCE_SHARDS} '
+                                                   f'and {balance_shards.MAX_BALANCE_SHARDS}!')
+
+    logger.debug(f'Received balance shards for `{user_id}`')
+
+    try:
+        user = users.enable_balance_shards(user_id, shard_count)
+        return http_u.generate_ok_response(user.to_dict(), msg='Balance shards enabled!')
+    except NotFoundException as e:
+        return http_u.generate_error_response(404, e)
+    except Exception as e:
+        logger.error(f'{e}')
+        return http_u.generate_error_response(500)
+
+
 @app.route("/user_ids", methods=('GET',))
 def get_all_user():
+    query_params = dict(request.args)
+    try:
+        # a page at most, whole tables are only sent streamed
+        limit = http_u.get_int_query_param(query_params, 'limit', default=MAX_PAGE_SIZE, min_value=1,
+                                           max_value=MAX_PAGE_SIZE)
+        stream = http_u.get_bool_query_param(query_params, 'stream')
+        cursor = query_params.get('cursor', None)
+        fields = http_u.get_fields_query_param(query_params, User.PUBLIC_FIELDS)
+    except BadRequestException as e:
+        return http_u.generate_error_response(400, e)
+
     logger.debug(f'Received get all users')
 
     try:
-        user_ids = users.get_all_user_ids()
+        if fields is not None:  # renders users with the chosen fields instead of bare ids
+            if stream:
+                found_users = (user.to_dict() for user in users.iterate_users(cursor, fields=fields))
+                return http_u.generate_streamed_json_response(200, 'users', found_users)
+            found_users, next_cursor = users.get_users_page(limit, cursor, fields=fields)
+            response = {
+                'users': [user.to_dict() for user in found_users],
+                'cursor': next_cursor
+            }
+            return http_u.generate_ok_response(response)
+        if stream:
+            return http_u.generate_streamed_json_response(200, 'user_ids', users.iterate_user_ids(cursor))
+        user_ids, next_cursor = users.get_user_ids_page(limit, cursor)
         response = {
-            'user_ids': user_ids
+            'user_ids': user_ids,
+            'cursor': next_cursor
         }
         return http_u.generate_ok_response(response)
+    except BadRequestException as e:
+        return http_u.generate_error_response(400, e)
     except Exception as e:
         logger.error(f'{e}')
         return http_u.generate_error_response(500)
@@ -149,6 +273,7 @@ def auth():
 
 
 @app.route("/transfer", methods=('POST',))
+@idempotency.idempotent('transfer')
 def make_transfer():
     request_body = request.json
     required_fields = ['src_user_id', 'dst_user_id', 'amount']
@@ -164,29 +289,86 @@ def make_transfer():
     dst_user_id = request_body['dst_user_id']
     amount = request_body['amount']
 
-    if not uuid_u.check_if_valid_uuid(dst_user_id):
-        return http_u.generate_error_response(400, 'Provide a valid dst user id!')
-
-    if not uuid_u.check_if_valid_uuid(src_user_id):
-        return http_u.generate_error_response(400, 'Provide a valid src user id!')
-
-    if src_user_id == dst_user_id:
-        return http_u.generate_error_response(400, 'Provide distinct user ids!')
-
-    if type(amount) not in (int, float):
-        return http_u.generate_error_response(400, 'Provide a amount!')
+    try:
+        transactions.validate_transfer(src_user_id, dst_user_id, amount)
+    except BadRequestException as e:
+        return http_u.generate_error_response(400, e)
 
     logger.debug(f'Received transaction request of `{amount}` from `{src_user_id}` to `{dst_user_id}`')
 
+    if ASYNC_TRANSFERS or http_u.prefers_async_response(request.headers):
+        try:
+            transfer_status = transactions.enqueue_transfer(src_user_id, dst_user_id, amount)
+        except Exception as e:
+            logger.error(f'{type(e)}-{e}')
+            return http_u.generate_error_response(500)
+        response = http_u.generate_response(202, {**transfer_status.to_dict(), 'message': 'Transfer was queued!'})
+        response.headers['Location'] = f'/transfers/{transfer_status.id}'
+        response.headers['Preference-Applied'] = 'respond-async'
+        if transfer_queue.transfer_queue.DRAINED_BY_SENDER:
+            response.call_on_close(transfer_worker.drain_queue)
+        return response
+
     try:
-        src_user = users.get_user_from_id(src_user_id)
-        dst_user = users.get_user_from_id(dst_user_id)
-        transaction = transactions.make_transfer(src_user, dst_user, amount)
-        return http_u.generate_ok_response(transaction, msg='Transaction was successful!')
+        transaction = transactions.make_transfer(src_user_id, dst_user_id, amount)
+        return http_u.generate_ok_response(transaction.to_dict(), msg='Transaction was successful!')
     except NotFoundException as e:
         return http_u.generate_error_response(404, e)
     except NotEnoughBalanceException as e:
         return http_u.generate_error_response(401, e)
+    except ConcurrencyException as e:
+        return http_u.generate_error_response(409, e)
+    except Exception as e:
+        logger.error(f'{type(e)}-{e}')
+        return http_u.generate_error_response(500)
+
+
+@app.route("/transfers/<string:transfer_id>", methods=('GET',))
+def get_transfer(transfer_id):
+    if transfer_id is None or not uuid_u.check_if_valid_uuid(transfer_id):
+        return http_u.generate_error_response(400, 'Provide a valid transfer id!')
+
+    logger.debug(f'Received get transfer for `{transfer_id}`')
+
+    try:
+        transfer_status = transactions.get_transfer_status(transfer_id)
+        etag, last_modified = transfer_status.state, transfer_status.get('occurredAtUTC')  # final once not queued
+        if http_u.is_not_modified(request.headers, etag=etag, last_modified=last_modified):
+            return http_u.generate_not_modified_response(etag=etag, last_modified=last_modified)
+        response = http_u.generate_ok_response(transfer_status.to_dict())
+        return http_u.add_validators(response, etag=etag, last_modified=last_modified)
+    except NotFoundException as e:
+        return http_u.generate_error_response(404, e)
+    except Exception as e:
+        logger.error(f'{e}')
+        return http_u.generate_error_response(500)
+
+
+@app.route("/transfers/batch", methods=('POST',))
+def make_batch_transfer():
+    request_body = request.json
+    required_fields = ['transfers']
+    try:
+        http_u.validate_request(request_body, required_fields)
+    except BadRequestException as e:
+        return http_u.generate_error_response(400, e)
+    except Exception as e:
+        logger.error(f'{e}')
+        return http_u.generate_error_response(500)
+
+    transfers = request_body['transfers']
+    if type(transfers) is not list or len(transfers) == 0 or len(transfers) > MAX_BATCH_TRANSFERS:
+        return http_u.generate_error_response(400, f'Provide a list of up to {MAX_BATCH_TRANSFERS} transfers!')
+
+    logger.debug(f'Received batch transaction request of `{len(transfers)}` transfers')
+
+    try:
+        results = transactions.make_batch_transfer(transfers)
+        return http_u.generate_ok_response({'results': results}, msg='Batch was processed!')
+    except BadRequestException as e:
+        return http_u.generate_error_response(400, e)
+    except ConcurrencyException as e:
+        return http_u.generate_error_response(409, e)
     except Exception as e:
         logger.error(f'{type(e)}-{e}')
         return http_u.generate_error_response(500)
@@ -197,14 +379,75 @@ def get_user_transfers(user_id):
     if user_id is None or not uuid_u.check_if_valid_uuid(user_id):
         return http_u.generate_error_response(400, 'Provide a valid user id!')
 
+    query_params = dict(request.args)
+    try:
+        since = http_u.get_datetime_query_param(query_params, 'since')
+        until = http_u.get_datetime_query_param(query_params, 'until')
+        if since is not None and until is not None and since > until:  # dynamo rejects such a BETWEEN
+            raise BadRequestException('Provide a `since` earlier than `until`!')
+        limit = http_u.get_int_query_param(query_params, 'limit', min_value=1, max_value=MAX_PAGE_SIZE)
+        cursor = query_params.get('cursor', None)
+        fields = http_u.get_fields_query_param(query_params, Transfer.PUBLIC_FIELDS)
+    except BadRequestException as e:
+        return http_u.generate_error_response(400, e)
+
     logger.debug(f'Received get user transfers for `{user_id}`')
 
     try:
-        user_transfers = transactions.get_user_transfers(user_id)
+        user_transfers, next_cursor = transactions.get_user_transfers(user_id, since=since, until=until, limit=limit,
+                                                                      cursor=cursor, fields=fields)
         response = {
-            'transactions': user_transfers
+            'transactions': [transfer.to_dict(fields=fields) for transfer in user_transfers],
+            'cursor': next_cursor
         }
-        return http_u.generate_ok_response(response)
+        # the page comes from the indices, which lag behind the user version, so the page itself is the validator
+        etag = http_u.compute_etag(response)
+        if http_u.is_not_modified(request.headers, etag=etag):
+            return http_u.generate_not_modified_response(etag=etag)
+        return http_u.add_validators(http_u.generate_ok_response(response), etag=etag)
+    except BadRequestException as e:
+        return http_u.generate_error_response(400, e)
+    except NotFoundException as e:
+        return http_u.generate_error_response(404, e)
+    except Exception as e:
+        logger.error(f'{e}')
+        return http_u.generate_error_response(500)
+
+
+@app.route("/users/<string:user_id>/summary", methods=('GET',))
+def get_user_summary(user_id):
+    if user_id is None or not uuid_u.check_if_valid_uuid(user_id):
+        return http_u.generate_error_response(400, 'Provide a valid user id!')
+
+    try:
+        top = http_u.get_int_query_param(dict(request.args), 'top', default=summaries.DEFAULT_TOP_COUNTERPARTIES,
+                                         min_value=0, max_value=summaries.MAX_TOP_COUNTERPARTIES)
+    except BadRequestException as e:
+        return http_u.generate_error_response(400, e)
+
+    logger.debug(f'Received get user summary for `{user_id}`')
+
+    try:
+        return http_u.generate_ok_response(summaries.get_user_summary(user_id, top=top))
+    except Exception as e:
+        logger.error(f'{e}')
+        return http_u.generate_error_response(500)
+
+
+@app.route("/users/<string:user_id>/balance", methods=('GET',))
+def get_user_balance_at(user_id):
+    if user_id is None or not uuid_u.check_if_valid_uuid(user_id):
+        return http_u.generate_error_response(400, 'Provide a valid user id!')
+
+    try:
+        at = http_u.get_datetime_query_param(dict(request.args), 'at', default=dt.utcnow().isoformat())
+    except BadRequestException as e:
+        return http_u.generate_error_response(400, e)
+
+    logger.debug(f'Received get user balance for `{user_id}` at `{at}`')
+
+    try:
+        return http_u.generate_ok_response(snapshots.get_balance_at(user_id, at))
     except NotFoundException as e:
         return http_u.generate_error_response(404, e)
     except Exception as e:
@@ -219,10 +462,11 @@ def to_lower():
         return http_u.generate_error_response(400, 'Provide a string!')
 
     string = query_params['string']
+    transform = str.casefold if http_u.get_bool_query_param(query_params, 'casefold') else str.lower
 
     try:
         response = {
-            'string': string.lower()
+            'string': transform(string)
         }
         return http_u.generate_ok_response(response)
     except NotFoundException as e:
@@ -250,3 +494,50 @@ def to_upper():
     except Exception as e:
         logger.error(f'{e}')
         return http_u.generate_error_response(500)
+
+
+def transform_ndjson_lines(data, transform):
+    # a line that is not a json string gets an error line, so the output keeps one line per input line
+    for line_number, line in enumerate(io.BytesIO(data), start=1):
+        if line.strip() == b'':
+            continue
+        try:
+            string = json.loads(line)
+        except ValueError:
+            string = None
+        if type(string) is str:
+            yield transform(string)
+        else:
+            yield {'line': line_number, 'error': 'Provide a JSON string!'}
+
+
+def generate_transformed_strings_response(transform):
+    # a json array of strings gets a json array back, a ndjson stream of strings gets a ndjson stream back
+    try:
+        data = http_u.read_request_body(MAX_TRANSFORM_BODY_BYTES)
+    except PayloadTooLargeException as e:
+        return http_u.generate_error_response(413, e)
+
+    if request.mimetype in http_u.NDJSON_MIMETYPES:
+        logger.debug(f'Received ndjson transform of `{len(data)}` bytes')
+        return http_u.generate_streamed_ndjson_response(200, transform_ndjson_lines(data, transform))
+
+    try:
+        strings = json.loads(data)
+    except ValueError:
+        strings = None
+    if type(strings) is not list or any(type(string) is not str for string in strings):
+        return http_u.generate_error_response(400, 'Provide a JSON array of strings or a NDJSON stream of strings!')
+    logger.debug(f'Received transform of `{len(strings)}` strings')
+    return http_u.generate_streamed_json_response(200, 'strings', map(transform, strings))
+
+
+@app.route("/lower_case", methods=('POST',))
+def to_lower_bulk():
+    casefold = http_u.get_bool_query_param(dict(request.args), 'casefold')
+    return generate_transformed_strings_response(str.casefold if casefold else str.lower)
+
+
+@app.route("/upper_case", methods=('POST',))
+def to_upper_bulk():
+    return generate_transformed_strings_response(str.upper)
@@ -20,3 +20,11 @@ class NotEnoughBalanceException(Exception):
 
 class ConcurrencyException(Exception):
     pass
+
+
+class AlreadyProcessedException(Exception):
+    pass
+
+
+class PayloadTooLargeException(Exception):
+    pass
@@ -0,0 +1,101 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime as dt
+
+import psd_service.utils_cache as cache_u
+import psd_service.utils_http as http_u
+
+AWS_PROBE_URL = os.getenv('AWS_PROBE_URL', 'https://aws.amazon.com')
+PROD_URL = os.getenv('PROD_URL', None)
+HEALTH_PROBE_TIMEOUT_SECONDS = float(os.getenv('HEALTH_PROBE_TIMEOUT_SECONDS', '3'))
+HEALTH_CACHE_TTL_SECONDS = float(os.getenv('HEALTH_CACHE_TTL_SECONDS', '30'))
+UP = 'up'
+DOWN = 'down'
+DEGRADED = 'degraded'
+HEALTH_REPORT_KEY = 'report'
+STRING_TO_CONVERT_TO_LOWER = 'Some STRING to CONVERT remotely'
+STRING_TO_CONVERT_TO_UPPER = 'The OTHER str to CONVERT remotely'
+
+logger = logging.getLogger()
+
+# the probes reach other services, a warm lambda answers from the last report for a while
+health_cache = cache_u.LRUCache(max_size=1, ttl_seconds=HEALTH_CACHE_TTL_SECONDS)
+
+
+class Probe(object):
+    # A named dependency check, `check(timeout)` raises when the dependency is down and may return some details
+
+    def __init__(self, name, check, timeout_seconds=HEALTH_PROBE_TIMEOUT_SECONDS):
+        self.name = name
+        self.check = check
+        self.timeout_seconds = timeout_seconds
+
+    def run(self):
+        started_at = time.monotonic()
+        try:
+            result = {'status': UP, 'details': self.check(self.timeout_seconds)}
+        except Exception as e:
+            result = {'status': DOWN, 'error': f'{type(e).__name__}: {e}'}
+        result['latencyMs'] = round((time.monotonic() - started_at) * 1000, 1)
+        return result
+
+
+def check_aws(timeout):
+    response = http_u.http_get(AWS_PROBE_URL, timeout=timeout)
+    if response.status_code != 200:
+        raise Exception(f'{AWS_PROBE_URL} returned {response.status_code}')
+    return None
+
+
+def build_conversion_check(path, string):
+    def check(timeout):
+        response = http_u.http_get(PROD_URL + path, params={'string': string}, timeout=timeout)
+        return {'input': string, 'output': http_u.parse_http_response_to_json(response)['string']}
+    return check
+
+
+def get_default_probes():
+    probes = [Probe('aws', check_aws)]
+    if PROD_URL is not None:
+        probes.append(Probe('lower_case', build_conversion_check('/lower_case', STRING_TO_CONVERT_TO_LOWER)))
+        probes.append(Probe('upper_case', build_conversion_check('/upper_case', STRING_TO_CONVERT_TO_UPPER)))
+    return probes
+
+
+def run_probes(probes):
+    # all at once, a probe still running after its timeout is reported as down and left behind
+    executor = ThreadPoolExecutor(max_workers=max(len(probes), 1))
+    try:
+        futures = {probe.name: executor.submit(probe.run) for probe in probes}
+        wait(futures.values(), timeout=max((probe.timeout_seconds for probe in probes), default=0))
+        results = {}
+        for probe in probes:
+            future = futures[probe.name]
+            if future.done():
+                results[probe.name] = future.result()
+            else:
+                results[probe.name] = {'status': DOWN, 'error': f'Timed out after {probe.timeout_seconds}s',
+                                       'latencyMs': probe.timeout_seconds * 1000}
+        return results
+    finally:
+        executor.shutdown(wait=False)
+
+
+def get_health(probes=None, refresh=False):
+    if not refresh:
+        cached_report = health_cache.get(HEALTH_REPORT_KEY)
+        if cached_report is not None:
+            return cached_report
+    results = run_probes(get_default_probes() if probes is None else probes)
+    report = {
+        'status': UP if all(result['status'] == UP for result in results.values()) else DEGRADED,
+        'checkedAtUTC': dt.utcnow().isoformat(),
+        'probes': results
+    }
+    for name, result in results.items():
+        if result['status'] != UP:
+            logger.warning(f'Health probe `{name}` is down: {result["error"]}')
+    health_cache.put(HEALTH_REPORT_KEY, report)
+    return report
@@ -0,0 +1,158 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import time
+
+from botocore.exceptions import ClientError
+from flask import Response, request
+
+import psd_service.utils_cache as cache_u
+import psd_service.utils_dynamo as dynamo_u
+import psd_service.utils_http as http_u
+from psd_service.exceptions import BadRequestException, ConcurrencyException
+from psd_service.records import IdempotentResponse
+
+DYNAMODB_IDEMPOTENCY = os.getenv('DYNAMODB_IDEMPOTENCY')
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+STORED_RESPONSE_HEADERS = ('Location', 'Preference-Applied', 'Retry-After')  # part of what the request did
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', str(24 * 60 * 60)))
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv('IDEMPOTENCY_LOCK_SECONDS', '60'))  # longer than a lambda run
+IN_PROGRESS = 'in_progress'
+COMPLETED = 'completed'
+dynamodb = dynamo_u.get_dynamo_client()
+
+logger = logging.getLogger()
+
+# completed responses never change, so retries reaching a warm lambda are answered without any dynamo call
+response_cache = cache_u.LRUCache(max_size=int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '1024')),
+                                  ttl_seconds=IDEMPOTENCY_TTL_SECONDS)
+
+
+def get_request_fingerprint(scope):
+    return hashlib.sha256(scope.encode() + b'\n' + request.get_data()).hexdigest()
+
+
+def check_stored_response(stored_response, fingerprint):
+    if stored_response.fingerprint != fingerprint:
+        raise BadRequestException(f'The {IDEMPOTENCY_HEADER} was already used with another request!')
+    if stored_response.state != COMPLETED:
+        raise ConcurrencyException(f'A request with the same {IDEMPOTENCY_HEADER} is still in progress')
+    return stored_response
+
+
+def begin_request(idempotency_key, fingerprint):
+    # reserves the key and returns None, or returns the stored response of a finished request, in one round-trip
+    cached_response = response_cache.get(idempotency_key)
+    if cached_response is not None:
+        return check_stored_response(cached_response, fingerprint)
+
+    now = int(time.time())
+    reservation = IdempotentResponse(
+        idempotencyKey=idempotency_key,
+        state=IN_PROGRESS,
+        fingerprint=fingerprint,
+        lockedUntil=now + IDEMPOTENCY_LOCK_SECONDS,
+        expiresAt=now + IDEMPOTENCY_TTL_SECONDS
+    )
+    try:
+        dynamodb.put_item(
+            TableName=DYNAMODB_IDEMPOTENCY,
+            Item=reservation.to_dynamo(),
+            # the ttl deletion may take a while, and an abandoned reservation is freed after its lock
+            ConditionExpression='attribute_not_exists(idempotencyKey) OR expiresAt < :now OR '
+                                '(#state = :in_progress AND lockedUntil < :now)',
+            ExpressionAttributeNames={'#state': 'state'},
+            ExpressionAttributeValues={':now': {'N': str(now)}, ':in_progress': {'S': IN_PROGRESS}},
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+        return None
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise e
+        stored_response = IdempotentResponse.from_dynamo(e.response.get('Item', {}))
+    if stored_response.get('state') == COMPLETED:
+        response_cache.put(idempotency_key, stored_response)
+    return check_stored_response(stored_response, fingerprint)
+
+
+def complete_request(idempotency_key, fingerprint, response):
+    stored_response = IdempotentResponse(
+        idempotencyKey=idempotency_key,
+        state=COMPLETED,
+        fingerprint=fingerprint,
+        statusCode=response.status_code,
+        body=http_u.get_uncompressed_text(response),  # replays are compressed for each client
+        mimetype=response.mimetype,
+        headers=json.dumps({name: response.headers[name] for name in STORED_RESPONSE_HEADERS
+                            if name in response.headers}),
+        expiresAt=int(time.time()) + IDEMPOTENCY_TTL_SECONDS
+    )
+    dynamodb.put_item(TableName=DYNAMODB_IDEMPOTENCY, Item=stored_response.to_dynamo())
+    response_cache.put(idempotency_key, stored_response)
+
+
+def abandon_request(idempotency_key):
+    # a failed request may be retried with the same key
+    try:
+        dynamodb.delete_item(
+            TableName=DYNAMODB_IDEMPOTENCY,
+            Key={'idempotencyKey': {'S': idempotency_key}},
+            ConditionExpression='#state = :in_progress',
+            ExpressionAttributeNames={'#state': 'state'},
+            ExpressionAttributeValues={':in_progress': {'S': IN_PROGRESS}}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise e
+
+
+def generate_replayed_response(stored_response):
+    headers = http_u.get_cors_headers()
+    headers.update(json.loads(stored_response.get('headers', '{}')))  # responses stored before had none
+    headers[REPLAYED_HEADER] = 'true'
+    response = Response(response=stored_response.body, status=stored_response.statusCode,
+                        mimetype=stored_response.mimetype, headers=headers)
+    return http_u.compress_response(response, http_u.get_request_encoding())
+
+
+def idempotent(scope):
+    # replays the stored response of requests retried with the same Idempotency-Key, instead of running them again
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+            if idempotency_key is None:
+                return handler(*args, **kwargs)
+            if not 0 < len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+                return http_u.generate_error_response(400, f'Provide an {IDEMPOTENCY_HEADER} up to '
+                                                           f'{MAX_IDEMPOTENCY_KEY_LENGTH} characters!')
+            idempotency_key = f'{scope}#{idempotency_key}'
+            fingerprint = get_request_fingerprint(scope)
+            try:
+                stored_response = begin_request(idempotency_key, fingerprint)
+            except BadRequestException as e:
+                return http_u.generate_error_response(422, e)
+            except ConcurrencyException as e:
+                return http_u.generate_error_response(409, e)
+            if stored_response is not None:
+                return generate_replayed_response(stored_response)
+
+            try:
+                response = handler(*args, **kwargs)
+            except Exception as e:
+                abandon_request(idempotency_key)
+                raise e
+            if response.status_code >= 500 or response.status_code == 409:
+                abandon_request(idempotency_key)  # server errors and conflicts are not final, a retry may succeed
+                return response
+            try:
+                complete_request(idempotency_key, fingerprint, response)
+            except ClientError as e:
+                logger.error(f'Could not store the response of {idempotency_key}: {e}')  # the request did happen
+            return response
+        return wrapper
+    return decorator
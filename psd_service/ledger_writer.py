@@ -0,0 +1,58 @@
+import atexit
+import logging
+import threading
+
+import psd_service.utils_dynamo as dynamo_u
+
+logger = logging.getLogger()
+
+
+class LedgerWriter(object):
+    # Synchronous writer of ledger rows as BatchWriteItem calls. The rows of a failed write are kept pending, they go
+    # first on the next write and are tried again after the response is sent and when the process exits
+
+    def __init__(self, client, table_name):
+        self.client = client
+        self.table_name = table_name
+        self.pending_items = []
+        self.lock = threading.Lock()
+
+    def write(self, dynamo_items):
+        # returns only once the rows, and the pending ones before them, are stored
+        with self.lock:
+            self.pending_items += dynamo_items
+            items_to_write = self.take_pending_items()
+        self.write_items(items_to_write)
+
+    def flush(self):
+        with self.lock:
+            items_to_write = self.take_pending_items()
+        self.write_items(items_to_write)
+
+    def take_pending_items(self):
+        items, self.pending_items = self.pending_items, []
+        return items
+
+    def write_items(self, items):
+        if len(items) == 0:
+            return
+        try:
+            # unprocessed items are retried with backoff by the batch writer, rewriting a stored row is harmless
+            dynamo_u.batch_write_items(self.client, self.table_name, items, object_name='Transactions', encode=False)
+        except Exception as e:
+            with self.lock:
+                self.pending_items = items + self.pending_items  # kept for the next write or flush
+            raise e
+
+    def get_pending_count(self):
+        with self.lock:
+            return len(self.pending_items)
+
+
+def flush_on_exit(ledger_writer):
+    def flush():
+        try:
+            ledger_writer.flush()
+        except Exception as e:
+            logger.error(f'Could not flush {ledger_writer.get_pending_count()} ledger rows on exit: {e}')
+    atexit.register(flush)
@@ -0,0 +1,171 @@
+import psd_service.utils_dynamo as dynamo_u
+
+MISSING = object()
+
+# precompiled (encoder, decoder) pairs between python values and dynamo attribute values, by declared type
+FIELD_CODECS = {
+    str: (lambda value: {'S': value}, lambda attribute_value: attribute_value['S']),
+    bool: (lambda value: {'BOOL': value}, lambda attribute_value: attribute_value['BOOL']),
+    int: (lambda value: {'N': str(int(value))}, lambda attribute_value: int(float(attribute_value['N']))),
+    float: (lambda value: {'N': dynamo_u.encode_float_for_dynamo(float(value))},
+            lambda attribute_value: float(attribute_value['N'])),
+}
+
+
+class Record(object):
+    # Compact record with a declared schema, subclasses set FIELDS as (name, type) pairs and the same names as slots
+    __slots__ = ()
+    FIELDS = ()
+    SENSITIVE_FIELDS = ()
+    INTERNAL_FIELDS = ()  # storage details, read along with the public fields but never rendered
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.FIELD_NAMES = tuple(name for name, _ in cls.FIELDS)
+        cls.NON_SENSITIVE_FIELDS = tuple(name for name in cls.FIELD_NAMES if name not in cls.SENSITIVE_FIELDS)
+        cls.PUBLIC_FIELDS = tuple(name for name in cls.NON_SENSITIVE_FIELDS if name not in cls.INTERNAL_FIELDS)
+        cls.ENCODERS = {name: FIELD_CODECS[field_type][0] for name, field_type in cls.FIELDS}
+        cls.DECODERS = {name: FIELD_CODECS[field_type][1] for name, field_type in cls.FIELDS}
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)  # unknown names fail because of the slots
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return False
+        return self.to_dict(include_sensitive=True) == other.to_dict(include_sensitive=True)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict(include_sensitive=True)})'
+
+    def copy(self):
+        record = type(self)()
+        for name in self.FIELD_NAMES:
+            value = getattr(self, name, MISSING)
+            if value is not MISSING:
+                setattr(record, name, value)
+        return record
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def has(self, name):
+        return getattr(self, name, MISSING) is not MISSING
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{name: data[name] for name in cls.FIELD_NAMES if name in data})
+
+    @classmethod
+    def from_dynamo(cls, dynamo_item, fields=None):
+        record = cls()
+        decoders = cls.DECODERS
+        for name in cls.FIELD_NAMES if fields is None else fields:
+            attribute_value = dynamo_item.get(name)
+            if attribute_value is not None:
+                setattr(record, name, decoders[name](attribute_value))
+        return record
+
+    def to_dynamo(self):
+        dynamo_item = {}
+        for name, encoder in self.ENCODERS.items():
+            value = getattr(self, name, None)
+            if value is not None:
+                dynamo_item[name] = encoder(value)
+        return dynamo_item
+
+    def to_dict(self, include_sensitive=False, fields=None):
+        if fields is None:
+            fields = self.FIELD_NAMES if include_sensitive else self.PUBLIC_FIELDS
+        data = {}
+        for name in fields:
+            value = getattr(self, name, MISSING)
+            if value is not MISSING:
+                data[name] = value
+        return data
+
+
+class User(Record):
+    FIELDS = (
+        ('id', str),
+        ('username', str),
+        ('passwordHash', str),
+        ('salt', str),
+        ('name', str),
+        ('surname', str),
+        ('createdAtUTC', str),
+        ('verifiedAccount', bool),
+        ('balance', float),
+        ('version', int),
+        ('balanceShards', int),  # set on hot accounts, which are credited on balance shards
+    )
+    SENSITIVE_FIELDS = ('passwordHash', 'salt', 'createdAtUTC')
+    INTERNAL_FIELDS = ('balanceShards',)
+    __slots__ = tuple(name for name, _ in FIELDS)
+
+
+class Transfer(Record):
+    FIELDS = (
+        ('id', str),
+        ('srcUserId', str),
+        ('dstUserId', str),
+        ('amount', float),
+        ('occurredAtUTC', str),
+    )
+    __slots__ = tuple(name for name, _ in FIELDS)
+
+
+class TransferStatus(Record):
+    FIELDS = (
+        ('id', str),
+        ('state', str),
+        ('srcUserId', str),
+        ('dstUserId', str),
+        ('amount', float),
+        ('occurredAtUTC', str),  # set once completed
+        ('error', str),  # set once failed
+        ('expiresAt', int),  # epoch seconds, the table ttl attribute
+    )
+    SENSITIVE_FIELDS = ('expiresAt',)
+    __slots__ = tuple(name for name, _ in FIELDS)
+
+
+class TransferSummary(Record):
+    # one row with the totals of an user, plus one row per counterparty
+    FIELDS = (
+        ('userId', str),
+        ('counterpartyId', str),
+        ('sentCount', int),
+        ('sentTotal', float),
+        ('receivedCount', int),
+        ('receivedTotal', float),
+        ('volume', float),  # only on counterparty rows, sorts them on the volume index
+        ('firstActivityAtUTC', str),
+        ('lastActivityAtUTC', str),
+    )
+    __slots__ = tuple(name for name, _ in FIELDS)
+
+
+class BalanceSnapshot(Record):
+    FIELDS = (
+        ('userId', str),
+        ('atUTC', str),  # every transfer that occurred up to it is included
+        ('balance', float),
+    )
+    __slots__ = tuple(name for name, _ in FIELDS)
+
+
+class IdempotentResponse(Record):
+    FIELDS = (
+        ('idempotencyKey', str),
+        ('state', str),
+        ('fingerprint', str),
+        ('statusCode', int),
+        ('body', str),
+        ('mimetype', str),
+        ('headers', str),  # json object of the replayed headers
+        ('lockedUntil', int),
+        ('expiresAt', int),  # epoch seconds, the table ttl attribute
+    )
+    __slots__ = tuple(name for name, _ in FIELDS)
@@ -0,0 +1,123 @@
+import logging
+import os
+from datetime import datetime as dt, timedelta
+from decimal import Decimal
+
+import psd_service.transactions as transactions
+import psd_service.users as users
+import psd_service.utils_dynamo as dynamo_u
+import psd_service.utils_retry as retry_u
+from psd_service.exceptions import NotFoundException
+from psd_service.records import BalanceSnapshot
+
+DYNAMODB_BALANCE_SNAPSHOTS = os.getenv('DYNAMODB_BALANCE_SNAPSHOTS')
+# transfers are written behind or queued, so only times older than this are taken as final
+SNAPSHOT_SETTLE_SECONDS = int(os.getenv('SNAPSHOT_SETTLE_SECONDS', '300'))
+SNAPSHOT_REPLAY_THRESHOLD = int(os.getenv('SNAPSHOT_REPLAY_THRESHOLD', '100'))  # longer replays leave a snapshot
+REPLAY_FIELDS = ('amount', 'occurredAtUTC')
+SNAPSHOT_RETRY_POLICY = retry_u.RetryPolicy(retry_on=(retry_u.THROTTLING,))  # rewriting a snapshot is harmless
+dynamodb = dynamo_u.get_dynamo_client()
+
+logger = logging.getLogger()
+
+
+def get_settled_at():
+    return (dt.utcnow() - timedelta(seconds=SNAPSHOT_SETTLE_SECONDS)).isoformat()
+
+
+def store_snapshot(snapshot):
+    retry_u.retry_call(lambda: dynamodb.put_item(TableName=DYNAMODB_BALANCE_SNAPSHOTS, Item=snapshot.to_dynamo()),
+                       'store_snapshot', policy=SNAPSHOT_RETRY_POLICY)
+
+
+def get_nearest_snapshot(user_id, at):
+    response = dynamodb.query(
+        TableName=DYNAMODB_BALANCE_SNAPSHOTS,
+        KeyConditionExpression='userId = :user_id AND atUTC <= :at',
+        ExpressionAttributeValues={':user_id': {'S': user_id}, ':at': {'S': at}},
+        ScanIndexForward=False,  # the latest one first
+        Limit=1
+    )
+    items = response.get('Items', [])
+    return BalanceSnapshot.from_dynamo(items[0]) if len(items) > 0 else None
+
+
+def get_starting_snapshot(user_id, at):
+    snapshot = get_nearest_snapshot(user_id, at)
+    if snapshot is not None:
+        return snapshot
+    # users created before snapshots existed start from the default balance
+    user = users.get_user_from_id(user_id, get_sensitive_info=True)
+    if at < user.createdAtUTC:
+        raise NotFoundException(f'User with id {user_id} did not exist at {at}')
+    return BalanceSnapshot(userId=user_id, atUTC=user.createdAtUTC, balance=users.DEFAULT_BALANCE)
+
+
+def replay_transfers(user_id, since, until):
+    # balance change from the transfers in (since, until], summed as decimals to avoid drifting
+    balance_change = Decimal(0)
+    replayed_transfers = 0
+    for stream_name in transactions.TRANSFER_STREAMS:
+        sign = -1 if stream_name == 'sent' else 1
+        for _, item in transactions.iterate_user_transfers_stream(stream_name, user_id, since=since, until=until,
+                                                                  fields=REPLAY_FIELDS):
+            if item['occurredAtUTC']['S'] == since:
+                continue  # already in the snapshot
+            balance_change += sign * Decimal(item['amount']['N'])
+            replayed_transfers += 1
+    return balance_change, replayed_transfers
+
+
+def compute_balance_at(user_id, at):
+    snapshot = get_starting_snapshot(user_id, at)
+    balance_change, replayed_transfers = replay_transfers(user_id, snapshot.atUTC, at)
+    return snapshot, float(Decimal(repr(snapshot.balance)) + balance_change), replayed_transfers
+
+
+def get_balance_at(user_id, at):
+    snapshot, balance, replayed_transfers = compute_balance_at(user_id, at)
+    if replayed_transfers >= SNAPSHOT_REPLAY_THRESHOLD and at <= get_settled_at():
+        try:
+            store_snapshot(BalanceSnapshot(userId=user_id, atUTC=at, balance=balance))  # the next query starts here
+        except Exception as e:
+            # only a shortcut for the next query, the balance is already computed
+            logger.error(f'Could not store the balance snapshot of {user_id} at {at}: {e}')
+    return {
+        'userId': user_id,
+        'at': at,
+        'balance': balance,
+        'snapshotAtUTC': snapshot.atUTC,
+        'replayedTransfers': replayed_transfers
+    }
+
+
+def compact_user_balance(user_id, at=None):
+    # writes a snapshot at the settled time when transfers happened since the previous one
+    at = get_settled_at() if at is None else at
+    _, balance, replayed_transfers = compute_balance_at(user_id, at)
+    if replayed_transfers == 0:
+        return False
+    store_snapshot(BalanceSnapshot(userId=user_id, atUTC=at, balance=balance))
+    return True
+
+
+def handler(event, context):
+    # scheduled compaction, every user gets a snapshot when it moved money since its last one
+    retry_u.set_deadline_from_lambda_context(context)
+    at = get_settled_at()
+    compacted_users = 0
+    failed_users = 0
+    try:
+        for user_id in users.iterate_user_ids():
+            try:
+                compacted_users += compact_user_balance(user_id, at=at)
+            except NotFoundException:
+                pass  # created after the settled time
+            except Exception as e:
+                # the other users are still compacted, this one replays a bit longer until the next run
+                logger.error(f'Could not compact the balance of {user_id} at {at}: {e}')
+                failed_users += 1
+    finally:
+        retry_u.clear_deadline()
+    logger.info(f'Wrote {compacted_users} balance snapshots at {at}, {failed_users} users failed')
+    return {'compacted_users': compacted_users, 'failed_users': failed_users, 'at': at}
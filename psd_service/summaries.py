@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+
+import psd_service.utils_dynamo as dynamo_u
+import psd_service.utils_retry as retry_u
+import psd_service.utils_uuid as uuid_u
+from psd_service.records import TransferSummary
+
+DYNAMODB_SUMMARIES = os.getenv('DYNAMODB_SUMMARIES')
+DYNAMODB_SUMMARIES_VOLUME_INDEX = os.getenv('DYNAMODB_SUMMARIES_VOLUME_INDEX', 'volume-index')
+TOTALS_ROW = '#'  # counterparty id of the totals row, never an uuid
+REPAIR_ROWS = '#repair'  # user id of the partition holding the updates left to apply, never an uuid
+MAX_TRANSACT_ITEMS = 100  # TransactWriteItems limit
+DEFAULT_TOP_COUNTERPARTIES = 5
+MAX_TOP_COUNTERPARTIES = 100
+SUMMARY_RETRY_POLICY = retry_u.RetryPolicy(retry_on=(retry_u.THROTTLING,))  # a throttled ADD was not applied
+# a cancelled transaction applied none of its rows, so a conflict is retried as well
+SUMMARY_CHUNK_RETRY_POLICY = retry_u.RetryPolicy(retry_on=(retry_u.CONCURRENCY, retry_u.THROTTLING))
+dynamodb = dynamo_u.get_dynamo_client()
+
+logger = logging.getLogger()
+
+
+def build_summary_row_update(user_id, counterparty_id, sent_count=0, sent_total=0.0, received_count=0,
+                             received_total=0.0, first_activity_at=None, last_activity_at=None):
+    add_values = {
+        ':sent_count': sent_count,
+        ':sent_total': sent_total,
+        ':received_count': received_count,
+        ':received_total': received_total
+    }
+    add_clauses = ['sentCount :sent_count', 'sentTotal :sent_total', 'receivedCount :received_count',
+                   'receivedTotal :received_total']
+    if counterparty_id != TOTALS_ROW:
+        add_values[':volume'] = sent_total + received_total
+        add_clauses.append('volume :volume')
+    set_values = {':first_activity_at': first_activity_at, ':last_activity_at': last_activity_at}
+    expression_attribute_values = dynamo_u.encode_item_for_dynamo({**add_values, **set_values})
+    return {
+        'TableName': DYNAMODB_SUMMARIES,
+        'Key': {'userId': {'S': user_id}, 'counterpartyId': {'S': counterparty_id}},
+        # rows are created by the first update, no read is needed
+        'UpdateExpression': f'ADD {", ".join(add_clauses)} '
+                            'SET firstActivityAtUTC = if_not_exists(firstActivityAtUTC, :first_activity_at), '
+                            'lastActivityAtUTC = :last_activity_at',
+        'ExpressionAttributeValues': expression_attribute_values
+    }
+
+
+def build_summary_updates(transfers):
+    # nets the transfers into one update per row, by user, each party gets its totals and its counterparty rows
+    rows = {}
+    for transfer in transfers:
+        at = transfer.occurredAtUTC
+        for user_id, counterparty_id, direction in ((transfer.srcUserId, transfer.dstUserId, 'sent'),
+                                                    (transfer.dstUserId, transfer.srcUserId, 'received')):
+            for row_id in (TOTALS_ROW, counterparty_id):
+                row = rows.setdefault(user_id, {}).setdefault(row_id, {
+                    'sent_count': 0, 'sent_total': 0.0, 'received_count': 0, 'received_total': 0.0,
+                    'first_activity_at': at, 'last_activity_at': at
+                })
+                row[f'{direction}_count'] += 1
+                row[f'{direction}_total'] += transfer.amount
+                row['first_activity_at'] = min(row['first_activity_at'], at)
+                row['last_activity_at'] = max(row['last_activity_at'], at)
+    return {
+        user_id: [build_summary_row_update(user_id, row_id, **row) for row_id, row in user_rows.items()]
+        for user_id, user_rows in rows.items()
+    }
+
+
+# The summaries are applied once the transfers are committed and never fail a request that a retry would apply again.
+# The updates that still fail are stored under REPAIR_ROWS and applied exactly once by repair_summaries, until then
+# the summaries lag behind the ledger. Only when storing them fails too is an update lost, it is then logged in full.
+# A repaired row may also set lastActivityAtUTC back to an older transfer, until the next transfer of the row.
+
+def apply_summary_updates(updates):
+    # plain updates, one per row, for the rows of hot accounts that a transaction would contend on
+    failed_updates = []
+    for update in updates:
+        try:
+            retry_u.retry_call(lambda: dynamodb.update_item(**update), 'apply_summary_updates',
+                               policy=SUMMARY_RETRY_POLICY)
+        except Exception as e:
+            logger.error(f'Could not update the summary row {update["Key"]}: {e}')
+            failed_updates.append(update)
+    store_summary_repairs(failed_updates)
+
+
+def apply_summary_updates_in_chunks(updates):
+    # one transaction per chunk, so a batch costs a few calls instead of one per row. The updates come from a single
+    # build_summary_updates, which gives each row at most one of them, as a transaction requires
+    failed_updates = []
+    for start in range(0, len(updates), MAX_TRANSACT_ITEMS):
+        chunk = updates[start:start + MAX_TRANSACT_ITEMS]
+        transact_items = [{'Update': update} for update in chunk]
+        try:
+            retry_u.retry_call(lambda: dynamodb.transact_write_items(TransactItems=transact_items),
+                               'apply_summary_updates_in_chunks', policy=SUMMARY_CHUNK_RETRY_POLICY)
+        except Exception as e:
+            logger.error(f'Could not update {len(chunk)} summary rows: {e}')
+            failed_updates += chunk
+    store_summary_repairs(failed_updates)
+
+
+def build_summary_repair_item(update):
+    return {
+        'userId': {'S': REPAIR_ROWS},
+        'counterpartyId': {'S': uuid_u.generate_time_ordered_uuid()},
+        'update': {'S': json.dumps({key: value for key, value in update.items() if key != 'TableName'})}
+    }
+
+
+def store_summary_repairs(updates):
+    if len(updates) == 0:
+        return
+    try:
+        dynamo_u.batch_write_items(dynamodb, DYNAMODB_SUMMARIES, [build_summary_repair_item(update)
+                                                                  for update in updates],
+                                   object_name='SummaryRepairs', encode=False)
+    except Exception as e:
+        for update in updates:
+            logger.error(f'Could not store the summary repair {json.dumps(update)}: {e}')
+
+
+def repair_summary_row(repair_item):
+    # the repair item is deleted along with the update, so a repair is applied once even by concurrent runs
+    update = {'TableName': DYNAMODB_SUMMARIES, **json.loads(repair_item['update']['S'])}
+    dynamodb.transact_write_items(TransactItems=[
+        {'Update': update},
+        {
+            'Delete': {
+                'TableName': DYNAMODB_SUMMARIES,
+                'Key': {'userId': repair_item['userId'], 'counterpartyId': repair_item['counterpartyId']},
+                'ConditionExpression': 'attribute_exists(counterpartyId)'
+            }
+        }
+    ])
+
+
+def repair_summaries():
+    repaired_rows = 0
+    query_kwargs = {
+        'TableName': DYNAMODB_SUMMARIES,
+        'KeyConditionExpression': 'userId = :user_id',
+        'ExpressionAttributeValues': {':user_id': {'S': REPAIR_ROWS}},
+        'ConsistentRead': True
+    }
+    for page in dynamo_u.iterate_query_pages(dynamodb, **query_kwargs):
+        for repair_item in page.get('Items', []):
+            try:
+                retry_u.retry_call(lambda: repair_summary_row(repair_item), 'repair_summaries',
+                                   policy=SUMMARY_CHUNK_RETRY_POLICY)
+                repaired_rows += 1
+            except Exception as e:
+                logger.error(f'Could not apply the summary repair {repair_item["counterpartyId"]["S"]}: {e}')
+    return repaired_rows
+
+
+def handler(event, context):
+    # scheduled repair of the summary updates that could not be applied along with their transfers
+    retry_u.set_deadline_from_lambda_context(context)
+    try:
+        repaired_rows = repair_summaries()
+    finally:
+        retry_u.clear_deadline()
+    logger.info(f'Repaired {repaired_rows} summary rows')
+    return {'repaired_rows': repaired_rows}
+
+
+def get_user_summary(user_id, top=DEFAULT_TOP_COUNTERPARTIES):
+    response = dynamodb.get_item(TableName=DYNAMODB_SUMMARIES,
+                                 Key={'userId': {'S': user_id}, 'counterpartyId': {'S': TOTALS_ROW}})
+    totals = TransferSummary.from_dynamo(response.get('Item', {}))
+    top_counterparties = []
+    if top > 0 and totals.has('lastActivityAtUTC'):
+        # the totals row has no volume, so the sparse index holds only counterparty rows, largest first
+        response = dynamodb.query(TableName=DYNAMODB_SUMMARIES, IndexName=DYNAMODB_SUMMARIES_VOLUME_INDEX,
+                                  KeyConditionExpression='userId = :user_id',
+                                  ExpressionAttributeValues={':user_id': {'S': user_id}},
+                                  ScanIndexForward=False, Limit=top)
+        top_counterparties = [TransferSummary.from_dynamo(item) for item in response.get('Items', [])]
+
+    summary = {
+        'userId': user_id,
+        'sent': {'count': totals.get('sentCount', 0), 'total': totals.get('sentTotal', 0.0)},
+        'received': {'count': totals.get('receivedCount', 0), 'total': totals.get('receivedTotal', 0.0)},
+        'firstActivityAtUTC': totals.get('firstActivityAtUTC'),
+        'lastActivityAtUTC': totals.get('lastActivityAtUTC'),
+        'topCounterparties': [
+            {
+                'userId': counterparty.counterpartyId,
+                'volume': counterparty.volume,
+                'sent': {'count': counterparty.sentCount, 'total': counterparty.sentTotal},
+                'received': {'count': counterparty.receivedCount, 'total': counterparty.receivedTotal}
+            }
+            for counterparty in top_counterparties
+        ]
+    }
+    return summary
@@ -1,98 +1,413 @@
+import heapq
+import logging
 import os
 import time
 from datetime import datetime as dt
+from decimal import Decimal
 
 from botocore.exceptions import ClientError
 
+import psd_service.balance_shards as balance_shards
+import psd_service.ledger_writer as ledger_writer
+import psd_service.summaries as summaries
+import psd_service.transfer_queue as transfer_queue
 import psd_service.users as users
 import psd_service.utils_dynamo as dynamo_u
+import psd_service.utils_http as http_u
+import psd_service.utils_retry as retry_u
 import psd_service.utils_uuid as uuid_u
-from psd_service.exceptions import NotEnoughBalanceException, NotFoundException
+from psd_service.records import Transfer, TransferStatus, User
+from psd_service.exceptions import NotEnoughBalanceException, BadRequestException, NotFoundException, \
+    ConcurrencyException, AlreadyProcessedException
 
 DYNAMODB_TRANSACTIONS = os.getenv('DYNAMODB_TRANSACTIONS')
+DYNAMODB_TRANSFER_STATUS = os.getenv('DYNAMODB_TRANSFER_STATUS')
+DYNAMODB_TRANSACTIONS_SRC_USER_INDEX = os.getenv('DYNAMODB_TRANSACTIONS_SRC_USER_INDEX',
+                                                 'srcUserId-occurredAtUTC-index')
+DYNAMODB_TRANSACTIONS_DST_USER_INDEX = os.getenv('DYNAMODB_TRANSACTIONS_DST_USER_INDEX',
+                                                 'dstUserId-occurredAtUTC-index')
+TRANSFER_KEY_FIELDS = ('id', 'occurredAtUTC', 'srcUserId', 'dstUserId')
+TRANSFER_STREAMS = {
+    'sent': ('srcUserId', DYNAMODB_TRANSACTIONS_SRC_USER_INDEX),
+    'received': ('dstUserId', DYNAMODB_TRANSACTIONS_DST_USER_INDEX)
+}
+MAX_BATCH_ACCOUNTS = 100  # TransactWriteItems limit, one item per account
+MAX_BATCH_ATTEMPTS = 3
+TRANSFER_RETRY_POLICY = retry_u.RetryPolicy(retry_on=(retry_u.CONCURRENCY, retry_u.THROTTLING))
+BATCH_RETRY_POLICY = retry_u.RetryPolicy(max_attempts=MAX_BATCH_ATTEMPTS,
+                                         retry_on=(retry_u.CONCURRENCY, retry_u.THROTTLING))
+TRANSFER_STATUS_TTL_SECONDS = int(os.getenv('TRANSFER_STATUS_TTL_SECONDS', str(7 * 24 * 60 * 60)))
+QUEUED = 'queued'
+COMPLETED = 'completed'
+FAILED = 'failed'
 dynamodb = dynamo_u.get_dynamo_client()
+ledger = ledger_writer.LedgerWriter(dynamodb, DYNAMODB_TRANSACTIONS)
+ledger_writer.flush_on_exit(ledger)
 
+logger = logging.getLogger()
 
-def register_transaction(src_user_id, dst_user_id, amount):
-    transfer_id = uuid_u.generate_uuid()
-    transfer = {
-        'id': transfer_id,
-        'srcUserId': src_user_id,
-        'dstUserId': dst_user_id,
-        'amount': amount,
-        'occurredAtUTC': dt.utcnow().isoformat()
-    }
-    dynamo_item = dynamo_u.encode_item_for_dynamo(transfer)
-    condition_expression = 'attribute_not_exists(id)'
+
+def build_transfer(src_user_id, dst_user_id, amount, transfer_id=None):
+    if transfer_id is None:
+        transfer_id = uuid_u.generate_time_ordered_uuid()
+        occurred_at = uuid_u.get_time_ordered_uuid_datetime(transfer_id)  # one clock read for the id and the time
+    else:
+        occurred_at = dt.utcnow()  # queued transfers keep their enqueue id, but occur when processed
+    return Transfer(
+        id=transfer_id,
+        srcUserId=src_user_id,
+        dstUserId=dst_user_id,
+        amount=amount,
+        occurredAtUTC=occurred_at.isoformat(timespec='microseconds')
+    )
+
+
+def store_ledger_rows(dynamo_items):
+    # the money already moved, so the rows are stored before answering, but a failure must not fail the request,
+    # a retried request would move the money again
     try:
-        response = dynamodb.put_item(TableName=DYNAMODB_TRANSACTIONS, Item=dynamo_item,
-                                     ConditionExpression=condition_expression)
-        dynamo_u.assert_valid_dynamo_put_response(response, object_name='User')
-        return transfer
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
-            time.sleep(1)
-            return register_transaction(src_user_id, dst_user_id, amount)
-        else:
-            raise e
+        ledger.write(dynamo_items)
+    except Exception as e:
+        logger.error(f'Could not store {len(dynamo_items)} ledger rows, {ledger.get_pending_count()} rows are kept '
+                     f'for the next flush: {e}')
 
 
-def make_transfer(src_user, dst_user, amount):
-    src_user_version = src_user['version']
-    if src_user['balance'] - amount >= 0:
-        src_user['balance'] -= amount
-    else:
-        raise NotEnoughBalanceException(f"User {src_user['id']} does not have enough balance")
+def flush_ledger():
+    ledger.flush()
 
-    src_user['version'] += 1
-    users.store_user(src_user, src_user_version)
 
-    while True:
-        try:
-            dst_user_version = dst_user['version']
-            dst_user['balance'] += amount
-            dst_user['version'] += 1
-            users.store_user(dst_user, dst_user_version)
-            break
-        except:
-            # The correct thing to do would be to publish this into a queue
-            try:
-                time.sleep(1)
-            except:
-                pass
-            dst_user = users.get_user_from_id(dst_user['id'])
-
-    return register_transaction(src_user['id'], dst_user['id'], amount)
-
-
-def get_user_transfers(user_id):
-    items = []
-    response = dynamodb.scan(
-        TableName=DYNAMODB_TRANSACTIONS,
-        ScanFilter={
-            'srcUserId': {
-                'AttributeValueList': [{'S': user_id}],
-                'ComparisonOperator': 'EQ'
-            }
+def validate_transfer(src_user_id, dst_user_id, amount):
+    if not uuid_u.check_if_valid_uuid(dst_user_id):
+        raise BadRequestException('Provide a valid dst user id!')
+
+    if not uuid_u.check_if_valid_uuid(src_user_id):
+        raise BadRequestException('Provide a valid src user id!')
+
+    if src_user_id == dst_user_id:
+        raise BadRequestException('Provide distinct user ids!')
+
+    if type(amount) not in (int, float):
+        raise BadRequestException('Provide a amount!')
+
+
+def build_transfer_status_completion(transfer):
+    # a redelivered queued transfer finds it completed and is not applied twice
+    return {
+        'TableName': DYNAMODB_TRANSFER_STATUS,
+        'Key': {'id': {'S': transfer.id}},
+        'UpdateExpression': 'SET #state = :completed, occurredAtUTC = :occurred_at',
+        'ConditionExpression': '#state = :queued',
+        'ExpressionAttributeNames': {'#state': 'state'},
+        'ExpressionAttributeValues': {
+            ':completed': {'S': COMPLETED},
+            ':queued': {'S': QUEUED},
+            ':occurred_at': {'S': transfer.occurredAtUTC}
         }
-    )
-    try:
-        items += dynamo_u.get_items_from_dynamo_response_or_fail(response, object_name='Transactions')
-    except NotFoundException:
-        pass  # Explicitly ignoring
-
-    response = dynamodb.scan(
-        TableName=DYNAMODB_TRANSACTIONS,
-        ScanFilter={
-            'dstUserId': {
-                'AttributeValueList': [{'S': user_id}],
-                'ComparisonOperator': 'EQ'
+    }
+
+
+def make_transfer(src_user_id, dst_user_id, amount, transfer_id=None):
+    # a transfer id is given by queued transfers, their status is completed along with the transfer
+    transfer = build_transfer(src_user_id, dst_user_id, amount, transfer_id=transfer_id)
+    summary_updates = summaries.build_summary_updates([transfer])
+    swept = False
+    deferred_summary_updates = []
+
+    def apply_transfer():
+        nonlocal swept
+        # debit, credit and ledger entry are applied in a single round-trip, all or nothing. The users are not read
+        # before, the debit condition checks the balance and the cancellation reasons tell what failed
+        transact_items = [
+            {'Update': users.build_balance_update(src_user_id, -amount)},
+            {'Update': users.build_credit_update(dst_user_id, amount)},  # hot accounts are credited on a shard
+            {
+                'Put': {
+                    'TableName': DYNAMODB_TRANSACTIONS,
+                    'Item': transfer.to_dynamo(),
+                    'ConditionExpression': 'attribute_not_exists(id)'
+                }
             }
-        }
+        ]
+        if transfer_id is not None:
+            transact_items.append({'Update': build_transfer_status_completion(transfer)})
+        # the summaries are kept along with the transfer, but the ones of hot accounts would contend again
+        deferred_summary_updates.clear()
+        for user_id in (src_user_id, dst_user_id):
+            if balance_shards.get_known_shard_count(user_id) is None:
+                transact_items += [{'Update': update} for update in summary_updates[user_id]]
+            else:
+                deferred_summary_updates.extend(summary_updates[user_id])
+        try:
+            dynamodb.transact_write_items(TransactItems=transact_items)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise e
+            reasons = e.response.get('CancellationReasons', [{}] * len(transact_items))
+            src_reason, dst_reason = reasons[0], reasons[1]
+            if transfer_id is not None and reasons[3].get('Code') == 'ConditionalCheckFailed':
+                raise AlreadyProcessedException(f'Transfer {transfer_id} was already processed')
+            if dst_reason.get('Code') == 'ConditionalCheckFailed':
+                shard_count = users.get_shard_count_from_item(dst_reason.get('Item'))
+                if shard_count is not None:
+                    balance_shards.remember_shard_count(dst_user_id, shard_count)
+                    return apply_transfer()  # credits the shard of the account instead
+            if src_reason.get('Code') == 'ConditionalCheckFailed':
+                if not swept and users.get_shard_count_from_item(src_reason.get('Item')) is not None:
+                    swept = True
+                    if users.sweep_balance_shards(src_user_id):
+                        return apply_transfer()  # checks the balance again with the credits of the shards
+            for user_id, delta, reason in ((src_user_id, -amount, src_reason), (dst_user_id, amount, dst_reason)):
+                if reason.get('Code') == 'ConditionalCheckFailed':
+                    users.raise_for_failed_balance_update(user_id, delta, reason.get('Item'))
+            if retry_u.classify_error(e) == retry_u.THROTTLING:
+                raise e
+            raise ConcurrencyException(f'Transfer was cancelled: {e}')  # conflicts with another transaction
+
+    try:
+        retry_u.retry_call(apply_transfer, 'make_transfer', policy=TRANSFER_RETRY_POLICY)
+    finally:
+        users.invalidate_cached_users((src_user_id, dst_user_id))
+    summaries.apply_summary_updates(deferred_summary_updates)  # plain updates, they never raise after the commit
+    return transfer
+
+
+def enqueue_transfer(src_user_id, dst_user_id, amount):
+    transfer_status = TransferStatus(
+        id=uuid_u.generate_time_ordered_uuid(),
+        state=QUEUED,
+        srcUserId=src_user_id,
+        dstUserId=dst_user_id,
+        amount=amount,
+        expiresAt=int(time.time()) + TRANSFER_STATUS_TTL_SECONDS
     )
+    dynamodb.put_item(TableName=DYNAMODB_TRANSFER_STATUS, Item=transfer_status.to_dynamo(),
+                      ConditionExpression='attribute_not_exists(id)')
+    message = {'id': transfer_status.id, 'srcUserId': src_user_id, 'dstUserId': dst_user_id, 'amount': amount}
+    try:
+        transfer_queue.transfer_queue.send(message)
+    except Exception as e:
+        fail_queued_transfer(transfer_status.id, 'Could not queue the transfer')
+        raise e
+    return transfer_status
+
+
+def fail_queued_transfer(transfer_id, error):
     try:
-        items += dynamo_u.get_items_from_dynamo_response_or_fail(response, object_name='Transactions')
-    except NotFoundException:
-        pass  # Explicitly ignoring
+        dynamodb.update_item(
+            TableName=DYNAMODB_TRANSFER_STATUS,
+            Key={'id': {'S': transfer_id}},
+            UpdateExpression='SET #state = :failed, #error = :error',
+            ConditionExpression='#state = :queued',
+            ExpressionAttributeNames={'#state': 'state', '#error': 'error'},
+            ExpressionAttributeValues={':failed': {'S': FAILED}, ':queued': {'S': QUEUED}, ':error': {'S': error}}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise e  # otherwise it was processed meanwhile
+
+
+def process_queued_transfer(message):
+    # errors other than the final ones are raised, so the message is delivered again
+    try:
+        make_transfer(message['srcUserId'], message['dstUserId'], message['amount'], transfer_id=message['id'])
+    except AlreadyProcessedException:
+        pass  # a redelivered message
+    except (NotFoundException, NotEnoughBalanceException) as e:
+        fail_queued_transfer(message['id'], str(e))
+
+
+def get_transfer_status(transfer_id):
+    response = dynamodb.get_item(TableName=DYNAMODB_TRANSFER_STATUS, Key={'id': {'S': transfer_id}})
+    if 'Item' in response:
+        return TransferStatus.from_dynamo(response['Item'])
+    # transfers made synchronously only exist in the ledger
+    response = dynamodb.query(TableName=DYNAMODB_TRANSACTIONS, KeyConditionExpression='id = :id',
+                              ExpressionAttributeValues={':id': {'S': transfer_id}}, Limit=1)
+    items = dynamo_u.get_items_from_dynamo_response_or_fail(response, object_name='Transfer', decode=False)
+    transfer = Transfer.from_dynamo(items[0])
+    return TransferStatus(state=COMPLETED, **transfer.to_dict())
+
+
+def plan_batch_transfer(transfer_requests, balances):
+    # replays the requests in order against the known balances and nets the accepted ones per account, as decimals
+    # so a batch netting to zero leaves no float residue behind
+    results = []
+    balance_deltas = {}
+    accepted_transfers = []
+    running_balances = {user_id: Decimal(repr(balance)) for user_id, balance in balances.items()}
+    for i, (src_user_id, dst_user_id, amount, error) in enumerate(transfer_requests):
+        if error is None and src_user_id not in running_balances:
+            error = NotFoundException(f'User with id {src_user_id} does not exists')
+        if error is None and dst_user_id not in running_balances:
+            error = NotFoundException(f'User with id {dst_user_id} does not exists')
+        if error is None and running_balances[src_user_id] - Decimal(repr(amount)) < 0:
+            error = NotEnoughBalanceException(f'User {src_user_id} does not have enough balance')
+        if error is not None:
+            results.append({'index': i, 'status': 'failed', 'error': str(error)})
+            continue
+        running_balances[src_user_id] -= Decimal(repr(amount))
+        running_balances[dst_user_id] += Decimal(repr(amount))
+        balance_deltas[src_user_id] = balance_deltas.get(src_user_id, Decimal(0)) - Decimal(repr(amount))
+        balance_deltas[dst_user_id] = balance_deltas.get(dst_user_id, Decimal(0)) + Decimal(repr(amount))
+        transfer = build_transfer(src_user_id, dst_user_id, amount)
+        accepted_transfers.append(transfer)
+        results.append({'index': i, 'status': 'ok', 'transaction': transfer.to_dict()})
+    balance_deltas = {user_id: float(delta) for user_id, delta in balance_deltas.items() if delta != 0}
+    return results, balance_deltas, accepted_transfers
+
+
+def parse_batch_transfer_requests(transfer_requests):
+    parsed_requests = []
+    required_fields = ['src_user_id', 'dst_user_id', 'amount']
+    for transfer_request in transfer_requests:
+        try:
+            if type(transfer_request) is not dict:
+                raise BadRequestException('Provide each transfer as an object!')
+            http_u.validate_request(transfer_request, required_fields)
+            src_user_id = transfer_request['src_user_id']
+            dst_user_id = transfer_request['dst_user_id']
+            amount = transfer_request['amount']
+            validate_transfer(src_user_id, dst_user_id, amount)
+            parsed_requests.append((src_user_id, dst_user_id, amount, None))
+        except BadRequestException as e:
+            parsed_requests.append((None, None, None, e))
+    return parsed_requests
+
+
+def make_batch_transfer(transfer_requests):
+    transfer_requests = parse_batch_transfer_requests(transfer_requests)
+    user_ids = {user_id for src_user_id, dst_user_id, _, _ in transfer_requests
+                for user_id in (src_user_id, dst_user_id) if user_id is not None}
+    if len(user_ids) > MAX_BATCH_ACCOUNTS:
+        raise BadRequestException(f'A batch can move money across at most {MAX_BATCH_ACCOUNTS} accounts!')
+
+    # the transfers involving missing users will fail
+    found_users = users.get_users_by_ids(list(user_ids), consistent_read=True)
+    balances = {user_id: user.balance for user_id, user in found_users.items()}  # shards are summed in
+    src_user_ids = {src_user_id for src_user_id, _, _, _ in transfer_requests}
+    for user_id, user in found_users.items():
+        if user_id in src_user_ids and user.get('balanceShards') is not None:
+            users.sweep_balance_shards(user_id)  # debits are checked against the main item only
+
+    def apply_batch():
+        results, balance_deltas, accepted_transfers = plan_batch_transfer(transfer_requests, balances)
+        if len(balance_deltas) == 0:
+            return results, accepted_transfers
+        account_ids = list(balance_deltas.keys())
+        transact_items = [
+            {'Update': users.build_balance_update(user_id, delta) if delta < 0 else
+                users.build_credit_update(user_id, delta)}  # hot accounts are credited on a shard
+            for user_id, delta in balance_deltas.items()
+        ]  # one write per account, all or nothing
+        try:
+            dynamodb.transact_write_items(TransactItems=transact_items)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise e
+            for user_id, reason in zip(account_ids, e.response.get('CancellationReasons', [])):
+                if reason.get('Code') != 'ConditionalCheckFailed':
+                    continue
+                if 'Item' in reason:
+                    balances[user_id] = User.from_dynamo(reason['Item'], fields=('balance',)).balance
+                    shard_count = users.get_shard_count_from_item(reason['Item'])
+                    if shard_count is not None:
+                        balance_shards.remember_shard_count(user_id, shard_count)  # sharded meanwhile
+                else:
+                    balances.pop(user_id, None)  # the user was deleted meanwhile
+            if retry_u.classify_error(e) == retry_u.THROTTLING:
+                raise e
+            # plans again with the balances that made the transaction fail, or after a conflict
+            raise ConcurrencyException('Could not apply the batch, the accounts are being modified concurrently')
+        finally:
+            users.invalidate_cached_users(account_ids)
+        return results, accepted_transfers
+
+    results, accepted_transfers = retry_u.retry_call(apply_batch, 'make_batch_transfer', policy=BATCH_RETRY_POLICY)
+    if len(accepted_transfers) > 0:
+        store_ledger_rows([transfer.to_dynamo() for transfer in accepted_transfers])
+        summary_updates = summaries.build_summary_updates(accepted_transfers)
+        summaries.apply_summary_updates_in_chunks([update for updates in summary_updates.values()
+                                                   for update in updates])
+    return results
+
+
+def iterate_user_transfers_stream(stream_name, user_id, since=None, until=None, exclusive_start_key=None,
+                                  page_size=None, fields=None):
+    user_key, index_name = TRANSFER_STREAMS[stream_name]
+    key_condition_expression = f'{user_key} = :user_id'
+    expression_attribute_values = {':user_id': {'S': user_id}}
+    if since is not None and until is not None:
+        key_condition_expression += ' AND occurredAtUTC BETWEEN :since AND :until'
+    elif since is not None:
+        key_condition_expression += ' AND occurredAtUTC >= :since'
+    elif until is not None:
+        key_condition_expression += ' AND occurredAtUTC <= :until'
+    if since is not None:
+        expression_attribute_values[':since'] = {'S': since}
+    if until is not None:
+        expression_attribute_values[':until'] = {'S': until}
+
+    query_kwargs = {
+        'TableName': DYNAMODB_TRANSACTIONS,
+        'IndexName': index_name,
+        'KeyConditionExpression': key_condition_expression,
+        'ExpressionAttributeValues': expression_attribute_values,
+        'ScanIndexForward': False  # newest first
+    }
+    if exclusive_start_key is not None:
+        query_kwargs['ExclusiveStartKey'] = exclusive_start_key
+    if page_size is not None:
+        query_kwargs['Limit'] = page_size
+    if fields is not None:
+        projection_expression, expression_attribute_names = dynamo_u.build_projection_expression(fields)
+        query_kwargs['ProjectionExpression'] = projection_expression
+        query_kwargs['ExpressionAttributeNames'] = expression_attribute_names
+
+    for page in dynamo_u.iterate_query_pages(dynamodb, **query_kwargs):
+        for item in page.get('Items', []):
+            yield stream_name, item
+
+
+def is_valid_stream_position(stream_name, position):
+    # the keys of the last item read, as sent to dynamo, a tampered one would fail the query instead
+    if position is None:
+        return True
+    user_key, _ = TRANSFER_STREAMS[stream_name]
+    return type(position) is dict and set(position.keys()) == {'id', 'occurredAtUTC', user_key} and \
+        all(type(value) is dict and list(value.keys()) == ['S'] and type(value['S']) is str
+            for value in position.values())
+
+
+def decode_user_transfers_cursor(cursor):
+    positions = dynamo_u.decode_cursor(cursor)
+    for stream_name, position in positions.items():
+        if stream_name not in TRANSFER_STREAMS or not is_valid_stream_position(stream_name, position):
+            raise BadRequestException('Provide a valid cursor!')
+    return positions
+
+
+def get_user_transfers(user_id, since=None, until=None, limit=None, cursor=None, fields=None):
+    if cursor is None:
+        positions = {stream_name: None for stream_name in TRANSFER_STREAMS}  # every stream from the start
+    else:
+        positions = decode_user_transfers_cursor(cursor)  # each stream resumes after the last item it gave
+    page_size = None if limit is None else limit + 1  # one extra item tells if there is a next page
+    if fields is not None:
+        fields = tuple(dict.fromkeys(TRANSFER_KEY_FIELDS + tuple(fields)))  # keys are needed to merge and page
+
+    streams = [
+        iterate_user_transfers_stream(stream_name, user_id, since=since, until=until,
+                                      exclusive_start_key=position, page_size=page_size, fields=fields)
+        for stream_name, position in positions.items()
+    ]
+    merged_streams = heapq.merge(*streams, key=lambda stream_item: stream_item[1]['occurredAtUTC']['S'],
+                                 reverse=True)
 
-    return items
+    transfers = []
+    for stream_name, item in merged_streams:
+        if limit is not None and len(transfers) >= limit:
+            return transfers, dynamo_u.encode_cursor(positions)
+        transfers.append(Transfer.from_dynamo(item, fields=fields))
+        user_key, _ = TRANSFER_STREAMS[stream_name]
+        positions[stream_name] = {key: item[key] for key in ('id', 'occurredAtUTC', user_key)}
+    return transfers, None
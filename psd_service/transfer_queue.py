@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+import boto3
+
+TRANSFER_QUEUE = os.getenv('TRANSFER_QUEUE', 'memory')  # memory, file or sqs
+TRANSFER_QUEUE_URL = os.getenv('TRANSFER_QUEUE_URL')
+TRANSFER_QUEUE_PATH = os.getenv('TRANSFER_QUEUE_PATH', '/tmp/transfer-queue')
+SQS_MAX_MESSAGES = 10  # ReceiveMessage limit
+
+
+class TransferQueue(object):
+    # At least once delivery: a received message comes back unless it is deleted, or right away when released
+    DRAINED_BY_SENDER = False  # no worker reads the queue, the sending process drains it after answering
+
+    def send(self, message):
+        raise NotImplementedError()
+
+    def receive(self, max_messages=SQS_MAX_MESSAGES):
+        # returns (message, receipt) pairs
+        raise NotImplementedError()
+
+    def delete(self, receipt):
+        raise NotImplementedError()
+
+    def release(self, receipt):
+        raise NotImplementedError()
+
+
+class InProcessTransferQueue(TransferQueue):
+    DRAINED_BY_SENDER = True
+
+    def __init__(self):
+        self.messages = deque()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            self.messages.append(json.dumps(message))
+
+    def receive(self, max_messages=SQS_MAX_MESSAGES):
+        received = []
+        with self.lock:
+            while len(self.messages) > 0 and len(received) < max_messages:
+                receipt = str(uuid.uuid4())
+                self.in_flight[receipt] = self.messages.popleft()
+                received.append((json.loads(self.in_flight[receipt]), receipt))
+        return received
+
+    def delete(self, receipt):
+        with self.lock:
+            self.in_flight.pop(receipt, None)
+
+    def release(self, receipt):
+        with self.lock:
+            message = self.in_flight.pop(receipt, None)
+            if message is not None:
+                self.messages.appendleft(message)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.messages) + len(self.in_flight)
+
+
+class FileTransferQueue(TransferQueue):
+    # one file per message, claimed by renaming it, so several local processes can share the queue
+
+    def __init__(self, path=TRANSFER_QUEUE_PATH):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def send(self, message):
+        name = f'{time.time_ns():020d}-{uuid.uuid4().hex}'  # keeps the sending order when sorted
+        temporary_path = os.path.join(self.path, f'{name}.tmp')
+        with open(temporary_path, 'w') as message_file:
+            json.dump(message, message_file)
+        os.rename(temporary_path, os.path.join(self.path, f'{name}.json'))  # never seen half written
+
+    def receive(self, max_messages=SQS_MAX_MESSAGES):
+        received = []
+        for file_name in sorted(os.listdir(self.path)):
+            if len(received) >= max_messages:
+                break
+            if not file_name.endswith('.json'):
+                continue
+            receipt = os.path.join(self.path, f'{file_name[:-len(".json")]}.processing')
+            try:
+                os.rename(os.path.join(self.path, file_name), receipt)
+            except FileNotFoundError:
+                continue  # claimed by another process
+            with open(receipt) as message_file:
+                received.append((json.load(message_file), receipt))
+        return received
+
+    def delete(self, receipt):
+        try:
+            os.remove(receipt)
+        except FileNotFoundError:
+            pass
+
+    def release(self, receipt):
+        os.rename(receipt, f'{receipt[:-len(".processing")]}.json')
+
+
+class SqsTransferQueue(TransferQueue):
+
+    def __init__(self, queue_url=TRANSFER_QUEUE_URL):
+        self.queue_url = queue_url
+        self.client = boto3.client('sqs')
+
+    def send(self, message):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(message))
+
+    def receive(self, max_messages=SQS_MAX_MESSAGES):
+        response = self.client.receive_message(QueueUrl=self.queue_url,
+                                               MaxNumberOfMessages=min(max_messages, SQS_MAX_MESSAGES))
+        return [(json.loads(message['Body']), message['ReceiptHandle']) for message in response.get('Messages', [])]
+
+    def delete(self, receipt):
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+
+    def release(self, receipt):
+        self.client.change_message_visibility(QueueUrl=self.queue_url, ReceiptHandle=receipt, VisibilityTimeout=0)
+
+
+def build_transfer_queue(kind=TRANSFER_QUEUE):
+    if kind == 'sqs':
+        return SqsTransferQueue()
+    if kind == 'file':
+        return FileTransferQueue()
+    if kind == 'memory':
+        return InProcessTransferQueue()
+    raise ValueError(f'Unknown transfer queue `{kind}`')
+
+
+transfer_queue = build_transfer_queue()
@@ -0,0 +1,47 @@
+import json
+import logging
+
+import psd_service.transactions as transactions
+import psd_service.transfer_queue as transfer_queue
+import psd_service.utils_retry as retry_u
+
+logger = logging.getLogger()
+
+
+def drain_queue(queue=None, max_messages=None):
+    # polls until the queue is empty, for the queues that no lambda is triggered by
+    queue = transfer_queue.transfer_queue if queue is None else queue
+    processed_messages = 0
+    while max_messages is None or processed_messages < max_messages:
+        received = queue.receive()
+        if len(received) == 0:
+            break
+        for i, (message, receipt) in enumerate(received):
+            try:
+                transactions.process_queued_transfer(message)
+                queue.delete(receipt)
+            except Exception as e:
+                logger.error(f'Could not process transfer {message.get("id")}: {type(e)}-{e}')
+                # the rest of the batch is released too, the in-process queue would never deliver it again,
+                # the last one first so they come back in order
+                for _, unprocessed_receipt in reversed(received[i:]):
+                    queue.release(unprocessed_receipt)
+                return processed_messages  # the next drain tries them again
+            processed_messages += 1
+    return processed_messages
+
+
+def handler(event, context):
+    # triggered by the sqs queue, only the failed messages are delivered again
+    retry_u.set_deadline_from_lambda_context(context)
+    failures = []
+    try:
+        for record in event.get('Records', []):
+            try:
+                transactions.process_queued_transfer(json.loads(record['body']))
+            except Exception as e:
+                logger.error(f'Could not process message {record["messageId"]}: {type(e)}-{e}')
+                failures.append({'itemIdentifier': record['messageId']})
+    finally:
+        retry_u.clear_deadline()
+    return {'batchItemFailures': failures}
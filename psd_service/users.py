@@ -5,14 +5,25 @@ from datetime import datetime as dt
 
 from botocore.exceptions import ClientError
 
+import psd_service.balance_shards as balance_shards
+import psd_service.utils_cache as cache_u
 import psd_service.utils_dynamo as dynamo_u
+import psd_service.utils_retry as retry_u
 import psd_service.utils_uuid as uuid_u
-from psd_service.exceptions import NotFoundException, CannotSaveException, BadCredentialsException, ConcurrencyException
+from psd_service.records import User
+from psd_service.exceptions import NotFoundException, CannotSaveException, BadCredentialsException, \
+    ConcurrencyException, NotEnoughBalanceException
 
 DYNAMODB_USERS = os.getenv('DYNAMODB_USERS')
+DYNAMODB_USERS_USERNAME_INDEX = os.getenv('DYNAMODB_USERS_USERNAME_INDEX', 'username-index')
 dynamodb = dynamo_u.get_dynamo_client()
 
 DEFAULT_BALANCE = 500.0
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '1024'))
+USER_CACHE_TTL_SECONDS = float(os.getenv('USER_CACHE_TTL_SECONDS', '5'))
+user_cache = cache_u.LRUCache(max_size=USER_CACHE_SIZE, ttl_seconds=USER_CACHE_TTL_SECONDS)
+STORE_USER_RETRY_POLICY = retry_u.RetryPolicy(retry_on=(retry_u.THROTTLING,))
+SWEEP_RETRY_POLICY = retry_u.RetryPolicy(retry_on=(retry_u.CONCURRENCY, retry_u.THROTTLING))
 
 logger = logging.getLogger()
 
@@ -32,19 +43,19 @@ def generate_password_hash(password, salt):
 def create_user(username, password, name, surname):
     user_id = uuid_u.generate_uuid_from_str(username)  # makes it unique
     salt = generate_salt()
-    user = {
-        'id': user_id,
-        'username': username,
-        'passwordHash': generate_password_hash(password, salt),
-        'salt': salt,
-        'name': name,
-        'surname': surname,
-        'createdAtUTC': dt.utcnow().isoformat(),
-        'verifiedAccount': False,
-        'balance': DEFAULT_BALANCE,
-        'version': 0
-    }
-    dynamo_item = dynamo_u.encode_item_for_dynamo(user)
+    user = User(
+        id=user_id,
+        username=username,
+        passwordHash=generate_password_hash(password, salt),
+        salt=salt,
+        name=name,
+        surname=surname,
+        createdAtUTC=dt.utcnow().isoformat(),
+        verifiedAccount=False,
+        balance=DEFAULT_BALANCE,
+        version=0
+    )
+    dynamo_item = user.to_dynamo()
     condition_expression = 'attribute_not_exists(id)'
     try:
         response = dynamodb.put_item(TableName=DYNAMODB_USERS, Item=dynamo_item,
@@ -57,73 +68,291 @@ def create_user(username, password, name, surname):
         raise e
 
 
-def get_user_from_id(user_id, get_sensitive_info=False):
+def cache_user(user):
+    public_user = User.from_dict(user.to_dict(fields=User.NON_SENSITIVE_FIELDS))  # never the hashes
+    user_cache.put(user.id, public_user, version=user.get('version'))
+
+
+def invalidate_cached_users(user_ids):
+    for user_id in user_ids:
+        user_cache.invalidate(user_id)
+        balance_shards.invalidate_shard_balance(user_id)  # a shard may have been credited
+
+
+def get_user_cache_stats():
+    return user_cache.get_stats()
+
+
+def get_fields_to_read(fields):
+    fields = ('id',) + tuple(fields)  # the id tells apart a missing user
+    if 'balance' in fields:
+        fields += ('balanceShards',)  # tells if the balance is spread over shards
+    return tuple(dict.fromkeys(fields))
+
+
+def add_shard_balances(user, consistent_read=False):
+    # the main item holds the balance swept so far, the shards hold the credits received since
+    shard_count = user.get('balanceShards')
+    if shard_count is not None:
+        balance_shards.remember_shard_count(user.id, shard_count)
+        if user.has('balance'):
+            user.balance += balance_shards.get_shard_balance_sum(user.id, consistent_read=consistent_read)
+    return user
+
+
+def get_user_from_id(user_id, get_sensitive_info=False, consistent_read=False, fields=None):
+    if not get_sensitive_info and not consistent_read:
+        cached_user = user_cache.get(user_id)
+        if cached_user is not None:
+            # holds every public field, callers render only the ones they want
+            return add_shard_balances(cached_user.copy())
+
+    if get_sensitive_info:
+        fields = User.FIELD_NAMES
+    elif fields is None:
+        fields = User.NON_SENSITIVE_FIELDS  # the shard count is read too, the balance needs it
+    else:
+        fields = get_fields_to_read(fields)
+    projection_expression, expression_attribute_names = dynamo_u.build_projection_expression(fields)
     try:
-        response = dynamodb.get_item(TableName=DYNAMODB_USERS, Key={'id': {'S': user_id}})
-        user = dynamo_u.get_item_from_dynamo_response_or_fail(response, object_name='User')
-        if get_sensitive_info:
-            return user
-        else:
-            non_sensitive_keys = ['id', 'username', 'name', 'surname', 'verifiedAccount', 'balance', 'version']
-            user_with_filtered_data = {}
-            for key in non_sensitive_keys:
-                user_with_filtered_data[key] = user[key]
-            return user_with_filtered_data
+        response = dynamodb.get_item(TableName=DYNAMODB_USERS, Key={'id': {'S': user_id}},
+                                     ConsistentRead=consistent_read, ProjectionExpression=projection_expression,
+                                     ExpressionAttributeNames=expression_attribute_names)
+        dynamo_item = dynamo_u.get_item_from_dynamo_response_or_fail(response, object_name='User', decode=False)
+        user = User.from_dynamo(dynamo_item, fields=fields)
+        if fields == User.NON_SENSITIVE_FIELDS:
+            cache_user(user)
+        return add_shard_balances(user, consistent_read=consistent_read)
     except ClientError as e:
         logger.error(e.response['Error']['Message'])
         raise NotFoundException(f'User with id {user_id} does not exists')
 
 
+def compute_user_etag(user):
+    # changes whenever any field does, the user needs its version and balance
+    if user.get('balanceShards') is None:
+        return str(user.version)
+    return f'{user.version}-{user.balance}'  # shard credits change the balance but not the version
+
+
+def get_user_etag(user_id):
+    # read from the cache or a projection of the version and balance only
+    return compute_user_etag(get_user_from_id(user_id, fields=('version', 'balance')))
+
+
+def get_users_by_ids(user_ids, consistent_read=False):
+    found_users = {}
+    missing_user_ids = []
+    for user_id in dict.fromkeys(user_ids):
+        cached_user = None if consistent_read else user_cache.get(user_id)
+        if cached_user is not None:
+            found_users[user_id] = add_shard_balances(cached_user.copy())
+        else:
+            missing_user_ids.append(user_id)
+    if len(missing_user_ids) == 0:
+        return found_users
+
+    keys = [{'id': {'S': user_id}} for user_id in missing_user_ids]
+    projection_expression, expression_attribute_names = dynamo_u.build_projection_expression(
+        User.NON_SENSITIVE_FIELDS)
+    found_items = dynamo_u.batch_get_items(dynamodb, DYNAMODB_USERS, keys, projection_expression=projection_expression,
+                                           expression_attribute_names=expression_attribute_names,
+                                           consistent_read=consistent_read, decode=False)
+    for item in found_items:
+        user = User.from_dynamo(item)
+        cache_user(user)
+        found_users[user.id] = add_shard_balances(user, consistent_read=consistent_read)
+    return found_users  # missing users are left out
+
+
 def get_user_from_username(username):
-    response = dynamodb.scan(
+    user_id = uuid_u.generate_uuid_from_str(username)  # ids are derived from the username, so try the key first
+    try:
+        user = get_user_from_id(user_id, get_sensitive_info=True)
+        if user.username == username:
+            return user
+    except NotFoundException:
+        pass  # falling back to the index
+
+    response = dynamodb.query(
         TableName=DYNAMODB_USERS,
-        ScanFilter={
-            'username': {
-                'AttributeValueList': [{'S': username}],
-                'ComparisonOperator': 'EQ'
-            }
-        }
+        IndexName=DYNAMODB_USERS_USERNAME_INDEX,
+        KeyConditionExpression='username = :username',
+        ExpressionAttributeValues={
+            ':username': {'S': username}
+        },
+        Limit=1
     )
     try:
-        items = dynamo_u.get_items_from_dynamo_response_or_fail(response, object_name='User')
-        return items[0]
-    except:
+        items = dynamo_u.get_items_from_dynamo_response_or_fail(response, object_name='User', decode=False)
+        return User.from_dynamo(items[0])
+    except NotFoundException:
         raise NotFoundException(f'User with username {username} does not exists')
 
 
-def get_all_user_ids():
-    response = dynamodb.scan(TableName=DYNAMODB_USERS)
-    users = []
-    try:
-        users = dynamo_u.get_items_from_dynamo_response_or_fail(response, object_name='Users')
-    except:
-        pass  # Explicitly ignoring
-    users = [user['id'] for user in users]  # removing other fields
-    return users
+def get_users_page(limit=None, cursor=None, fields=('id',)):
+    fields = get_fields_to_read(fields)
+    projection_expression, expression_attribute_names = dynamo_u.build_projection_expression(fields)
+    scan_kwargs = {
+        'TableName': DYNAMODB_USERS,
+        'ProjectionExpression': projection_expression,  # no need to read hashes and salts
+        'ExpressionAttributeNames': expression_attribute_names
+    }
+    if limit is not None:
+        scan_kwargs['Limit'] = limit
+    exclusive_start_key = dynamo_u.decode_cursor(cursor, key_names=('id',))
+    if exclusive_start_key is not None:
+        scan_kwargs['ExclusiveStartKey'] = exclusive_start_key
+
+    response = dynamodb.scan(**scan_kwargs)
+    found_users = [add_shard_balances(User.from_dynamo(item, fields=fields)) for item in response.get('Items', [])]
+    next_cursor = dynamo_u.encode_cursor(response.get('LastEvaluatedKey'))
+    return found_users, next_cursor
+
+
+def get_user_ids_page(limit=None, cursor=None):
+    found_users, next_cursor = get_users_page(limit=limit, cursor=cursor)
+    return [user.id for user in found_users], next_cursor
+
+
+def iterate_users(cursor=None, fields=('id',)):
+    fields = get_fields_to_read(fields)
+    projection_expression, expression_attribute_names = dynamo_u.build_projection_expression(fields)
+    if cursor is None:
+        items = dynamo_u.parallel_scan(dynamodb, DYNAMODB_USERS, projection_expression=projection_expression,
+                                       expression_attribute_names=expression_attribute_names, decode=False)
+        return (add_shard_balances(User.from_dynamo(item, fields=fields)) for item in items)
+
+    scan_kwargs = {
+        'TableName': DYNAMODB_USERS,
+        'ProjectionExpression': projection_expression,
+        'ExpressionAttributeNames': expression_attribute_names,
+        'ExclusiveStartKey': dynamo_u.decode_cursor(cursor, key_names=('id',))  # validates before streaming
+    }
+    pages = dynamo_u.iterate_scan_pages(dynamodb, **scan_kwargs)
+    return (add_shard_balances(User.from_dynamo(item, fields=fields))
+            for page in pages for item in page.get('Items', []))
+
+
+def iterate_user_ids(cursor=None):
+    return (user.id for user in iterate_users(cursor=cursor))
 
 
 def auth_user_and_get_token(username, password):
     user = get_user_from_username(username)
-    computed_hash = generate_password_hash(password, user['salt'])
+    computed_hash = generate_password_hash(password, user.salt)
 
-    if not computed_hash == user['passwordHash']:
+    if not computed_hash == user.passwordHash:
         raise BadCredentialsException('username and/or password does not match')
     return 'a_super_safe_token'
 
 
-def store_user(user, version):
-    dynamo_item = dynamo_u.encode_item_for_dynamo(user)
+def build_user_update(user_id, set_values=None, add_values=None, condition_expression=None,
+                      condition_values=None, return_old_on_failure=False):
+    # partial update of a user, usable on UpdateItem and inside TransactWriteItems
+    expression_attribute_names = {}
+    expression_attribute_values = {}
+    clauses = []
+    for action, prefix, values in (('SET', 's', set_values), ('ADD', 'a', add_values)):
+        if not values:
+            continue
+        assignments = []
+        for i, (name, value) in enumerate(values.items()):
+            expression_attribute_names[f'#{prefix}{i}'] = name  # `name` is a reserved word
+            expression_attribute_values[f':{prefix}{i}'] = User.ENCODERS[name](value)
+            assignments.append(f'#{prefix}{i} = :{prefix}{i}' if action == 'SET' else f'#{prefix}{i} :{prefix}{i}')
+        clauses.append(f'{action} {", ".join(assignments)}')
+    update = {
+        'TableName': DYNAMODB_USERS,
+        'Key': {'id': {'S': user_id}},
+        'UpdateExpression': ' '.join(clauses),
+        'ExpressionAttributeNames': expression_attribute_names
+    }
+    if condition_expression is not None:
+        update['ConditionExpression'] = condition_expression
+        expression_attribute_values.update(dynamo_u.encode_item_for_dynamo(condition_values or {}))
+    if return_old_on_failure:
+        update['ReturnValuesOnConditionCheckFailure'] = 'ALL_OLD'
+    update['ExpressionAttributeValues'] = expression_attribute_values
+    return update
+
+
+def update_user(update, call_site='update_user'):
+    # applies a partial update and returns the user as it is after it
+    response = retry_u.retry_call(lambda: dynamodb.update_item(ReturnValues='ALL_NEW', **update), call_site,
+                                  policy=STORE_USER_RETRY_POLICY)
+    user = User.from_dynamo(response['Attributes'])
+    cache_user(user)
+    return add_shard_balances(user)
+
+
+def build_balance_update(user_id, delta):
+    # version is bumped for version-checked writers
+    add_values = {'balance': delta, 'version': 1}
+    if delta < 0:
+        # also fails when the user does not exist, the old item tells both cases apart
+        return build_user_update(user_id, add_values=add_values, condition_expression='balance >= :needed',
+                                 condition_values={':needed': -delta}, return_old_on_failure=True)
+    # sharded accounts are credited on their shards instead, the old item tells them apart
+    return build_user_update(user_id, add_values=add_values,
+                             condition_expression='attribute_exists(id) AND attribute_not_exists(balanceShards)',
+                             return_old_on_failure=True)
+
+
+def build_credit_update(user_id, amount):
+    shard_count = balance_shards.get_known_shard_count(user_id)
+    if shard_count is None:
+        return build_balance_update(user_id, amount)
+    return balance_shards.build_shard_credit(user_id, shard_count, amount)
+
+
+def get_shard_count_from_item(dynamo_item):
+    if dynamo_item is None or 'balanceShards' not in dynamo_item:
+        return None
+    return User.from_dynamo(dynamo_item, fields=('balanceShards',)).balanceShards
+
+
+def raise_for_failed_balance_update(user_id, delta, old_item):
+    if delta >= 0 or old_item is None:
+        raise NotFoundException(f'User with id {user_id} does not exists')
+    raise NotEnoughBalanceException(f'User {user_id} does not have enough balance')
+
+
+def sweep_balance_shards(user_id):
+    # moves the shard credits into the main item, so debits can be checked against the whole balance
+    def sweep():
+        shard_balances = balance_shards.get_shard_balances(user_id, consistent_read=True)
+        swept_amount = balance_shards.sum_shard_balances(shard_balances)
+        if swept_amount == 0:
+            return False
+        transact_items = [{'Update': update} for update in balance_shards.build_shard_sweep(user_id, shard_balances)]
+        transact_items.append({'Update': build_user_update(user_id, add_values={'balance': swept_amount, 'version': 1},
+                                                           condition_expression='attribute_exists(id)')})
+        try:
+            dynamodb.transact_write_items(TransactItems=transact_items)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException' or \
+                    retry_u.classify_error(e) == retry_u.THROTTLING:
+                raise e
+            raise ConcurrencyException(f'Balance shards changed while sweeping: {e}')  # a credit landed meanwhile
+        return True
+
     try:
-        dynamodb.put_item(
-            TableName=DYNAMODB_USERS,
-            Item=dynamo_item,
-            ExpressionAttributeValues={
-                ':version': {'N': str(version)}
-            },
-            ConditionExpression='version = :version'
-        )
+        return retry_u.retry_call(sweep, 'sweep_balance_shards', policy=SWEEP_RETRY_POLICY)
+    finally:
+        balance_shards.invalidate_shard_balance(user_id)
+        user_cache.invalidate(user_id)
+
+
+def enable_balance_shards(user_id, shard_count):
+    update = build_user_update(user_id, set_values={'balanceShards': shard_count},
+                               condition_expression='attribute_exists(id)')
+    try:
+        user = update_user(update, call_site='enable_balance_shards')
     except ClientError as e:
-        if e.response["Error"]["Code"] == 'ConditionalCheckFailedException':
-            raise ConcurrencyException("User has been already modified")
-        else:
-            raise e
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            raise NotFoundException(f'User with id {user_id} does not exists')
+        raise e
+    balance_shards.remember_shard_count(user_id, shard_count)
+    return user
+
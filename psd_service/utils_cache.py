@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    # Bounded in-process cache, it survives across warm lambda invocations
+
+    def __init__(self, max_size=1024, ttl_seconds=60.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (value, version, expires_at), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[2] <= self.clock():
+                if entry is not None:
+                    del self.entries[key]  # expired
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get_version(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[2] <= self.clock():
+                return None
+            return entry[1]
+
+    def put(self, key, value, version=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and version is not None and entry[1] is not None and entry[1] > version and \
+                    entry[2] > self.clock():
+                return False  # never replaces a newer version with an older one
+            self.entries[key] = (value, version, self.clock() + self.ttl_seconds)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
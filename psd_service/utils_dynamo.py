@@ -1,14 +1,30 @@
+import base64
+import binascii
 import json
+import math
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 
 import boto3
-from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
 
-from psd_service.exceptions import CannotSaveException, NotFoundException
+from psd_service.exceptions import CannotSaveException, NotFoundException, BadRequestException
 
 IS_OFFLINE = os.getenv('IS_OFFLINE', 'False').lower() in ('true', '1', 't', 'y', 'yes')
 OFFLINE_PORT = 8032
+SCAN_SEGMENTS = int(os.getenv('DYNAMODB_SCAN_SEGMENTS', '4'))
+SCAN_QUEUE_PAGES_PER_SEGMENT = 2
+SEGMENT_DONE = object()
+DYNAMO_MIN_NUMBER = 1e-130  # smaller numbers are rejected by dynamodb
+DYNAMO_MAX_NUMBER = 1e127
+DYNAMO_MAX_DIGITS = 38
+BATCH_WRITE_SIZE = 25  # BatchWriteItem limit
+BATCH_GET_SIZE = 100  # BatchGetItem limit
+BATCH_ATTEMPTS = 5
+BATCH_BACKOFF_SECONDS = 0.05
 
 
 class DecimalEncoder(json.JSONEncoder):
@@ -30,19 +46,71 @@ def get_dynamo_client():
     return client
 
 
+def encode_float_for_dynamo(value):
+    if not math.isfinite(value) or (value != 0 and not DYNAMO_MIN_NUMBER <= abs(value) < DYNAMO_MAX_NUMBER):
+        raise TypeError(f'Dynamodb does not support the number {value}')
+    number = repr(value)  # the same digits json.dumps would write
+    if 'e' in number:
+        number = str(Decimal(number))  # keeps the format the Decimal based serialization had, e.g. 1E-7
+    return number
+
+
+def encode_value_for_dynamo(value):
+    value_type = type(value)
+    if value_type is str:
+        return {'S': value}
+    if value_type is bool:
+        return {'BOOL': value}
+    if value_type is int:
+        number = str(value)
+        if len(number.lstrip('-')) > DYNAMO_MAX_DIGITS:
+            raise TypeError(f'Dynamodb does not support the number {value}')
+        return {'N': number}
+    if value_type is float:
+        return {'N': encode_float_for_dynamo(value)}
+    if value_type is dict:
+        return {'M': {k: encode_value_for_dynamo(v) for k, v in value.items()}}
+    if value_type in (list, tuple):
+        return {'L': [encode_value_for_dynamo(v) for v in value]}
+    if value is None:
+        return {'NULL': True}
+    if isinstance(value, Decimal):
+        return {'N': encode_float_for_dynamo(float(value))}  # decimals were always stored as floats
+    # subclasses, as enums, are encoded as their base type
+    for base_type, encoder in ((bool, bool), (int, int), (float, float), (str, str), (dict, dict), (list, list)):
+        if isinstance(value, base_type):
+            return encode_value_for_dynamo(encoder(value))
+    raise TypeError(f'Object of type {value_type.__name__} cannot be stored on dynamodb')
+
+
+def decode_value_from_dynamo(attribute_value):
+    for type_name, value in attribute_value.items():
+        if type_name == 'S':
+            return value
+        if type_name == 'N':
+            return float(value)  # every number is handled as a float, as the json based decoding did
+        if type_name == 'BOOL':
+            return value
+        if type_name == 'M':
+            return {k: decode_value_from_dynamo(v) for k, v in value.items()}
+        if type_name == 'L':
+            return [decode_value_from_dynamo(v) for v in value]
+        if type_name == 'NULL':
+            return None
+        if type_name == 'SS':
+            return list(value)
+        if type_name == 'NS':
+            return [float(v) for v in value]
+        raise TypeError(f'Dynamodb type {type_name} is not supported')
+    raise TypeError('Empty dynamodb attribute value')
+
+
 def encode_item_for_dynamo(item):
-    parsed_item = json.loads(json.dumps(item, cls=DecimalEncoder),
-                             parse_float=Decimal)  # boto3 does not allow float types :/
-    serializer = TypeSerializer()
-    dynamo_item = {k: serializer.serialize(v) for k, v in parsed_item.items()}
-    return dynamo_item
+    return {k: encode_value_for_dynamo(v) for k, v in item.items()}
 
 
 def decode_item_from_dynamo(dynamo_item):
-    deserializer = TypeDeserializer()
-    parsed_item = {k: deserializer.deserialize(v) for k, v in dynamo_item.items()}
-    item = json.loads(json.dumps(parsed_item, cls=DecimalEncoder))  # boto3 does not allow float types :/
-    return item
+    return {k: decode_value_from_dynamo(v) for k, v in dynamo_item.items()}
 
 
 def assert_valid_dynamo_put_response(response, allowed_responses=(200,), object_name=''):
@@ -57,10 +125,11 @@ def assert_valid_dynamo_put_response(response, allowed_responses=(200,), object_
         raise CannotSaveException(error_msg)
 
 
-def get_items_from_dynamo_response_or_fail(response, object_name=''):
+def get_items_from_dynamo_response_or_fail(response, object_name='', decode=True):
     if ('Count' in response and response['Count'] > 0) and ('Items' in response and len(response['Items']) > 0):
         items = response['Items']
-        items = [decode_item_from_dynamo(item) for item in items]
+        if decode:
+            items = [decode_item_from_dynamo(item) for item in items]
         return items
     if object_name is None or object_name == '':
         error_msg = 'Not found'
@@ -69,13 +138,177 @@ def get_items_from_dynamo_response_or_fail(response, object_name=''):
     raise NotFoundException(error_msg)
 
 
-def get_item_from_dynamo_response_or_fail(response, object_name=''):
+def get_item_from_dynamo_response_or_fail(response, object_name='', decode=True):
     if 'Item' in response:
         item = response['Item']
-        item = decode_item_from_dynamo(item)
+        if decode:
+            item = decode_item_from_dynamo(item)
         return item
     if object_name is None or object_name == '':
         error_msg = 'Not found'
     else:
         error_msg = '{} not found'.format(object_name)
     raise NotFoundException(error_msg)
+
+
+def batch_write_items(client, table_name, items, object_name='', encode=True):
+    for start in range(0, len(items), BATCH_WRITE_SIZE):
+        requests = [{'PutRequest': {'Item': encode_item_for_dynamo(item) if encode else item}}
+                    for item in items[start:start + BATCH_WRITE_SIZE]]
+        request_items = {table_name: requests}
+        for attempt in range(BATCH_ATTEMPTS):
+            response = client.batch_write_item(RequestItems=request_items)
+            request_items = response.get('UnprocessedItems', {})
+            if len(request_items) == 0:
+                break
+            time.sleep(BATCH_BACKOFF_SECONDS * 2 ** attempt)  # unprocessed items usually mean throttling
+        if len(request_items) > 0:
+            if object_name is None or object_name == '':
+                error_msg = 'Could not insert batch on dynamodb'
+            else:
+                error_msg = 'Could not insert {} batch on dynamodb'.format(object_name)
+            raise CannotSaveException(error_msg)
+
+
+def build_projection_expression(fields):
+    # every name goes through a placeholder, so reserved words as `name` can be projected
+    expression_attribute_names = {f'#p{i}': field for i, field in enumerate(fields)}
+    projection_expression = ', '.join(expression_attribute_names.keys())
+    return projection_expression, expression_attribute_names
+
+
+def batch_get_items(client, table_name, keys, projection_expression=None, expression_attribute_names=None,
+                    consistent_read=False, decode=True):
+    items = []
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        keys_and_attributes = {'Keys': keys[start:start + BATCH_GET_SIZE], 'ConsistentRead': consistent_read}
+        if projection_expression is not None:
+            keys_and_attributes['ProjectionExpression'] = projection_expression
+        if expression_attribute_names is not None:
+            keys_and_attributes['ExpressionAttributeNames'] = expression_attribute_names
+        request_items = {table_name: keys_and_attributes}
+        for attempt in range(BATCH_ATTEMPTS):
+            response = client.batch_get_item(RequestItems=request_items)
+            found_items = response.get('Responses', {}).get(table_name, [])
+            items += [decode_item_from_dynamo(item) for item in found_items] if decode else found_items
+            request_items = response.get('UnprocessedKeys', {})
+            if len(request_items) == 0:
+                break
+            time.sleep(BATCH_BACKOFF_SECONDS * 2 ** attempt)  # unprocessed keys usually mean throttling
+        if len(request_items) > 0:
+            raise Exception('Could not read every item from dynamodb')
+    return items
+
+
+def iterate_pages(operation, **kwargs):
+    while True:
+        response = operation(**kwargs)
+        yield response
+        last_evaluated_key = response.get('LastEvaluatedKey')
+        if last_evaluated_key is None:
+            break
+        kwargs['ExclusiveStartKey'] = last_evaluated_key
+
+
+def iterate_scan_pages(client, **scan_kwargs):
+    return iterate_pages(client.scan, **scan_kwargs)
+
+
+def iterate_query_pages(client, **query_kwargs):
+    return iterate_pages(client.query, **query_kwargs)
+
+
+def build_scan_kwargs(table_name, projection_expression=None, filter_expression=None,
+                      expression_attribute_names=None, expression_attribute_values=None, page_size=None):
+    scan_kwargs = {'TableName': table_name}
+    if projection_expression is not None:
+        scan_kwargs['ProjectionExpression'] = projection_expression
+    if filter_expression is not None:
+        scan_kwargs['FilterExpression'] = filter_expression
+    if expression_attribute_names is not None:
+        scan_kwargs['ExpressionAttributeNames'] = expression_attribute_names
+    if expression_attribute_values is not None:
+        scan_kwargs['ExpressionAttributeValues'] = expression_attribute_values
+    if page_size is not None:
+        scan_kwargs['Limit'] = page_size
+    return scan_kwargs
+
+
+def parallel_scan(client, table_name, total_segments=SCAN_SEGMENTS, projection_expression=None,
+                  filter_expression=None, expression_attribute_names=None, expression_attribute_values=None,
+                  page_size=None, decode=True):
+    scan_kwargs = build_scan_kwargs(table_name, projection_expression=projection_expression,
+                                    filter_expression=filter_expression,
+                                    expression_attribute_names=expression_attribute_names,
+                                    expression_attribute_values=expression_attribute_values, page_size=page_size)
+    if total_segments <= 1:
+        for page in iterate_scan_pages(client, **scan_kwargs):
+            for item in page.get('Items', []):
+                yield decode_item_from_dynamo(item) if decode else item
+        return
+
+    pages = queue.Queue(maxsize=total_segments * SCAN_QUEUE_PAGES_PER_SEGMENT)  # bounds the memory in use
+    stop = threading.Event()
+
+    def put_page(page):
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return True
+            except queue.Full:
+                pass  # waiting for the consumer
+        return False
+
+    def scan_segment(segment):
+        try:
+            for page in iterate_scan_pages(client, Segment=segment, TotalSegments=total_segments, **scan_kwargs):
+                if not put_page(page.get('Items', [])):
+                    return
+        except Exception as e:
+            put_page(e)
+        finally:
+            put_page(SEGMENT_DONE)
+
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        for segment in range(total_segments):
+            executor.submit(scan_segment, segment)
+        try:
+            done_segments = 0
+            while done_segments < total_segments:
+                page = pages.get()
+                if page is SEGMENT_DONE:
+                    done_segments += 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    for item in page:
+                        yield decode_item_from_dynamo(item) if decode else item
+        finally:
+            stop.set()  # releases the workers if the consumer gave up early
+
+
+def encode_cursor(last_evaluated_key):
+    if last_evaluated_key is None:
+        return None
+    raw_cursor = json.dumps(last_evaluated_key, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw_cursor).decode()
+
+
+def decode_cursor(cursor, key_names=None):
+    if cursor is None:
+        return None
+    try:
+        last_evaluated_key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, binascii.Error):
+        raise BadRequestException('Provide a valid cursor!')
+    if type(last_evaluated_key) is not dict or \
+            (key_names is not None and (set(last_evaluated_key.keys()) != set(key_names) or
+                                        not all(is_valid_key_value(value) for value in last_evaluated_key.values()))):
+        raise BadRequestException('Provide a valid cursor!')
+    return last_evaluated_key
+
+
+def is_valid_key_value(value):
+    # a key attribute as sent to dynamo, anything else would fail the request instead of the cursor
+    return type(value) is dict and len(value) == 1 and list(value.keys())[0] in ('S', 'N', 'B') and \
+        type(list(value.values())[0]) is str
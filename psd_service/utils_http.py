@@ -1,26 +1,207 @@
+import gzip
+import hashlib
 import json
+import os
+import threading
+import time
+import zlib
+from datetime import datetime as dt, timezone
 from http.client import responses
+from urllib.parse import urlsplit
 
-from flask import Response
+import requests
+from flask import Response, has_request_context, request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from werkzeug.http import parse_date, parse_etags
 
-from psd_service.exceptions import BadRequestException
+import psd_service.utils_retry as retry_u
+from psd_service.exceptions import BadRequestException, PayloadTooLargeException
+
+try:
+    import orjson  # optional, several times faster than json on big bodies
+except ImportError:
+    orjson = None
+
+
+STREAM_CHUNK_SIZE = 16 * 1024
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'json' if orjson is None else 'orjson')
+COMPRESSION_MIN_BYTES = int(os.getenv('COMPRESSION_MIN_BYTES', '1024'))  # smaller bodies are not worth the cpu
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', '6'))
+SUPPORTED_ENCODINGS = ('gzip', 'deflate')  # by preference
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv('HTTP_CONNECT_TIMEOUT_SECONDS', '3.05'))
+HTTP_READ_TIMEOUT_SECONDS = float(os.getenv('HTTP_READ_TIMEOUT_SECONDS', '10'))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))  # connections kept per host
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '2'))
+HTTP_RETRY_BACKOFF_SECONDS = float(os.getenv('HTTP_RETRY_BACKOFF_SECONDS', '0.1'))
+HTTP_RETRY_STATUSES = (429, 502, 503, 504)
+
+# created on the first outbound call, the pooled connections are reused by the next warm invocations
+http_session = None
+http_session_lock = threading.Lock()
+http_stats_lock = threading.Lock()
+host_stats = {}
+
+
+def get_cors_headers():
+    return {
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Credentials": True,
+    }
+
+
+def encode_json(value):
+    if JSON_BACKEND == 'orjson':
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()  # compact, unlike json
+    return json.dumps(value)
+
+
+def negotiate_encoding(accept_encoding):
+    # the preferred supported encoding with the highest q-value of an `Accept-Encoding` header, if any
+    qualities = {}
+    for coding in (accept_encoding or '').split(','):
+        name, _, parameters = coding.partition(';')
+        name = name.strip().lower()
+        quality = 1.0
+        parameter_name, _, parameter_value = parameters.partition('=')
+        if parameter_name.strip().lower() == 'q':
+            try:
+                quality = float(parameter_value)
+            except ValueError:
+                quality = 0.0
+        if name != '':
+            qualities[name] = quality
+    best_encoding, best_quality = None, 0.0
+    for encoding in SUPPORTED_ENCODINGS:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best_encoding, best_quality = encoding, quality
+    return best_encoding
+
+
+def get_request_encoding():
+    if not has_request_context():
+        return None
+    return negotiate_encoding(request.headers.get('Accept-Encoding'))
+
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=COMPRESSION_LEVEL, mtime=0)
+    return zlib.compress(data, COMPRESSION_LEVEL)  # http deflate is the zlib format
+
+
+def decompress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    return zlib.decompress(data)
+
+
+def build_compressor(encoding):
+    return zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+
+
+def compress_chunks(chunks, encoding):
+    compressor = build_compressor(encoding)
+    for chunk in chunks:
+        compressed_chunk = compressor.compress(chunk.encode() if type(chunk) is str else chunk)
+        if len(compressed_chunk) > 0:
+            yield compressed_chunk
+    yield compressor.flush()
+
+
+def compress_response(response, encoding):
+    # compresses a buffered response in place, when the client accepts it and the body is big enough
+    if response.content_encoding is not None:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')  # caches keep one copy per encoding
+    if encoding is None:
+        return response
+    response.set_data(compress(data, encoding))
+    response.content_encoding = encoding
+    return response
+
+
+def get_uncompressed_text(response):
+    data = response.get_data()
+    if response.content_encoding in SUPPORTED_ENCODINGS:
+        data = decompress(data, response.content_encoding)
+    return data.decode()
 
 
 def generate_response(code, body):
     if type(body) is dict:
-        response = json.dumps(body)
+        response = encode_json(body)
         mimetype = 'application/json'
     elif type(body) is str:
         response = body
         mimetype = 'text/html'
     else:
         raise ValueError('Invalid http response type')
-    headers = {
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Credentials": True,
-    }
+    headers = get_cors_headers()
     response = Response(response=response, status=code, mimetype=mimetype, headers=headers)
-    return response
+    return compress_response(response, get_request_encoding())
+
+
+def stream_json_object(list_key, items, json_body=None):
+    buffer = '{' + json.dumps(list_key) + ': ['
+    for i, item in enumerate(items):
+        if i > 0:
+            buffer += ', '
+        buffer += encode_json(item)
+        if len(buffer) >= STREAM_CHUNK_SIZE:
+            yield buffer
+            buffer = ''
+    buffer += ']'
+    if json_body is not None:
+        for key, value in json_body.items():
+            buffer += f', {json.dumps(key)}: {encode_json(value)}'
+    yield buffer + '}'
+
+
+def stream_ndjson(items):
+    buffer = ''
+    for item in items:
+        buffer += encode_json(item) + '\n'
+        if len(buffer) >= STREAM_CHUNK_SIZE:
+            yield buffer
+            buffer = ''
+    if buffer != '':
+        yield buffer
+
+
+def generate_streamed_response(code, chunks, mimetype):
+    headers = get_cors_headers()
+    encoding = get_request_encoding()
+    if encoding is not None:  # the size is unknown upfront, so streams are compressed whenever accepted
+        chunks = compress_chunks(chunks, encoding)
+        headers['Content-Encoding'] = encoding
+    headers['Vary'] = 'Accept-Encoding'
+    return Response(response=chunks, status=code, mimetype=mimetype, headers=headers)
+
+
+def generate_streamed_json_response(code, list_key, items, json_body=None):
+    # the body is sent chunked while `items` is consumed, so it never has to fit in memory
+    return generate_streamed_response(code, stream_json_object(list_key, items, json_body=json_body),
+                                      'application/json')
+
+
+def generate_streamed_ndjson_response(code, items):
+    # one json value per line, so clients can process the lines as they arrive
+    return generate_streamed_response(code, stream_ndjson(items), 'application/x-ndjson')
+
+
+def read_request_body(max_bytes):
+    if request.content_length is not None and request.content_length > max_bytes:
+        raise PayloadTooLargeException(f'Provide a body up to {max_bytes} bytes!')
+    data = request.stream.read(max_bytes + 1)  # chunked bodies have no length upfront
+    if len(data) > max_bytes:
+        raise PayloadTooLargeException(f'Provide a body up to {max_bytes} bytes!')
+    return data
 
 
 def generate_error_body(status=None, error_msg=None, details=None):
@@ -46,6 +227,42 @@ def generate_error_response(code, details=None, error_msg=None):
     return response
 
 
+def is_not_modified(headers, etag=None, last_modified=None):
+    # RFC 7232 conditional GET, `If-None-Match` wins over `If-Modified-Since` when both are sent
+    if 'If-None-Match' in headers:
+        return etag is not None and parse_etags(headers['If-None-Match']).contains_weak(etag)
+    if_modified_since = parse_date(headers.get('If-Modified-Since'))
+    if if_modified_since is None or last_modified is None:
+        return False
+    last_modified = dt.fromisoformat(last_modified).replace(microsecond=0, tzinfo=timezone.utc)  # dates have seconds
+    return last_modified <= if_modified_since
+
+
+def compute_etag(body):
+    # for bodies read from eventually consistent indices, no stored version tells they changed, the body itself does
+    return hashlib.sha256(json.dumps(body, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def add_validators(response, etag=None, last_modified=None):
+    # weak, since the same representation may be sent compressed or not
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = dt.fromisoformat(last_modified).replace(tzinfo=timezone.utc)
+    return response
+
+
+def generate_not_modified_response(etag=None, last_modified=None):
+    response = Response(status=304, headers=get_cors_headers())
+    return add_validators(response, etag=etag, last_modified=last_modified)
+
+
+def prefers_async_response(headers):
+    # RFC 7240 `Prefer: respond-async`
+    preferences = [preference.split(';')[0].strip().lower() for preference in headers.get('Prefer', '').split(',')]
+    return 'respond-async' in preferences
+
+
 def generate_ok_response(json_body=None, msg=None):
     if json_body is None and msg is None:
         raise AttributeError('Provide either json_body or msg')
@@ -76,6 +293,48 @@ def validate_request(request_data, required_fields):
                     f'Expected one of the following keys: `{req_field}` but request data had `{list(request_data.keys())}`')
 
 
+def get_int_query_param(query_params, name, default=None, min_value=None, max_value=None):
+    if name not in query_params:
+        return default
+    try:
+        value = int(query_params[name])
+    except (TypeError, ValueError):
+        raise BadRequestException(f'Provide an integer `{name}`!')
+    if min_value is not None and value < min_value:
+        raise BadRequestException(f'Provide a `{name}` greater or equal than {min_value}!')
+    if max_value is not None and value > max_value:
+        raise BadRequestException(f'Provide a `{name}` lower or equal than {max_value}!')
+    return value
+
+
+def get_datetime_query_param(query_params, name, default=None):
+    if name not in query_params:
+        return default
+    try:
+        value = dt.fromisoformat(str(query_params[name]).replace('Z', '+00:00'))
+    except ValueError:
+        raise BadRequestException(f'Provide `{name}` as an ISO-8601 date!')
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)  # dates are stored as naive UTC
+    return value.isoformat()
+
+
+def get_fields_query_param(query_params, allowed_fields, name='fields'):
+    if name not in query_params:
+        return None
+    fields = tuple(dict.fromkeys(field.strip() for field in str(query_params[name]).split(',') if field.strip()))
+    unknown_fields = [field for field in fields if field not in allowed_fields]
+    if len(fields) == 0 or len(unknown_fields) > 0:
+        raise BadRequestException(f'Provide `{name}` as a comma separated list of: {", ".join(allowed_fields)}!')
+    return fields
+
+
+def get_bool_query_param(query_params, name, default=False):
+    if name not in query_params:
+        return default
+    return str(query_params[name]).lower() in ('true', '1', 't', 'y', 'yes')
+
+
 def get_common_headers_with_authorization(bearer_token=None, basic_auth=None):
     if bearer_token is not None:
         headers = {'Authorization': f'Bearer {bearer_token}'}
@@ -108,3 +367,76 @@ def parse_http_response_to_json(response, allowed_responses=(200,), server_name=
             error_msg = f', {error_msg}'
         error_str = f'{server_name} returned: {response.status_code} ({responses[response.status_code]}){error_msg}'
         raise Exception(error_str)
+
+
+def build_http_session():
+    # only idempotent methods are retried, with exponential backoff, and Retry-After is honored
+    retry = Retry(total=HTTP_MAX_RETRIES, backoff_factor=HTTP_RETRY_BACKOFF_SECONDS,
+                  status_forcelist=HTTP_RETRY_STATUSES, allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_http_session():
+    global http_session
+    if http_session is None:
+        with http_session_lock:
+            if http_session is None:
+                http_session = build_http_session()
+    return http_session
+
+
+def get_http_timeout(timeout=None):
+    # (connect, read) seconds, never past the lambda deadline
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS)
+    elif type(timeout) not in (list, tuple):
+        timeout = (timeout, timeout)
+    remaining_seconds = retry_u.get_remaining_seconds()
+    if remaining_seconds is not None:
+        remaining_seconds = max(remaining_seconds - retry_u.DEADLINE_MARGIN_SECONDS, 0.001)
+        timeout = tuple(min(seconds, remaining_seconds) for seconds in timeout)
+    return tuple(timeout)
+
+
+def count_http_request(host, elapsed_seconds, failed):
+    with http_stats_lock:
+        stats = host_stats.setdefault(host, {'requests': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stats['requests'] += 1
+        stats['errors'] += int(failed)
+        stats['total_ms'] += elapsed_seconds * 1000
+        stats['max_ms'] = max(stats['max_ms'], elapsed_seconds * 1000)
+
+
+def get_http_stats():
+    with http_stats_lock:
+        return {host: {**stats, 'avg_ms': stats['total_ms'] / stats['requests']} for host, stats in host_stats.items()}
+
+
+def reset_http_stats():
+    with http_stats_lock:
+        host_stats.clear()
+
+
+def http_request(method, url, timeout=None, bearer_token=None, basic_auth=None, headers=None, **kwargs):
+    # outbound call through the shared pool, latencies include the retries
+    request_headers = get_common_headers_with_authorization(bearer_token=bearer_token, basic_auth=basic_auth)
+    if headers is not None:
+        request_headers.update(headers)
+    failed = True
+    started_at = time.monotonic()
+    try:
+        response = get_http_session().request(method, url, headers=request_headers, timeout=get_http_timeout(timeout),
+                                              **kwargs)
+        failed = response.status_code >= 500
+        return response
+    finally:
+        count_http_request(urlsplit(url).netloc, time.monotonic() - started_at, failed)
+
+
+def http_get(url, **kwargs):
+    return http_request('GET', url, **kwargs)
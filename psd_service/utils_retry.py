@@ -0,0 +1,115 @@
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from psd_service.exceptions import ConcurrencyException
+
+CONCURRENCY = 'concurrency'
+CONDITIONAL_CHECK = 'conditional_check'
+THROTTLING = 'throttling'
+
+THROTTLING_ERROR_CODES = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'Throttling',
+                          'RequestLimitExceeded', 'TooManyRequestsException', 'ThrottlingError')
+CONFLICT_CANCELLATION_CODES = ('TransactionConflict',)
+
+DEADLINE_MARGIN_SECONDS = float(os.getenv('RETRY_DEADLINE_MARGIN_SECONDS', '0.5'))
+
+request_state = threading.local()
+stats_lock = threading.Lock()
+call_site_stats = {}
+
+
+class RetryPolicy(object):
+    def __init__(self, max_attempts=5, base_delay_seconds=0.01, max_delay_seconds=0.5,
+                 retry_on=(CONCURRENCY, CONDITIONAL_CHECK, THROTTLING)):
+        self.max_attempts = max_attempts
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.retry_on = retry_on
+
+    def compute_delay(self, attempt):
+        # exponential backoff with full jitter, spreads the retries of contending callers
+        return random.uniform(0, min(self.max_delay_seconds, self.base_delay_seconds * 2 ** attempt))
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+
+def classify_error(error):
+    if isinstance(error, ConcurrencyException):
+        return CONCURRENCY
+    if isinstance(error, ClientError):
+        error_code = error.response.get('Error', {}).get('Code')
+        if error_code == 'ConditionalCheckFailedException':
+            return CONDITIONAL_CHECK
+        if error_code in THROTTLING_ERROR_CODES:
+            return THROTTLING
+        if error_code == 'TransactionCanceledException':
+            reason_codes = [reason.get('Code') for reason in error.response.get('CancellationReasons', [])]
+            if any(code in THROTTLING_ERROR_CODES for code in reason_codes):
+                return THROTTLING
+            if any(code in CONFLICT_CANCELLATION_CODES for code in reason_codes):
+                return CONCURRENCY
+    return None
+
+
+def set_deadline_from_lambda_context(context):
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        request_state.deadline = None
+    else:
+        request_state.deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000
+
+
+def clear_deadline():
+    request_state.deadline = None
+
+
+def get_remaining_seconds():
+    deadline = getattr(request_state, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def count(call_site, key):
+    with stats_lock:
+        stats = call_site_stats.setdefault(call_site, {})
+        stats[key] = stats.get(key, 0) + 1
+
+
+def get_retry_stats():
+    with stats_lock:
+        return {call_site: dict(stats) for call_site, stats in call_site_stats.items()}
+
+
+def reset_retry_stats():
+    with stats_lock:
+        call_site_stats.clear()
+
+
+def retry_call(function, call_site, policy=DEFAULT_POLICY):
+    attempt = 0
+    while True:
+        count(call_site, 'attempts')
+        try:
+            result = function()
+            count(call_site, 'successes')
+            return result
+        except Exception as e:
+            error_class = classify_error(e)
+            if error_class is None or error_class not in policy.retry_on:
+                count(call_site, 'failures')
+                raise e
+            count(call_site, error_class)
+            attempt += 1
+            delay = policy.compute_delay(attempt)
+            remaining_seconds = get_remaining_seconds()
+            if attempt >= policy.max_attempts or \
+                    (remaining_seconds is not None and remaining_seconds - delay < DEADLINE_MARGIN_SECONDS):
+                count(call_site, 'give_ups')  # leaves time for the lambda to answer
+                raise e
+            count(call_site, 'retries')
+            time.sleep(delay)
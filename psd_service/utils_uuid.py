@@ -1,10 +1,26 @@
 import hashlib
+import os
+import threading
+import time
 import uuid
+from datetime import datetime as dt, timezone
+
+TIME_ORDERED_UUID_VERSION = 7
+# the 12 bits after the timestamp count the ids of the same millisecond, starting from a random value below half, so
+# ids keep their order even when many are generated within a millisecond
+MAX_TIME_ORDERED_UUID_COUNTER = 0xfff
+MAX_INITIAL_TIME_ORDERED_UUID_COUNTER = 0x7ff
+
+time_ordered_uuid_lock = threading.Lock()
+last_time_ordered_uuid_timestamp_ms = 0
+last_time_ordered_uuid_counter = 0
 
 
 def check_if_valid_uuid(query_uuid):
     if type(query_uuid) is not str:
         return False
+    if check_if_valid_time_ordered_uuid(query_uuid):
+        return True
     supported_versions = (4, 5, 3, 1)
     for version in supported_versions:
         try:
@@ -25,3 +41,48 @@ def generate_uuid_from_str(string):
     hash_digit = hashlib.sha1((salt + string).encode()).digest()
     uuid_obj = uuid.UUID(bytes=hash_digit[:16], version=5)
     return str(uuid_obj)
+
+
+def next_time_ordered_uuid_fields(timestamp_ms):
+    # same millisecond, or a clock going back, counts on from the last id instead
+    global last_time_ordered_uuid_timestamp_ms, last_time_ordered_uuid_counter
+    with time_ordered_uuid_lock:
+        if timestamp_ms > last_time_ordered_uuid_timestamp_ms:
+            last_time_ordered_uuid_timestamp_ms = timestamp_ms
+            last_time_ordered_uuid_counter = int.from_bytes(os.urandom(2), 'big') & MAX_INITIAL_TIME_ORDERED_UUID_COUNTER
+        elif last_time_ordered_uuid_counter < MAX_TIME_ORDERED_UUID_COUNTER:
+            last_time_ordered_uuid_counter += 1
+        else:
+            last_time_ordered_uuid_timestamp_ms += 1  # borrows the next millisecond
+            last_time_ordered_uuid_counter = 0
+        return last_time_ordered_uuid_timestamp_ms, last_time_ordered_uuid_counter
+
+
+def build_time_ordered_uuid(timestamp_ms, counter, random_bits):
+    # uuid version 7: 48 bits of unix milliseconds, version, 12 bits of counter, variant and 62 random bits
+    value = (timestamp_ms << 80) | (TIME_ORDERED_UUID_VERSION << 76) | (counter << 64) | (0b10 << 62) | random_bits
+    return str(uuid.UUID(int=value))
+
+
+def generate_time_ordered_uuid():
+    timestamp_ms, counter = next_time_ordered_uuid_fields(time.time_ns() // 1_000_000)
+    random_bits = int.from_bytes(os.urandom(8), 'big') & ((1 << 62) - 1)
+    return build_time_ordered_uuid(timestamp_ms, counter, random_bits)
+
+
+def check_if_valid_time_ordered_uuid(query_uuid):
+    if type(query_uuid) is not str:
+        return False
+    try:
+        uuid_obj = uuid.UUID(query_uuid)
+    except ValueError:
+        return False
+    return str(uuid_obj) == query_uuid and uuid_obj.version == TIME_ORDERED_UUID_VERSION and \
+        uuid_obj.variant == uuid.RFC_4122
+
+
+def get_time_ordered_uuid_datetime(time_ordered_uuid):
+    # naive UTC, like the dates stored
+    timestamp_ms = uuid.UUID(time_ordered_uuid).int >> 80
+    return dt.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc).replace(tzinfo=None)
+
@@ -0,0 +1,64 @@
+import json
+import timeit
+from decimal import Decimal
+
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+
+from psd_service import utils_dynamo as dynamo_u
+
+ROUNDS = 5
+ITEMS_PER_PAGE = 1000  # about the size of a 1 MB scan page of transfers
+
+
+# The json round-trip based functions the codec replaced, kept here as the baseline
+def legacy_encode_item_for_dynamo(item):
+    parsed_item = json.loads(json.dumps(item, cls=dynamo_u.DecimalEncoder), parse_float=Decimal)
+    serializer = TypeSerializer()
+    return {k: serializer.serialize(v) for k, v in parsed_item.items()}
+
+
+def legacy_decode_item_from_dynamo(dynamo_item):
+    deserializer = TypeDeserializer()
+    parsed_item = {k: deserializer.deserialize(v) for k, v in dynamo_item.items()}
+    return json.loads(json.dumps(parsed_item, cls=dynamo_u.DecimalEncoder))
+
+
+def generate_page():
+    return [{
+        'id': f'4af4de19-255d-447a-bccd-{i:012d}',
+        'srcUserId': '480a34b2-537b-11ec-bf63-0242ac130002',
+        'dstUserId': 'b0a99b29-a664-5401-baaa-554c04ef667b',
+        'amount': i * 1.25,
+        'version': i,
+        'verifiedAccount': i % 2 == 0,
+        'occurredAtUTC': '2022-02-10T10:00:00.000000',
+        'tags': ['payout', {'batch': i // 100, 'ratio': 0.1}]
+    } for i in range(ITEMS_PER_PAGE)]
+
+
+def bench(name, function, page):
+    seconds = min(timeit.repeat(lambda: [function(item) for item in page], number=1, repeat=ROUNDS))
+    print(f'{name:<10} {seconds * 1000:8.2f} ms/page')
+    return seconds
+
+
+def main():
+    page = generate_page()
+    dynamo_page = [dynamo_u.encode_item_for_dynamo(item) for item in page]
+    assert dynamo_page == [legacy_encode_item_for_dynamo(item) for item in page]
+    assert [dynamo_u.decode_item_from_dynamo(item) for item in dynamo_page] == \
+           [legacy_decode_item_from_dynamo(item) for item in dynamo_page]
+
+    print(f'Encoding {ITEMS_PER_PAGE} items')
+    legacy = bench('legacy', legacy_encode_item_for_dynamo, page)
+    codec = bench('codec', dynamo_u.encode_item_for_dynamo, page)
+    print(f'speedup    {legacy / codec:8.2f}x')
+
+    print(f'Decoding {ITEMS_PER_PAGE} items')
+    legacy = bench('legacy', legacy_decode_item_from_dynamo, dynamo_page)
+    codec = bench('codec', dynamo_u.decode_item_from_dynamo, dynamo_page)
+    print(f'speedup    {legacy / codec:8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
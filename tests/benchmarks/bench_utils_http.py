@@ -0,0 +1,39 @@
+import json
+import timeit
+
+from flask import Flask
+
+from psd_service import utils_http as http_u
+
+ROUNDS = 5
+USER_IDS = 10000  # a big /user_ids page
+
+
+def generate_body():
+    return {'user_ids': [f'4af4de19-255d-447a-bccd-{i:012d}' for i in range(USER_IDS)], 'cursor': None}
+
+
+def bench(name, function):
+    seconds = min(timeit.repeat(function, number=1, repeat=ROUNDS))
+    print(f'{name:<14} {seconds * 1000:8.2f} ms')
+    return seconds
+
+
+def main():
+    app = Flask(__name__)
+    body = generate_body()
+    print(f'Serializing {USER_IDS} ids')
+    bench('json', lambda: json.dumps(body))
+    if http_u.orjson is not None:
+        bench('orjson', lambda: http_u.orjson.dumps(body))
+
+    print(f'Responding {USER_IDS} ids')
+    for encoding in (None, 'gzip', 'deflate'):
+        headers = {} if encoding is None else {'Accept-Encoding': encoding}
+        with app.test_request_context(headers=headers):
+            bench(f'{encoding or "identity"}', lambda: http_u.generate_response(200, body))
+            print(f'{"":<14} {len(http_u.generate_response(200, body).get_data()):8d} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+import timeit
+
+from psd_service import utils_uuid as uuid_u
+
+ROUNDS = 5
+IDS_PER_ROUND = 100000
+
+
+def bench(name, function):
+    seconds = min(timeit.repeat(function, number=IDS_PER_ROUND, repeat=ROUNDS))
+    print(f'{name:<13} {IDS_PER_ROUND / seconds / 1000:8.1f} k ids/s')
+    return seconds
+
+
+def main():
+    uuids = [uuid_u.generate_time_ordered_uuid() for _ in range(IDS_PER_ROUND)]
+    assert uuids == sorted(uuids) and len(set(uuids)) == IDS_PER_ROUND
+
+    print(f'Generating {IDS_PER_ROUND} ids')
+    random = bench('random', uuid_u.generate_uuid)
+    time_ordered = bench('time ordered', uuid_u.generate_time_ordered_uuid)
+    print(f'cost          {time_ordered / random:8.2f}x')
+
+    print(f'Validating {IDS_PER_ROUND} ids')
+    bench('any version', lambda: uuid_u.check_if_valid_uuid(uuids[0]))
+    bench('time ordered', lambda: uuid_u.check_if_valid_time_ordered_uuid(uuids[0]))
+
+
+if __name__ == '__main__':
+    main()
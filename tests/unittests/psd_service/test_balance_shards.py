@@ -0,0 +1,56 @@
+import unittest
+from unittest import mock
+
+with mock.patch('boto3.client'):  # no client is needed, every test mocks the dynamodb calls
+    from psd_service import balance_shards
+
+
+class BalanceShardsTest(unittest.TestCase):
+
+    def setUp(self, *args, **kwargs):
+        balance_shards.shard_balance_cache.clear()
+        balance_shards.shard_count_cache.clear()
+
+    def tearDown(self, *args, **kwargs):
+        balance_shards.shard_balance_cache.clear()
+        balance_shards.shard_count_cache.clear()
+
+    @mock.patch('random.randrange', return_value=2)
+    def test_build_shard_credit(self, randrange, *args, **kwargs):
+        credit = balance_shards.build_shard_credit('user', 4, 10)
+        randrange.assert_called_once_with(4)
+        self.assertEqual({'userId': {'S': 'user'}, 'shard': {'N': '2'}}, credit['Key'])
+        self.assertEqual('ADD balance :amount', credit['UpdateExpression'])
+        self.assertEqual({':amount': {'N': '10.0'}}, credit['ExpressionAttributeValues'])
+        self.assertNotIn('ConditionExpression', credit)  # credits never conflict on a condition
+
+    def test_build_shard_sweep(self, *args, **kwargs):
+        sweep = balance_shards.build_shard_sweep('user', {'0': '10.5', '1': '0', '3': '0.1'})
+        self.assertEqual(2, len(sweep))  # empty shards are left alone
+        self.assertEqual({'userId': {'S': 'user'}, 'shard': {'N': '0'}}, sweep[0]['Key'])
+        self.assertEqual('balance = :balance', sweep[0]['ConditionExpression'])
+        self.assertEqual({':swept': {'N': '-10.5'}, ':balance': {'N': '10.5'}}, sweep[0]['ExpressionAttributeValues'])
+        self.assertEqual({':swept': {'N': '-0.1'}, ':balance': {'N': '0.1'}}, sweep[1]['ExpressionAttributeValues'])
+
+    def test_get_shard_balance_sum(self, *args, **kwargs):
+        client = mock.Mock()
+        client.query.side_effect = [
+            {'Items': [{'shard': {'N': '0'}, 'balance': {'N': '0.1'}}], 'LastEvaluatedKey': {'page': 1}},
+            {'Items': [{'shard': {'N': '1'}, 'balance': {'N': '0.2'}}]},
+        ] * 2
+        with mock.patch.object(balance_shards, 'dynamodb', client):
+            self.assertEqual(0.3, balance_shards.get_shard_balance_sum('user'))  # summed as decimals
+            self.assertEqual(0.3, balance_shards.get_shard_balance_sum('user'))
+            self.assertEqual(2, client.query.call_count)  # the second sum came from the cache
+            self.assertEqual(0.3, balance_shards.get_shard_balance_sum('user', consistent_read=True))
+            self.assertEqual(4, client.query.call_count)
+            self.assertTrue(client.query.call_args.kwargs['ConsistentRead'])
+
+    def test_shard_counts(self, *args, **kwargs):
+        self.assertIsNone(balance_shards.get_known_shard_count('user'))
+        balance_shards.remember_shard_count('user', 8)
+        self.assertEqual(8, balance_shards.get_known_shard_count('user'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import json
+import sys
+import unittest
+from unittest import mock
+
+from psd_service import xray
+from psd_service.records import User
+
+sys.modules.setdefault('xray', xray)  # the lambda runs from the package folder, so the app imports it unprefixed
+
+with mock.patch('boto3.client'), mock.patch.object(xray, 'configure_xray'):  # every test replaces the clients
+    from psd_service import endpoint_hall
+    from psd_service import transactions
+    from psd_service import users
+    from psd_service import utils_dynamo as dynamo_u
+
+USER_ID = '00000000-0000-4000-8000-00000000000a'
+
+
+class EndpointHallTest(unittest.TestCase):
+
+    def setUp(self, *args, **kwargs):
+        users.user_cache.clear()
+        self.app = endpoint_hall.app.test_client()
+
+    def tearDown(self, *args, **kwargs):
+        users.user_cache.clear()
+
+    def test_get_user_hides_balance_shards(self, *args, **kwargs):
+        client, shards_client = mock.Mock(), mock.Mock()
+        client.get_item.return_value = {'Item': User(id=USER_ID, balance=10.0, version=2, balanceShards=4).to_dynamo()}
+        shards_client.query.return_value = {'Items': [{'userId': {'S': USER_ID}, 'shard': {'N': '1'},
+                                                       'balance': {'N': '5'}}]}
+        with mock.patch.object(users, 'dynamodb', client), \
+                mock.patch.object(users.balance_shards, 'dynamodb', shards_client):
+            response = self.app.get(f'/users/{USER_ID}')
+            hidden_response = self.app.get(f'/users/{USER_ID}', query_string={'fields': 'balanceShards'})
+        self.assertEqual(400, hidden_response.status_code)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'id': USER_ID, 'balance': 15.0, 'version': 2}, response.get_json())
+
+    def test_get_user_reads_once(self, *args, **kwargs):
+        client = mock.Mock()
+        client.get_item.return_value = {'Item': User(id=USER_ID, username='alice', balance=10.0, version=2).to_dynamo()}
+        with mock.patch.object(users, 'dynamodb', client):
+            response = self.app.get(f'/users/{USER_ID}', query_string={'fields': 'username'})
+            self.assertEqual(1, client.get_item.call_count)  # the etag comes from the same record
+            full_response = self.app.get(f'/users/{USER_ID}')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'username': 'alice'}, response.get_json())
+        self.assertEqual('W/"2"', response.headers['ETag'])
+        self.assertEqual('W/"2"', full_response.headers['ETag'])
+        self.assertEqual(2, client.get_item.call_count)  # a single read for each cold request
+
+    def test_get_user_not_modified(self, *args, **kwargs):
+        client = mock.Mock()
+        client.get_item.return_value = {'Item': {'id': {'S': USER_ID}, 'version': {'N': '2'}, 'balance': {'N': '10'}}}
+        with mock.patch.object(users, 'dynamodb', client):
+            response = self.app.get(f'/users/{USER_ID}', headers={'If-None-Match': 'W/"2"'})
+        self.assertEqual(304, response.status_code)
+        client.get_item.assert_called_once()  # only the version and balance projection
+        self.assertNotIn('username', client.get_item.call_args.kwargs['ExpressionAttributeNames'].values())
+
+    def test_get_user_ids_is_paged_by_default(self, *args, **kwargs):
+        client = mock.Mock()
+        client.scan.return_value = {'Items': [{'id': {'S': 'a'}}], 'LastEvaluatedKey': {'id': {'S': 'a'}}}
+        with mock.patch.object(users, 'dynamodb', client):
+            response = self.app.get('/user_ids')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'user_ids': ['a'], 'cursor': dynamo_u.encode_cursor({'id': {'S': 'a'}})},
+                         response.get_json())
+        self.assertEqual(endpoint_hall.MAX_PAGE_SIZE, client.scan.call_args.kwargs['Limit'])
+        client.scan.assert_called_once()  # a single page, however large the table
+
+    def test_get_user_ids_tampered_cursor(self, *args, **kwargs):
+        client = mock.Mock()
+        with mock.patch.object(users, 'dynamodb', client):
+            response = self.app.get('/user_ids', query_string={'cursor': dynamo_u.encode_cursor({'id': 'abc'})})
+        self.assertEqual(400, response.status_code)
+        client.scan.assert_not_called()
+
+
+    def test_get_user_transfers_since_after_until(self, *args, **kwargs):
+        client = mock.Mock()
+        with mock.patch.object(transactions, 'dynamodb', client):
+            response = self.app.get(f'/users/{USER_ID}/transfers',
+                                    query_string={'since': '2020-01-02T00:00:00Z', 'until': '2020-01-01T00:00:00Z'})
+        self.assertEqual(400, response.status_code)
+        client.query.assert_not_called()
+
+    def test_to_lower_bulk_json_array(self, *args, **kwargs):
+        response = self.app.post('/lower_case', json=['ABC', 'Straße'])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'strings': ['abc', 'straße']}, response.get_json())
+
+    def test_to_lower_bulk_casefold(self, *args, **kwargs):
+        response = self.app.post('/lower_case', json=['Straße'], query_string={'casefold': 'true'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'strings': ['strasse']}, response.get_json())
+
+    def test_to_upper_bulk_ndjson(self, *args, **kwargs):
+        data = b'"abc"\n\n{"not": "a string"}\n"def"\n'
+        response = self.app.post('/upper_case', data=data, content_type='application/x-ndjson')
+        self.assertEqual(200, response.status_code)
+        lines = [json.loads(line) for line in response.get_data().splitlines()]
+        # the blank line is skipped but still counted, so the error points at the invalid line
+        self.assertEqual(['ABC', {'line': 3, 'error': 'Provide a JSON string!'}, 'DEF'], lines)
+
+    def test_to_upper_bulk_not_an_array(self, *args, **kwargs):
+        for body in ({'string': 'abc'}, ['abc', 1]):
+            response = self.app.post('/upper_case', json=body)
+            self.assertEqual(400, response.status_code)
+
+    def test_to_lower_bulk_body_too_large(self, *args, **kwargs):
+        with mock.patch.object(endpoint_hall, 'MAX_TRANSFORM_BODY_BYTES', 8):
+            response = self.app.post('/lower_case', json=['abcdefgh'])
+        self.assertEqual(413, response.status_code)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from psd_service import health
+
+
+def build_sleeping_check(seconds, released=None):
+    def check(timeout):
+        if released is not None:
+            released.wait(seconds)
+        else:
+            time.sleep(seconds)
+        return {'slept': seconds}
+    return check
+
+
+def failing_check(timeout):
+    raise ConnectionError('refused')
+
+
+class HealthTest(unittest.TestCase):
+
+    def setUp(self, *args, **kwargs):
+        health.health_cache.clear()
+
+    def tearDown(self, *args, **kwargs):
+        health.health_cache.clear()
+
+    def test_run_probes_concurrently(self, *args, **kwargs):
+        probes = [health.Probe(f'probe-{i}', build_sleeping_check(0.2)) for i in range(4)]
+        started_at = time.monotonic()
+        results = health.run_probes(probes)
+        self.assertLess(time.monotonic() - started_at, 0.6)  # not one after the other
+        self.assertEqual({health.UP}, {result['status'] for result in results.values()})
+        self.assertEqual({'slept': 0.2}, results['probe-0']['details'])
+
+    def test_run_probes_timeout(self, *args, **kwargs):
+        released = threading.Event()
+        probes = [
+            health.Probe('slow', build_sleeping_check(5, released=released), timeout_seconds=0.1),
+            health.Probe('failing', failing_check, timeout_seconds=0.1),
+        ]
+        try:
+            results = health.run_probes(probes)
+        finally:
+            released.set()
+        self.assertEqual(health.DOWN, results['slow']['status'])
+        self.assertIn('Timed out', results['slow']['error'])
+        self.assertEqual(health.DOWN, results['failing']['status'])
+        self.assertEqual('ConnectionError: refused', results['failing']['error'])
+
+    def test_get_health_is_cached(self, *args, **kwargs):
+        check = mock.Mock(return_value=None)
+        probes = [health.Probe('dependency', check)]
+        report = health.get_health(probes=probes)
+        self.assertEqual(health.UP, report['status'])
+        self.assertIs(report, health.get_health(probes=probes))
+        self.assertEqual(1, check.call_count)
+        health.get_health(probes=probes, refresh=True)
+        self.assertEqual(2, check.call_count)
+
+    def test_get_health_degraded(self, *args, **kwargs):
+        probes = [health.Probe('dependency', build_sleeping_check(0)), health.Probe('failing', failing_check)]
+        report = health.get_health(probes=probes)
+        self.assertEqual(health.DEGRADED, report['status'])
+        self.assertEqual(health.UP, report['probes']['dependency']['status'])
+
+    def test_get_default_probes(self, *args, **kwargs):
+        with mock.patch.object(health, 'PROD_URL', None):
+            self.assertEqual(['aws'], [probe.name for probe in health.get_default_probes()])
+        with mock.patch.object(health, 'PROD_URL', 'https://example.com'):
+            self.assertEqual(['aws', 'lower_case', 'upper_case'],
+                             [probe.name for probe in health.get_default_probes()])
+
+
+if __name__ == '__main__':
+    unittest.main()
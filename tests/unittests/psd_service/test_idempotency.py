@@ -0,0 +1,124 @@
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+from flask import Flask, request
+
+from psd_service import utils_http as http_u
+from psd_service.exceptions import ConcurrencyException
+
+with mock.patch('boto3.client'):  # every test replaces the dynamodb client
+    from psd_service import idempotency
+
+
+class MockedIdempotencyTable(object):
+    # keeps the items in memory, holding only the key conditions the module relies on
+    def __init__(self):
+        self.items = {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, **kwargs):
+        key = Item['idempotencyKey']['S']
+        old_item = self.items.get(key)
+        if ConditionExpression is not None and old_item is not None:
+            now = int(kwargs['ExpressionAttributeValues'][':now']['N'])
+            lock_expired = old_item['state']['S'] == 'in_progress' and int(old_item['lockedUntil']['N']) < now
+            if int(old_item['expiresAt']['N']) >= now and not lock_expired:
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}, 'Item': old_item}, 'put')
+        self.items[key] = Item
+
+    def delete_item(self, TableName, Key, **kwargs):
+        self.items.pop(Key['idempotencyKey']['S'], None)
+
+
+class IdempotencyTest(unittest.TestCase):
+
+    def setUp(self, *args, **kwargs):
+        self.table = MockedIdempotencyTable()
+        self.dynamodb_patch = mock.patch.object(idempotency, 'dynamodb', self.table)
+        self.dynamodb_patch.start()
+        idempotency.response_cache.clear()
+        self.calls = 0
+        app = Flask(__name__)
+
+        @app.route('/run', methods=('POST',))
+        @idempotency.idempotent('run')
+        def run():
+            self.calls += 1
+            code = request.json.get('code', 200)
+            response = http_u.generate_response(code, {'call': self.calls})
+            if code == 202:
+                response.headers['Location'] = f'/runs/{self.calls}'
+                response.headers['Preference-Applied'] = 'respond-async'
+            return response
+
+        self.client = app.test_client()
+
+    def tearDown(self, *args, **kwargs):
+        self.dynamodb_patch.stop()
+        idempotency.response_cache.clear()
+
+    def test_without_key(self, *args, **kwargs):
+        self.client.post('/run', json={})
+        self.client.post('/run', json={})
+        self.assertEqual(2, self.calls)
+        self.assertEqual({}, self.table.items)
+
+    def test_replay(self, *args, **kwargs):
+        response = self.client.post('/run', json={}, headers={'Idempotency-Key': 'key'})
+        self.assertEqual({'call': 1}, response.json)
+        self.assertIsNone(response.headers.get(idempotency.REPLAYED_HEADER))
+
+        replayed_response = self.client.post('/run', json={}, headers={'Idempotency-Key': 'key'})
+        self.assertEqual({'call': 1}, replayed_response.json)
+        self.assertEqual('true', replayed_response.headers.get(idempotency.REPLAYED_HEADER))
+
+        idempotency.response_cache.clear()  # as on another lambda
+        replayed_response = self.client.post('/run', json={}, headers={'Idempotency-Key': 'key'})
+        self.assertEqual({'call': 1}, replayed_response.json)
+        self.assertEqual(1, self.calls)
+
+        self.client.post('/run', json={}, headers={'Idempotency-Key': 'other key'})
+        self.assertEqual(2, self.calls)
+
+    def test_replay_keeps_headers(self, *args, **kwargs):
+        self.client.post('/run', json={'code': 202}, headers={'Idempotency-Key': 'key'})
+        for _ in range(2):
+            replayed_response = self.client.post('/run', json={'code': 202}, headers={'Idempotency-Key': 'key'})
+            self.assertEqual(202, replayed_response.status_code)
+            self.assertEqual('/runs/1', replayed_response.headers.get('Location'))
+            self.assertEqual('respond-async', replayed_response.headers.get('Preference-Applied'))
+            idempotency.response_cache.clear()  # then as on another lambda
+        self.assertEqual(1, self.calls)
+
+    def test_key_reused_with_another_request(self, *args, **kwargs):
+        self.client.post('/run', json={}, headers={'Idempotency-Key': 'key'})
+        response = self.client.post('/run', json={'code': 201}, headers={'Idempotency-Key': 'key'})
+        self.assertEqual(422, response.status_code)
+        self.assertEqual(1, self.calls)
+
+    def test_failed_requests_are_not_stored(self, *args, **kwargs):
+        for code in (500, 409):
+            self.client.post('/run', json={'code': code}, headers={'Idempotency-Key': 'key'})
+            self.assertEqual({}, self.table.items)
+        response = self.client.post('/run', json={'code': 404}, headers={'Idempotency-Key': 'key'})
+        self.assertEqual(404, response.status_code)
+        response = self.client.post('/run', json={'code': 404}, headers={'Idempotency-Key': 'key'})
+        self.assertEqual(404, response.status_code)
+        self.assertEqual(3, self.calls)  # client errors are final
+
+    @mock.patch('time.time', return_value=1000)
+    def test_request_in_progress(self, *args, **kwargs):
+        fingerprint = 'fingerprint'
+        self.assertIsNone(idempotency.begin_request('run#key', fingerprint))
+        self.assertRaises(ConcurrencyException, idempotency.begin_request, 'run#key', fingerprint)
+        with mock.patch('time.time', return_value=1000 + idempotency.IDEMPOTENCY_LOCK_SECONDS + 1):
+            self.assertIsNone(idempotency.begin_request('run#key', fingerprint))  # the lock was abandoned
+
+    def test_invalid_key(self, *args, **kwargs):
+        response = self.client.post('/run', json={}, headers={'Idempotency-Key': 'k' * 256})
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(0, self.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
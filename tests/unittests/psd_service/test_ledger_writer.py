@@ -0,0 +1,68 @@
+import unittest
+from unittest import mock
+
+from psd_service import ledger_writer
+
+
+class MockedDynamoClient(object):
+    # stores the written rows, leaving the first `unprocessed` ones of each call unprocessed once
+    def __init__(self, unprocessed=0):
+        self.stored_items = []
+        self.batch_sizes = []
+        self.unprocessed = unprocessed
+
+    def batch_write_item(self, RequestItems):
+        (table_name, requests), = RequestItems.items()
+        self.batch_sizes.append(len(requests))
+        unprocessed_requests, self.unprocessed = requests[:self.unprocessed], 0
+        self.stored_items += [request['PutRequest']['Item'] for request in requests[len(unprocessed_requests):]]
+        if len(unprocessed_requests) == 0:
+            return {'UnprocessedItems': {}}
+        return {'UnprocessedItems': {table_name: unprocessed_requests}}
+
+
+def build_items(count, start=0):
+    return [{'id': {'S': str(i)}} for i in range(start, start + count)]
+
+
+class LedgerWriterTest(unittest.TestCase):
+
+    def setUp(self, *args, **kwargs):
+        pass  # nothing to create
+
+    def tearDown(self, *args, **kwargs):
+        pass  # nothing to flush or destroy
+
+    def test_write(self, *args, **kwargs):
+        client = MockedDynamoClient()
+        writer = ledger_writer.LedgerWriter(client, 'ledger')
+        writer.write(build_items(30))
+        self.assertEqual([25, 5], client.batch_sizes)  # stored before returning, a batch holds 25 rows at most
+        self.assertEqual(build_items(30), client.stored_items)
+        self.assertEqual(0, writer.get_pending_count())
+        writer.flush()
+        self.assertEqual(2, len(client.batch_sizes))  # nothing left to write
+
+    @mock.patch('time.sleep')
+    def test_unprocessed_items_are_retried(self, *args, **kwargs):
+        client = MockedDynamoClient(unprocessed=2)
+        writer = ledger_writer.LedgerWriter(client, 'ledger')
+        writer.write(build_items(3))
+        self.assertEqual([3, 2], client.batch_sizes)
+        self.assertCountEqual(build_items(3), client.stored_items)
+
+    def test_failed_rows_are_kept(self, *args, **kwargs):
+        client = MockedDynamoClient()
+        writer = ledger_writer.LedgerWriter(client, 'ledger')
+        with mock.patch.object(writer, 'client', mock.Mock()) as failing_client:
+            failing_client.batch_write_item.side_effect = Exception('unavailable')
+            self.assertRaises(Exception, writer.write, build_items(2))
+            self.assertRaises(Exception, writer.flush)
+        self.assertEqual(2, writer.get_pending_count())
+        writer.write(build_items(1, start=2))
+        self.assertEqual(build_items(3), client.stored_items)  # the rows kept go first
+        self.assertEqual(0, writer.get_pending_count())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+
+from psd_service.records import User, Transfer
+
+
+class RecordsTest(unittest.TestCase):
+
+    def setUp(self, *args, **kwargs):
+        pass  # nothing to create
+
+    def tearDown(self, *args, **kwargs):
+        pass  # nothing to flush or destroy
+
+    def test_user_fields(self, *args, **kwargs):
+        self.assertEqual(('passwordHash', 'salt', 'createdAtUTC'), User.SENSITIVE_FIELDS)
+        self.assertEqual(('id', 'username', 'name', 'surname', 'verifiedAccount', 'balance', 'version'),
+                         User.PUBLIC_FIELDS)
+        self.assertEqual(User.PUBLIC_FIELDS + ('balanceShards',), User.NON_SENSITIVE_FIELDS)  # read, not rendered
+        self.assertEqual({'id': 'an id'}, User(id='an id', balanceShards=4).to_dict())
+        self.assertRaises(AttributeError, User, unknown='field')
+        user = User(id='an id')
+        self.assertRaises(AttributeError, setattr, user, 'unknown', 'field')
+        self.assertFalse(hasattr(user, '__dict__'))
+
+    def test_to_and_from_dynamo(self, *args, **kwargs):
+        user = User(id='an id', username='user', passwordHash='hash', verifiedAccount=False, balance=10.5, version=3)
+        expected_dynamo_item = {'id': {'S': 'an id'},
+                                'username': {'S': 'user'},
+                                'passwordHash': {'S': 'hash'},
+                                'verifiedAccount': {'BOOL': False},
+                                'balance': {'N': '10.5'},
+                                'version': {'N': '3'}}
+        dynamo_item = user.to_dynamo()
+        self.assertEqual(expected_dynamo_item, dynamo_item)
+        self.assertEqual(user, User.from_dynamo(dynamo_item))
+
+        decoded_user = User.from_dynamo(dynamo_item, fields=('id', 'version'))
+        self.assertEqual({'id': 'an id', 'version': 3}, decoded_user.to_dict())
+        self.assertTrue(type(decoded_user.version) is int)
+        self.assertFalse(decoded_user.has('balance'))
+        self.assertIsNone(decoded_user.get('balance'))
+
+    def test_to_dict(self, *args, **kwargs):
+        transfer = Transfer.from_dict({'id': 'an id', 'amount': 7, 'extra': 'ignored'})
+        self.assertEqual({'id': 'an id', 'amount': 7}, transfer.to_dict())
+
+        user = User(id='an id', salt='salt', passwordHash='hash', balance=1.0)
+        self.assertEqual({'id': 'an id', 'balance': 1.0}, user.to_dict())
+        self.assertEqual({'id': 'an id', 'passwordHash': 'hash', 'salt': 'salt', 'balance': 1.0},
+                         user.to_dict(include_sensitive=True))
+        self.assertEqual({'balance': 1.0}, user.to_dict(fields=('balance', 'name')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+from unittest import mock
+
+from psd_service.exceptions import NotFoundException
+from psd_service.records import BalanceSnapshot, User
+
+with mock.patch('boto3.client'):  # every test replaces the dynamodb client
+    from psd_service import snapshots
+
+
+def build_transfer_item(amount, at):
+    return {'amount': {'N': str(amount)}, 'occurredAtUTC': {'S': at}}
+
+
+def build_streams(sent_items, received_items):
+    def iterate_user_transfers_stream(stream_name, user_id, since=None, until=None, fields=None):
+        for item in sent_items if stream_name == 'sent' else received_items:
+            yield stream_name, item
+    return iterate_user_transfers_stream
+
+
+class SnapshotsTest(unittest.TestCase):
+
+    def setUp(self, *args, **kwargs):
+        pass  # nothing to create
+
+    def tearDown(self, *args, **kwargs):
+        pass  # nothing to flush or destroy
+
+    def test_get_balance_at_replays_after_snapshot(self, *args, **kwargs):
+        client = mock.Mock()
+        client.query.return_value = {'Items': [
+            BalanceSnapshot(userId='a', atUTC='2020-01-01T00:00:00', balance=100.0).to_dynamo()
+        ]}
+        streams = build_streams([build_transfer_item(0.1, '2020-01-02'), build_transfer_item(0.2, '2020-01-03')],
+                                [build_transfer_item(50, '2020-01-02'),
+                                 build_transfer_item(7, '2020-01-01T00:00:00')])  # inside the snapshot
+        with mock.patch.object(snapshots, 'dynamodb', client), \
+                mock.patch.object(snapshots.transactions, 'iterate_user_transfers_stream', streams):
+            balance = snapshots.get_balance_at('a', '2020-02-01T00:00:00')
+        self.assertEqual(149.7, balance['balance'])
+        self.assertEqual(3, balance['replayedTransfers'])
+        self.assertEqual('2020-01-01T00:00:00', balance['snapshotAtUTC'])
+        query_kwargs = client.query.call_args.kwargs
+        self.assertFalse(query_kwargs['ScanIndexForward'])
+        self.assertEqual(1, query_kwargs['Limit'])
+        client.put_item.assert_not_called()  # short replays leave no snapshot
+
+    def test_get_balance_at_stores_snapshot_after_long_replay(self, *args, **kwargs):
+        client = mock.Mock()
+        client.query.return_value = {'Items': []}
+        user = User(id='a', createdAtUTC='2020-01-01T00:00:00')
+        streams = build_streams([build_transfer_item(1, '2020-01-02')] * 3, [])
+        with mock.patch.object(snapshots, 'dynamodb', client), \
+                mock.patch.object(snapshots, 'SNAPSHOT_REPLAY_THRESHOLD', 3), \
+                mock.patch.object(snapshots.users, 'get_user_from_id', return_value=user), \
+                mock.patch.object(snapshots.transactions, 'iterate_user_transfers_stream', streams):
+            balance = snapshots.get_balance_at('a', '2020-02-01T00:00:00')
+        self.assertEqual(snapshots.users.DEFAULT_BALANCE - 3, balance['balance'])
+        self.assertEqual('2020-01-01T00:00:00', balance['snapshotAtUTC'])
+        stored_snapshot = BalanceSnapshot.from_dynamo(client.put_item.call_args.kwargs['Item'])
+        self.assertEqual(BalanceSnapshot(userId='a', atUTC='2020-02-01T00:00:00',
+                                         balance=snapshots.users.DEFAULT_BALANCE - 3), stored_snapshot)
+
+    def test_get_balance_at_snapshot_failure(self, *args, **kwargs):
+        client = mock.Mock()
+        client.query.return_value = {'Items': []}
+        client.put_item.side_effect = Exception('Unreachable')
+        user = User(id='a', createdAtUTC='2020-01-01T00:00:00')
+        streams = build_streams([build_transfer_item(1, '2020-01-02')] * 3, [])
+        with mock.patch.object(snapshots, 'dynamodb', client), \
+                mock.patch.object(snapshots, 'SNAPSHOT_REPLAY_THRESHOLD', 3), \
+                mock.patch.object(snapshots.users, 'get_user_from_id', return_value=user), \
+                mock.patch.object(snapshots.transactions, 'iterate_user_transfers_stream', streams):
+            balance = snapshots.get_balance_at('a', '2020-02-01T00:00:00')  # the snapshot is only a shortcut
+        self.assertEqual(snapshots.users.DEFAULT_BALANCE - 3, balance['balance'])
+        client.put_item.assert_called_once()
+
+    def test_get_balance_before_creation(self, *args, **kwargs):
+        client = mock.Mock()
+        client.query.return_value = {'Items': []}
+        user = User(id='a', createdAtUTC='2020-01-01T00:00:00')
+        with mock.patch.object(snapshots, 'dynamodb', client), \
+                mock.patch.object(snapshots.users, 'get_user_from_id', return_value=user):
+            with self.assertRaises(NotFoundException):
+                snapshots.get_balance_at('a', '2019-12-31T00:00:00')
+
+    def test_compact_user_balance(self, *args, **kwargs):
+        client = mock.Mock()
+        client.query.return_value = {'Items': [
+            BalanceSnapshot(userId='a', atUTC='2020-01-01T00:00:00', balance=100.0).to_dynamo()
+        ]}
+        with mock.patch.object(snapshots, 'dynamodb', client), \
+                mock.patch.object(snapshots.transactions, 'iterate_user_transfers_stream', build_streams([], [])):
+            self.assertFalse(snapshots.compact_user_balance('a', at='2020-02-01T00:00:00'))
+        client.put_item.assert_not_called()  # nothing moved since the last snapshot
+
+    def test_handler_compacts_the_other_users(self, *args, **kwargs):
+        def compact_user_balance(user_id, at=None):
+            if user_id == 'b':
+                raise Exception('Throttled')
+            if user_id == 'c':
+                raise NotFoundException('c not found')
+            return True
+        with mock.patch.object(snapshots.users, 'iterate_user_ids', return_value=iter(['a', 'b', 'c', 'd'])), \
+                mock.patch.object(snapshots, 'compact_user_balance', side_effect=compact_user_balance) as compact:
+            result = snapshots.handler({}, None)
+        self.assertEqual(4, compact.call_count)
+        self.assertEqual(2, result['compacted_users'])
+        self.assertEqual(1, result['failed_users'])  # a user created after the settled time is not a failure
+
+
+if __name__ == '__main__':
+    unittest.main()
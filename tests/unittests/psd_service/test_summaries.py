@@ -0,0 +1,136 @@
+import json
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+from psd_service.records import Transfer
+
+with mock.patch('boto3.client'):  # every test replaces the dynamodb client
+    from psd_service import summaries
+
+
+def build_transfer(src_user_id, dst_user_id, amount, at):
+    return Transfer(id='id', srcUserId=src_user_id, dstUserId=dst_user_id, amount=amount, occurredAtUTC=at)
+
+
+class SummariesTest(unittest.TestCase):
+
+    def setUp(self, *args, **kwargs):
+        pass  # nothing to create
+
+    def tearDown(self, *args, **kwargs):
+        pass  # nothing to flush or destroy
+
+    def test_build_summary_updates(self, *args, **kwargs):
+        updates = summaries.build_summary_updates([build_transfer('a', 'b', 10.0, '2020-01-02')])
+        self.assertEqual({'a', 'b'}, set(updates.keys()))
+        totals_update, counterparty_update = updates['a']
+        self.assertEqual({'userId': {'S': 'a'}, 'counterpartyId': {'S': summaries.TOTALS_ROW}}, totals_update['Key'])
+        self.assertEqual({'userId': {'S': 'a'}, 'counterpartyId': {'S': 'b'}}, counterparty_update['Key'])
+        self.assertNotIn(':volume', totals_update['ExpressionAttributeValues'])  # kept out of the volume index
+        self.assertEqual({'N': '10.0'}, counterparty_update['ExpressionAttributeValues'][':volume'])
+        self.assertEqual({'N': '1'}, counterparty_update['ExpressionAttributeValues'][':sent_count'])
+        self.assertEqual({'N': '0'}, updates['b'][1]['ExpressionAttributeValues'][':sent_count'])
+        self.assertEqual({'N': '1'}, updates['b'][1]['ExpressionAttributeValues'][':received_count'])
+
+    def test_build_summary_updates_nets_transfers(self, *args, **kwargs):
+        updates = summaries.build_summary_updates([
+            build_transfer('a', 'b', 10.0, '2020-01-02'),
+            build_transfer('b', 'a', 4.0, '2020-01-01'),
+            build_transfer('a', 'c', 1.0, '2020-01-03'),
+        ])
+        self.assertEqual(3, len(updates['a']))  # totals, b and c rows
+        values = updates['a'][0]['ExpressionAttributeValues']
+        self.assertEqual({'N': '2'}, values[':sent_count'])
+        self.assertEqual({'N': '11.0'}, values[':sent_total'])
+        self.assertEqual({'N': '1'}, values[':received_count'])
+        self.assertEqual({'S': '2020-01-01'}, values[':first_activity_at'])
+        self.assertEqual({'S': '2020-01-03'}, values[':last_activity_at'])
+        self.assertEqual({'N': '14.0'}, updates['a'][1]['ExpressionAttributeValues'][':volume'])
+
+    def test_get_user_summary(self, *args, **kwargs):
+        client = mock.Mock()
+        client.get_item.return_value = {'Item': {
+            'userId': {'S': 'a'}, 'counterpartyId': {'S': '#'}, 'sentCount': {'N': '2'}, 'sentTotal': {'N': '11'},
+            'receivedCount': {'N': '1'}, 'receivedTotal': {'N': '4'}, 'firstActivityAtUTC': {'S': '2020-01-01'},
+            'lastActivityAtUTC': {'S': '2020-01-03'}
+        }}
+        client.query.return_value = {'Items': [{
+            'userId': {'S': 'a'}, 'counterpartyId': {'S': 'b'}, 'sentCount': {'N': '1'}, 'sentTotal': {'N': '10'},
+            'receivedCount': {'N': '1'}, 'receivedTotal': {'N': '4'}, 'volume': {'N': '14'}
+        }]}
+        with mock.patch.object(summaries, 'dynamodb', client):
+            summary = summaries.get_user_summary('a', top=1)
+        self.assertEqual({'count': 2, 'total': 11.0}, summary['sent'])
+        self.assertEqual({'count': 1, 'total': 4.0}, summary['received'])
+        self.assertEqual('2020-01-01', summary['firstActivityAtUTC'])
+        self.assertEqual([{'userId': 'b', 'volume': 14.0, 'sent': {'count': 1, 'total': 10.0},
+                           'received': {'count': 1, 'total': 4.0}}], summary['topCounterparties'])
+        self.assertFalse(client.query.call_args.kwargs['ScanIndexForward'])
+        self.assertEqual(1, client.query.call_args.kwargs['Limit'])
+
+    def test_get_user_summary_without_activity(self, *args, **kwargs):
+        client = mock.Mock()
+        client.get_item.return_value = {}
+        with mock.patch.object(summaries, 'dynamodb', client):
+            summary = summaries.get_user_summary('a')
+        self.assertEqual({'count': 0, 'total': 0.0}, summary['sent'])
+        self.assertEqual([], summary['topCounterparties'])
+        client.query.assert_not_called()
+
+
+    def test_apply_summary_updates(self, *args, **kwargs):
+        client = mock.Mock()
+        throttled = ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Throttled'}}, 'UpdateItem')
+        client.update_item.side_effect = [throttled, None, Exception('Unreachable'), None]
+        updates = [summaries.build_summary_row_update(user_id, summaries.TOTALS_ROW, sent_count=1)
+                   for user_id in ('a', 'b', 'c')]
+        policy = summaries.retry_u.RetryPolicy(base_delay_seconds=0, retry_on=(summaries.retry_u.THROTTLING,))
+        with mock.patch.object(summaries, 'dynamodb', client), \
+                mock.patch.object(summaries, 'SUMMARY_RETRY_POLICY', policy):
+            summaries.apply_summary_updates(updates)  # never raises, the transfers are already committed
+        self.assertEqual(['a', 'a', 'b', 'c'], [call.kwargs['Key']['userId']['S']
+                                                for call in client.update_item.call_args_list])
+        repair_items = [request['PutRequest']['Item']
+                        for request in client.batch_write_item.call_args.kwargs['RequestItems'][None]]
+        self.assertEqual(1, len(repair_items))  # only the failed row is kept for the repair
+        self.assertEqual(summaries.REPAIR_ROWS, repair_items[0]['userId']['S'])
+        self.assertEqual(updates[1]['Key'], json.loads(repair_items[0]['update']['S'])['Key'])
+
+    def test_apply_summary_updates_in_chunks(self, *args, **kwargs):
+        client = mock.Mock()
+        conflict = ClientError({'Error': {'Code': 'TransactionCanceledException', 'Message': 'Cancelled'},
+                                'CancellationReasons': [{'Code': 'TransactionConflict'}]}, 'TransactWriteItems')
+        client.transact_write_items.side_effect = [conflict, None, Exception('Unreachable')]
+        client.batch_write_item.return_value = {}
+        updates = [summaries.build_summary_row_update(f'user-{i}', summaries.TOTALS_ROW, sent_count=1)
+                   for i in range(summaries.MAX_TRANSACT_ITEMS + 1)]
+        policy = summaries.retry_u.RetryPolicy(base_delay_seconds=0, retry_on=(summaries.retry_u.CONCURRENCY,))
+        with mock.patch.object(summaries, 'dynamodb', client), \
+                mock.patch.object(summaries, 'SUMMARY_CHUNK_RETRY_POLICY', policy):
+            summaries.apply_summary_updates_in_chunks(updates)  # never raises, the transfers are already committed
+        self.assertEqual([summaries.MAX_TRANSACT_ITEMS, summaries.MAX_TRANSACT_ITEMS, 1],
+                         [len(call.kwargs['TransactItems']) for call in client.transact_write_items.call_args_list])
+        repair_items = [request['PutRequest']['Item']
+                        for request in client.batch_write_item.call_args.kwargs['RequestItems'][None]]
+        self.assertEqual([updates[-1]['Key']], [json.loads(item['update']['S'])['Key'] for item in repair_items])
+
+    def test_repair_summaries(self, *args, **kwargs):
+        client = mock.Mock()
+        update = summaries.build_summary_row_update('a', summaries.TOTALS_ROW, sent_count=1)
+        repair_items = [summaries.build_summary_repair_item(update) for _ in range(2)]
+        client.query.return_value = {'Items': repair_items}
+        client.transact_write_items.side_effect = [None, Exception('Unreachable')]
+        policy = summaries.retry_u.RetryPolicy(max_attempts=1)
+        with mock.patch.object(summaries, 'dynamodb', client), \
+                mock.patch.object(summaries, 'SUMMARY_CHUNK_RETRY_POLICY', policy):
+            repaired_rows = summaries.repair_summaries()  # the failed repair stays for the next run
+        self.assertEqual(1, repaired_rows)
+        update_item, delete_item = client.transact_write_items.call_args_list[0].kwargs['TransactItems']
+        self.assertEqual(update, update_item['Update'])
+        self.assertEqual(repair_items[0]['counterpartyId'], delete_item['Delete']['Key']['counterpartyId'])
+
+
+if __name__ == '__main__':
+    unittest.main()
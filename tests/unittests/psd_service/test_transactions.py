@@ -0,0 +1,483 @@
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+from psd_service.exceptions import BadRequestException, NotEnoughBalanceException, NotFoundException, \
+    ConcurrencyException, AlreadyProcessedException
+from psd_service.records import Transfer, TransferStatus, User
+
+with mock.patch('boto3.client'):  # every test replaces the dynamodb client
+    from psd_service import transactions
+    from psd_service import transfer_queue
+    from psd_service import utils_dynamo as dynamo_u
+
+SRC_INDEX = transactions.DYNAMODB_TRANSACTIONS_SRC_USER_INDEX
+DST_INDEX = transactions.DYNAMODB_TRANSACTIONS_DST_USER_INDEX
+
+
+def build_transfer_item(transfer_id, src_user_id, dst_user_id, at):
+    return Transfer(id=transfer_id, srcUserId=src_user_id, dstUserId=dst_user_id, amount=1.0,
+                    occurredAtUTC=at).to_dynamo()
+
+
+def build_cancellation(*reasons):
+    # a TransactWriteItems cancellation, with one reason per item and `None` for the items that did not fail
+    reasons = [{'Code': 'None'} if reason is None else reason for reason in reasons]
+    return ClientError({'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+                        'CancellationReasons': reasons}, 'TransactWriteItems')
+
+
+def build_user_item(user_id, balance, **fields):
+    return User(id=user_id, balance=balance, version=1, **fields).to_dynamo()
+
+
+CONDITION_FAILED = {'Code': 'ConditionalCheckFailed'}
+QUEUED_MESSAGE = {'id': 'queued', 'srcUserId': 'a', 'dstUserId': 'b', 'amount': 10.0}
+USER_A = '00000000-0000-4000-8000-00000000000a'
+USER_B = '00000000-0000-4000-8000-00000000000b'
+BATCH_REQUESTS = [{'src_user_id': USER_A, 'dst_user_id': USER_B, 'amount': 10.0},
+                  {'src_user_id': USER_B, 'dst_user_id': USER_A, 'amount': 2.5}]
+BATCH_USERS = {USER_A: User(id=USER_A, balance=20.0, version=1), USER_B: User(id=USER_B, balance=0.0, version=1)}
+THROTTLED = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'Throttled'}},
+                        'UpdateItem')
+NO_DELAY_BATCH_POLICY = transactions.retry_u.RetryPolicy(
+    max_attempts=3, base_delay_seconds=0, retry_on=(transactions.retry_u.CONCURRENCY, transactions.retry_u.THROTTLING))
+NO_RETRY_POLICY = transactions.retry_u.RetryPolicy(max_attempts=2, base_delay_seconds=0,
+                                                   retry_on=(transactions.retry_u.CONCURRENCY,))
+
+
+class FakeTransfersIndex(object):
+    # answers the stream queries from a list of items, newest first, one page of `Limit` items at a time
+    def __init__(self, items):
+        self.items = items
+        self.calls = []
+
+    def query(self, **query_kwargs):
+        self.calls.append(query_kwargs)
+        user_key = 'srcUserId' if query_kwargs['IndexName'] == SRC_INDEX else 'dstUserId'
+        user_id = query_kwargs['ExpressionAttributeValues'][':user_id']['S']
+        items = sorted((item for item in self.items if item[user_key]['S'] == user_id),
+                       key=lambda item: item['occurredAtUTC']['S'], reverse=True)
+        start_key = query_kwargs.get('ExclusiveStartKey')
+        if start_key is not None:
+            ids = [item['id']['S'] for item in items]
+            items = items[ids.index(start_key['id']['S']) + 1:]
+        limit = query_kwargs.get('Limit', len(items))
+        page = {'Items': items[:limit]}
+        if len(items) > limit:
+            last_item = items[limit - 1]
+            page['LastEvaluatedKey'] = {key: last_item[key] for key in ('id', 'occurredAtUTC', user_key)}
+        return page
+
+
+class TransactionsTest(unittest.TestCase):
+
+    def setUp(self, *args, **kwargs):
+        transactions.balance_shards.shard_count_cache.clear()
+        transactions.balance_shards.shard_balance_cache.clear()
+        transactions.users.user_cache.clear()
+
+    def tearDown(self, *args, **kwargs):
+        transactions.balance_shards.shard_count_cache.clear()
+        transactions.balance_shards.shard_balance_cache.clear()
+        transactions.users.user_cache.clear()
+        transactions.ledger.take_pending_items()
+
+    def test_plan_batch_transfer(self, *args, **kwargs):
+        requests = [
+            ('a', 'b', 10.0, None),
+            ('a', 'b', 100.0, None),  # more than a has by then
+            ('b', 'c', 15.0, None),  # only possible after the first one
+            ('a', 'x', 1.0, None),  # unknown user
+            (None, None, None, BadRequestException('Provide a amount!')),
+        ]
+        results, balance_deltas, accepted_transfers = transactions.plan_batch_transfer(
+            requests, {'a': 20.0, 'b': 5.0, 'c': 0.0})
+        self.assertEqual(['ok', 'failed', 'ok', 'failed', 'failed'], [result['status'] for result in results])
+        self.assertEqual('User a does not have enough balance', results[1]['error'])
+        self.assertEqual('Provide a amount!', results[4]['error'])
+        self.assertEqual({'a': -10.0, 'b': -5.0, 'c': 15.0}, balance_deltas)
+        self.assertEqual([('a', 'b'), ('b', 'c')], [(transfer.srcUserId, transfer.dstUserId)
+                                                    for transfer in accepted_transfers])
+        self.assertEqual(results[0]['transaction'], accepted_transfers[0].to_dict())
+
+    def test_plan_batch_transfer_nets_to_zero(self, *args, **kwargs):
+        requests = [('a', 'b', 0.1, None), ('a', 'b', 0.2, None), ('b', 'a', 0.3, None)]
+        results, balance_deltas, accepted_transfers = transactions.plan_batch_transfer(requests, {'a': 0.3, 'b': 0.0})
+        self.assertEqual(['ok', 'ok', 'ok'], [result['status'] for result in results])  # 0.3 - 0.1 - 0.2 is not < 0
+        self.assertEqual({}, balance_deltas)  # no float residue is left to write
+        self.assertEqual(3, len(accepted_transfers))
+
+    def test_make_transfer(self, *args, **kwargs):
+        client = mock.Mock()
+        with mock.patch.object(transactions, 'dynamodb', client):
+            transfer = transactions.make_transfer('a', 'b', 10.0)
+        self.assertEqual(('a', 'b', 10.0), (transfer.srcUserId, transfer.dstUserId, transfer.amount))
+        transact_items = client.transact_write_items.call_args.kwargs['TransactItems']
+        debit, credit, ledger_put = transact_items[0]['Update'], transact_items[1]['Update'], transact_items[2]['Put']
+        self.assertEqual({'S': 'a'}, debit['Key']['id'])
+        self.assertEqual('balance >= :needed', debit['ConditionExpression'])
+        self.assertEqual({'S': 'b'}, credit['Key']['id'])
+        self.assertEqual(transfer, Transfer.from_dynamo(ledger_put['Item']))
+        self.assertEqual(3 + 4, len(transact_items))  # the totals and counterparty summary rows of both users
+
+    def test_make_transfer_invalidates_cached_users(self, *args, **kwargs):
+        for user_id in ('a', 'b', 'c'):
+            transactions.users.cache_user(User(id=user_id, balance=100.0, version=1))
+        with mock.patch.object(transactions, 'dynamodb', mock.Mock()):
+            transactions.make_transfer('a', 'b', 10.0)
+        self.assertIsNone(transactions.users.user_cache.get('a'))  # both balances changed
+        self.assertIsNone(transactions.users.user_cache.get('b'))
+        self.assertIsNotNone(transactions.users.user_cache.get('c'))
+
+    def test_make_transfer_not_enough_balance(self, *args, **kwargs):
+        client = mock.Mock()
+        client.transact_write_items.side_effect = build_cancellation(
+            {**CONDITION_FAILED, 'Item': build_user_item('a', 5.0)}, None, None)
+        with mock.patch.object(transactions, 'dynamodb', client):
+            with self.assertRaises(NotEnoughBalanceException):
+                transactions.make_transfer('a', 'b', 10.0)
+        self.assertEqual(1, client.transact_write_items.call_count)
+
+    def test_make_transfer_missing_users(self, *args, **kwargs):
+        for reasons in ((CONDITION_FAILED, None, None), (None, CONDITION_FAILED, None)):  # no old item, no user
+            client = mock.Mock()
+            client.transact_write_items.side_effect = build_cancellation(*reasons)
+            with mock.patch.object(transactions, 'dynamodb', client):
+                with self.assertRaises(NotFoundException):
+                    transactions.make_transfer('a', 'b', 10.0)
+
+    def test_make_transfer_conflict(self, *args, **kwargs):
+        client = mock.Mock()
+        client.transact_write_items.side_effect = build_cancellation(None, {'Code': 'TransactionConflict'}, None)
+        with mock.patch.object(transactions, 'dynamodb', client), \
+                mock.patch.object(transactions, 'TRANSFER_RETRY_POLICY', NO_RETRY_POLICY):
+            with self.assertRaises(ConcurrencyException):
+                transactions.make_transfer('a', 'b', 10.0)
+        self.assertEqual(2, client.transact_write_items.call_count)  # conflicts are retried
+
+    def test_make_transfer_conflict_then_success(self, *args, **kwargs):
+        client = mock.Mock()
+        client.transact_write_items.side_effect = [build_cancellation({'Code': 'TransactionConflict'}, None, None),
+                                                   {}]
+        with mock.patch.object(transactions, 'dynamodb', client), \
+                mock.patch.object(transactions, 'TRANSFER_RETRY_POLICY', NO_RETRY_POLICY):
+            transactions.make_transfer('a', 'b', 10.0)
+        first_items, second_items = [call.kwargs['TransactItems'] for call in client.transact_write_items.call_args_list]
+        self.assertEqual(first_items[2], second_items[2])  # the same ledger row, so a retry never doubles it
+
+    def test_make_transfer_to_sharded_account(self, *args, **kwargs):
+        client, summaries_client = mock.Mock(), mock.Mock()
+        client.transact_write_items.side_effect = [
+            build_cancellation(None, {**CONDITION_FAILED, 'Item': build_user_item('b', 0.0, balanceShards=4)}, None),
+            None
+        ]
+        with mock.patch.object(transactions, 'dynamodb', client), \
+                mock.patch.object(transactions.summaries, 'dynamodb', summaries_client):
+            transactions.make_transfer('a', 'b', 10.0)
+        self.assertEqual(4, transactions.balance_shards.get_known_shard_count('b'))
+        transact_items = client.transact_write_items.call_args.kwargs['TransactItems']
+        credit = transact_items[1]['Update']
+        self.assertEqual(transactions.balance_shards.DYNAMODB_BALANCE_SHARDS, credit['TableName'])
+        self.assertEqual({'S': 'b'}, credit['Key']['userId'])
+        self.assertEqual(3 + 2, len(transact_items))  # the summary rows of `b` are kept out of the transaction
+        self.assertEqual(2, summaries_client.update_item.call_count)  # and applied after it
+
+    @mock.patch('psd_service.summaries.SUMMARY_RETRY_POLICY', NO_RETRY_POLICY)
+    def test_make_transfer_summary_failure_after_commit(self, *args, **kwargs):
+        transactions.balance_shards.remember_shard_count('b', 4)  # the summary rows of `b` are applied after it
+        client, summaries_client = mock.Mock(), mock.Mock()
+        summaries_client.update_item.side_effect = THROTTLED
+        summaries_client.batch_write_item.return_value = {}
+        with mock.patch.object(transactions, 'dynamodb', client), \
+                mock.patch.object(transactions.summaries, 'dynamodb', summaries_client):
+            transfer = transactions.make_transfer('a', 'b', 10.0)  # the money moved, the request did not fail
+        self.assertEqual(('a', 'b', 10.0), (transfer.srcUserId, transfer.dstUserId, transfer.amount))
+        self.assertEqual(1, client.transact_write_items.call_count)
+        self.assertEqual(2, summaries_client.update_item.call_count)  # each row is tried, none is given up early
+        repair_requests = list(summaries_client.batch_write_item.call_args.kwargs['RequestItems'].values())[0]
+        self.assertEqual(2, len(repair_requests))
+
+    def test_make_transfer_debit_after_sweep(self, *args, **kwargs):
+        client, shards_client, users_client = mock.Mock(), mock.Mock(), mock.Mock()
+        client.transact_write_items.side_effect = [
+            build_cancellation({**CONDITION_FAILED, 'Item': build_user_item('a', 5.0, balanceShards=4)}, None, None),
+            None
+        ]
+        shards_client.query.return_value = {'Items': [{'userId': {'S': 'a'}, 'shard': {'N': '1'},
+                                                       'balance': {'N': '20'}}]}
+        with mock.patch.object(transactions, 'dynamodb', client), \
+                mock.patch.object(transactions.balance_shards, 'dynamodb', shards_client), \
+                mock.patch.object(transactions.users, 'dynamodb', users_client):
+            transfer = transactions.make_transfer('a', 'b', 10.0)
+        self.assertEqual(10.0, transfer.amount)
+        users_client.transact_write_items.assert_called_once()  # the shards were swept into the balance
+        self.assertEqual(2, client.transact_write_items.call_count)
+
+    def test_make_transfer_debit_with_empty_shards(self, *args, **kwargs):
+        client, shards_client, users_client = mock.Mock(), mock.Mock(), mock.Mock()
+        client.transact_write_items.side_effect = build_cancellation(
+            {**CONDITION_FAILED, 'Item': build_user_item('a', 5.0, balanceShards=4)}, None, None)
+        shards_client.query.return_value = {'Items': []}
+        with mock.patch.object(transactions, 'dynamodb', client), \
+                mock.patch.object(transactions.balance_shards, 'dynamodb', shards_client), \
+                mock.patch.object(transactions.users, 'dynamodb', users_client):
+            with self.assertRaises(NotEnoughBalanceException):
+                transactions.make_transfer('a', 'b', 10.0)
+        users_client.transact_write_items.assert_not_called()
+        self.assertEqual(1, client.transact_write_items.call_count)  # nothing was swept, so it is not tried again
+
+    def test_make_transfer_already_processed(self, *args, **kwargs):
+        client = mock.Mock()
+        client.transact_write_items.side_effect = build_cancellation(None, None, None, CONDITION_FAILED)
+        with mock.patch.object(transactions, 'dynamodb', client):
+            with self.assertRaises(AlreadyProcessedException):
+                transactions.make_transfer('a', 'b', 10.0, transfer_id='queued')
+        status_update = client.transact_write_items.call_args.kwargs['TransactItems'][3]['Update']
+        self.assertEqual({'S': 'queued'}, status_update['Key']['id'])
+
+    @mock.patch('psd_service.users.get_users_by_ids', return_value=BATCH_USERS)
+    def test_make_batch_transfer_stores_ledger_rows(self, *args, **kwargs):
+        client, ledger_client = mock.Mock(), mock.Mock()
+        ledger_client.batch_write_item.return_value = {}
+        with mock.patch.object(transactions, 'dynamodb', client), \
+                mock.patch.object(transactions.ledger, 'client', ledger_client), \
+                mock.patch.object(transactions.summaries, 'dynamodb', mock.Mock()):
+            results = transactions.make_batch_transfer(BATCH_REQUESTS)
+        self.assertEqual(['ok', 'ok'], [result['status'] for result in results])
+        self.assertEqual(2, len(client.transact_write_items.call_args.kwargs['TransactItems']))  # netted per account
+        request_items = ledger_client.batch_write_item.call_args.kwargs['RequestItems']
+        self.assertEqual(2, len(request_items[transactions.DYNAMODB_TRANSACTIONS]))  # stored before answering
+        self.assertEqual(0, transactions.ledger.get_pending_count())
+
+    @mock.patch('psd_service.users.get_users_by_ids', return_value=BATCH_USERS)
+    @mock.patch('psd_service.transactions.BATCH_RETRY_POLICY', NO_DELAY_BATCH_POLICY)
+    def test_make_batch_transfer_replans_on_balance_change(self, *args, **kwargs):
+        client = mock.Mock()
+        client.transact_write_items.side_effect = [
+            build_cancellation({**CONDITION_FAILED, 'Item': build_user_item(USER_A, 5.0)}, None), None]
+        with mock.patch.object(transactions, 'dynamodb', client), \
+                mock.patch.object(transactions.ledger, 'client', mock.Mock()), \
+                mock.patch.object(transactions.summaries, 'dynamodb', mock.Mock()):
+            results = transactions.make_batch_transfer(BATCH_REQUESTS)
+        self.assertEqual(['failed', 'failed'], [result['status'] for result in results])  # planned with 5.0
+        self.assertEqual(1, client.transact_write_items.call_count)  # nothing left to apply
+
+    @mock.patch('psd_service.users.get_users_by_ids', return_value=BATCH_USERS)
+    @mock.patch('psd_service.transactions.BATCH_RETRY_POLICY', NO_DELAY_BATCH_POLICY)
+    def test_make_batch_transfer_conflict_then_success(self, *args, **kwargs):
+        client = mock.Mock()
+        client.transact_write_items.side_effect = [build_cancellation({'Code': 'TransactionConflict'}, None), None]
+        with mock.patch.object(transactions, 'dynamodb', client), \
+                mock.patch.object(transactions.ledger, 'client', mock.Mock()), \
+                mock.patch.object(transactions.summaries, 'dynamodb', mock.Mock()):
+            results = transactions.make_batch_transfer(BATCH_REQUESTS)
+        self.assertEqual(['ok', 'ok'], [result['status'] for result in results])
+        self.assertEqual(2, client.transact_write_items.call_count)
+
+    @mock.patch('psd_service.users.get_users_by_ids', return_value=BATCH_USERS)
+    @mock.patch('psd_service.transactions.BATCH_RETRY_POLICY', NO_DELAY_BATCH_POLICY)
+    def test_make_batch_transfer_conflicts(self, *args, **kwargs):
+        client = mock.Mock()
+        client.transact_write_items.side_effect = build_cancellation({'Code': 'TransactionConflict'}, None)
+        with mock.patch.object(transactions, 'dynamodb', client):
+            with self.assertRaises(ConcurrencyException):
+                transactions.make_batch_transfer(BATCH_REQUESTS)
+        self.assertEqual(NO_DELAY_BATCH_POLICY.max_attempts, client.transact_write_items.call_count)
+
+    @mock.patch('psd_service.users.get_users_by_ids', return_value=BATCH_USERS)
+    @mock.patch('psd_service.transactions.BATCH_RETRY_POLICY', NO_DELAY_BATCH_POLICY)
+    def test_make_batch_transfer_throttled(self, *args, **kwargs):
+        client = mock.Mock()
+        client.transact_write_items.side_effect = build_cancellation({'Code': 'ThrottlingError'}, None)
+        with mock.patch.object(transactions, 'dynamodb', client):
+            with self.assertRaises(ClientError):  # as it is, not as a conflict
+                transactions.make_batch_transfer(BATCH_REQUESTS)
+        self.assertEqual(NO_DELAY_BATCH_POLICY.max_attempts, client.transact_write_items.call_count)
+
+    @mock.patch('psd_service.users.get_users_by_ids', return_value=BATCH_USERS)
+    def test_make_batch_transfer_ledger_failure(self, *args, **kwargs):
+        ledger_client = mock.Mock()
+        ledger_client.batch_write_item.side_effect = ClientError(
+            {'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'Throttled'}}, 'BatchWriteItem')
+        with mock.patch.object(transactions, 'dynamodb', mock.Mock()), \
+                mock.patch.object(transactions.ledger, 'client', ledger_client), \
+                mock.patch.object(transactions.summaries, 'dynamodb', mock.Mock()):
+            results = transactions.make_batch_transfer(BATCH_REQUESTS)  # the money moved, the request did not fail
+        self.assertEqual(['ok', 'ok'], [result['status'] for result in results])
+        self.assertEqual(2, transactions.ledger.get_pending_count())  # kept for the next flush
+
+    @mock.patch('psd_service.users.get_users_by_ids', return_value=BATCH_USERS)
+    @mock.patch('psd_service.summaries.SUMMARY_CHUNK_RETRY_POLICY', NO_RETRY_POLICY)
+    def test_make_batch_transfer_summary_failure(self, *args, **kwargs):
+        ledger_client, summaries_client = mock.Mock(), mock.Mock()
+        ledger_client.batch_write_item.return_value = {}
+        summaries_client.transact_write_items.side_effect = THROTTLED
+        summaries_client.batch_write_item.return_value = {}
+        with mock.patch.object(transactions, 'dynamodb', mock.Mock()), \
+                mock.patch.object(transactions.ledger, 'client', ledger_client), \
+                mock.patch.object(transactions.summaries, 'dynamodb', summaries_client):
+            results = transactions.make_batch_transfer(BATCH_REQUESTS)
+        self.assertEqual(['ok', 'ok'], [result['status'] for result in results])
+        transact_items = summaries_client.transact_write_items.call_args.kwargs['TransactItems']
+        self.assertEqual(4, len(transact_items))  # totals and counterparty rows of both users, in a single chunk
+        summaries_client.update_item.assert_not_called()
+        repair_requests = list(summaries_client.batch_write_item.call_args.kwargs['RequestItems'].values())[0]
+        self.assertEqual(4, len(repair_requests))  # kept for the repair
+
+    def test_enqueue_transfer(self, *args, **kwargs):
+        client, queue = mock.Mock(), transfer_queue.InProcessTransferQueue()
+        with mock.patch.object(transactions, 'dynamodb', client), \
+                mock.patch.object(transactions.transfer_queue, 'transfer_queue', queue):
+            transfer_status = transactions.enqueue_transfer('a', 'b', 10.0)
+        self.assertEqual(transactions.QUEUED, transfer_status.state)
+        self.assertEqual(transfer_status, TransferStatus.from_dynamo(client.put_item.call_args.kwargs['Item']))
+        self.assertEqual([{'id': transfer_status.id, 'srcUserId': 'a', 'dstUserId': 'b', 'amount': 10.0}],
+                         [message for message, _ in queue.receive()])
+
+    def test_enqueue_transfer_send_failure(self, *args, **kwargs):
+        client, queue = mock.Mock(), mock.Mock()
+        queue.send.side_effect = Exception('Queue is down')
+        with mock.patch.object(transactions, 'dynamodb', client), \
+                mock.patch.object(transactions.transfer_queue, 'transfer_queue', queue):
+            with self.assertRaises(Exception):
+                transactions.enqueue_transfer('a', 'b', 10.0)
+        status_update = client.update_item.call_args.kwargs
+        self.assertEqual(client.put_item.call_args.kwargs['Item']['id'], status_update['Key']['id'])
+        self.assertEqual({'S': transactions.FAILED}, status_update['ExpressionAttributeValues'][':failed'])
+
+    def test_process_queued_transfer(self, *args, **kwargs):
+        client = mock.Mock()
+        with mock.patch.object(transactions, 'dynamodb', client):
+            transactions.process_queued_transfer(QUEUED_MESSAGE)
+        status_update = client.transact_write_items.call_args.kwargs['TransactItems'][3]['Update']
+        self.assertEqual({'S': transactions.COMPLETED}, status_update['ExpressionAttributeValues'][':completed'])
+        client.update_item.assert_not_called()
+
+    def test_process_queued_transfer_redelivered(self, *args, **kwargs):
+        client = mock.Mock()
+        client.transact_write_items.side_effect = build_cancellation(None, None, None, CONDITION_FAILED)
+        with mock.patch.object(transactions, 'dynamodb', client):
+            transactions.process_queued_transfer(QUEUED_MESSAGE)  # done already, so nothing is raised or changed
+        client.update_item.assert_not_called()
+
+    def test_process_queued_transfer_final_failures(self, *args, **kwargs):
+        for reasons, error in (
+                (({**CONDITION_FAILED, 'Item': build_user_item('a', 5.0)}, None, None, None),
+                 'User a does not have enough balance'),
+                ((None, CONDITION_FAILED, None, None), 'User with id b does not exists')):
+            client = mock.Mock()
+            client.transact_write_items.side_effect = build_cancellation(*reasons)
+            with mock.patch.object(transactions, 'dynamodb', client):
+                transactions.process_queued_transfer(QUEUED_MESSAGE)  # not raised, retrying would not help
+            status_update = client.update_item.call_args.kwargs
+            self.assertEqual({'S': 'queued'}, status_update['Key']['id'])
+            self.assertEqual({'S': transactions.FAILED}, status_update['ExpressionAttributeValues'][':failed'])
+            self.assertEqual({'S': error}, status_update['ExpressionAttributeValues'][':error'])
+
+    @mock.patch('psd_service.transactions.TRANSFER_RETRY_POLICY', NO_RETRY_POLICY)
+    def test_process_queued_transfer_conflict(self, *args, **kwargs):
+        client = mock.Mock()
+        client.transact_write_items.side_effect = build_cancellation(None, {'Code': 'TransactionConflict'}, None, None)
+        with mock.patch.object(transactions, 'dynamodb', client):
+            with self.assertRaises(ConcurrencyException):  # so the message is delivered again
+                transactions.process_queued_transfer(QUEUED_MESSAGE)
+        client.update_item.assert_not_called()
+
+    def test_get_transfer_status(self, *args, **kwargs):
+        transfer_status = TransferStatus(id='queued', state=transactions.QUEUED, srcUserId='a', dstUserId='b',
+                                         amount=10.0, expiresAt=1)
+        client = mock.Mock()
+        client.get_item.return_value = {'Item': transfer_status.to_dynamo()}
+        with mock.patch.object(transactions, 'dynamodb', client):
+            self.assertEqual(transfer_status, transactions.get_transfer_status('queued'))
+        client.query.assert_not_called()
+
+    def test_get_transfer_status_from_ledger(self, *args, **kwargs):
+        client = mock.Mock()
+        client.get_item.return_value = {}  # made synchronously
+        client.query.return_value = {'Count': 1, 'Items': [build_transfer_item('t1', 'a', 'b', '2020-01-01')]}
+        with mock.patch.object(transactions, 'dynamodb', client):
+            transfer_status = transactions.get_transfer_status('t1')
+        self.assertEqual(transactions.COMPLETED, transfer_status.state)
+        self.assertEqual(('t1', 'a', 'b', '2020-01-01'), (transfer_status.id, transfer_status.srcUserId,
+                                                          transfer_status.dstUserId, transfer_status.occurredAtUTC))
+        self.assertEqual(transactions.DYNAMODB_TRANSACTIONS, client.query.call_args.kwargs['TableName'])
+
+    def test_get_transfer_status_not_found(self, *args, **kwargs):
+        client = mock.Mock()
+        client.get_item.return_value = {}
+        client.query.return_value = {'Count': 0, 'Items': []}
+        with mock.patch.object(transactions, 'dynamodb', client):
+            with self.assertRaises(NotFoundException):
+                transactions.get_transfer_status('t1')
+
+    def test_get_user_transfers_pages_across_streams(self, *args, **kwargs):
+        index = FakeTransfersIndex([
+            build_transfer_item('t1', 'a', 'b', '2020-01-01'),
+            build_transfer_item('t2', 'b', 'a', '2020-01-02'),
+            build_transfer_item('t3', 'a', 'c', '2020-01-03'),
+            build_transfer_item('t4', 'c', 'a', '2020-01-04'),
+            build_transfer_item('t5', 'a', 'b', '2020-01-05'),
+            build_transfer_item('t6', 'b', 'c', '2020-01-06'),  # not of `a`
+        ])
+        pages = []
+        cursor = None
+        with mock.patch.object(transactions, 'dynamodb', index):
+            while True:
+                transfers, cursor = transactions.get_user_transfers('a', limit=2, cursor=cursor)
+                pages.append([transfer.id for transfer in transfers])
+                if cursor is None:
+                    break
+        self.assertEqual([['t5', 't4'], ['t3', 't2'], ['t1']], pages)  # newest first, sent and received merged
+
+    def test_get_user_transfers_exhausted_stream(self, *args, **kwargs):
+        index = FakeTransfersIndex([
+            build_transfer_item('t1', 'a', 'b', '2020-01-01'),
+            build_transfer_item('t2', 'b', 'a', '2020-01-02'),
+            build_transfer_item('t3', 'b', 'a', '2020-01-03'),
+            build_transfer_item('t4', 'b', 'a', '2020-01-04'),
+        ])
+        with mock.patch.object(transactions, 'dynamodb', index):
+            transfers, cursor = transactions.get_user_transfers('a', limit=2)
+            self.assertEqual(['t4', 't3'], [transfer.id for transfer in transfers])
+            positions = transactions.decode_user_transfers_cursor(cursor)
+            self.assertIsNone(positions['sent'])  # nothing was taken from it yet
+            self.assertEqual({'S': 't3'}, positions['received']['id'])
+
+            transfers, cursor = transactions.get_user_transfers('a', limit=2, cursor=cursor)
+            self.assertEqual(['t2', 't1'], [transfer.id for transfer in transfers])
+            self.assertIsNone(cursor)
+
+    def test_get_user_transfers_without_limit(self, *args, **kwargs):
+        index = FakeTransfersIndex([build_transfer_item('t1', 'a', 'b', '2020-01-01')])
+        with mock.patch.object(transactions, 'dynamodb', index):
+            transfers, cursor = transactions.get_user_transfers('a', since='2019-01-01', until='2021-01-01')
+        self.assertEqual(['t1'], [transfer.id for transfer in transfers])
+        self.assertIsNone(cursor)
+        self.assertEqual({SRC_INDEX, DST_INDEX}, {call['IndexName'] for call in index.calls})
+        self.assertIn('BETWEEN :since AND :until', index.calls[0]['KeyConditionExpression'])
+
+    def test_decode_user_transfers_cursor_tampered(self, *args, **kwargs):
+        valid_position = {'id': {'S': 't1'}, 'occurredAtUTC': {'S': '2020-01-01'}, 'srcUserId': {'S': 'a'}}
+        self.assertEqual({'sent': valid_position, 'received': None}, transactions.decode_user_transfers_cursor(
+            dynamo_u.encode_cursor({'sent': valid_position, 'received': None})))
+        tampered_positions = [
+            {'other': None},
+            {'sent': 'key'},
+            {'sent': {**valid_position, 'extra': {'S': 'x'}}},
+            {'sent': {**valid_position, 'id': {'N': '1'}}},
+            {'sent': {**valid_position, 'id': 't1'}},
+            {'received': valid_position},  # the received stream is keyed by dstUserId
+        ]
+        for positions in tampered_positions:
+            with self.assertRaises(BadRequestException):
+                transactions.decode_user_transfers_cursor(dynamo_u.encode_cursor(positions))
+        for cursor in ('not base64!', dynamo_u.encode_cursor(['sent'])):
+            with self.assertRaises(BadRequestException):
+                transactions.decode_user_transfers_cursor(cursor)
+
+
+if __name__ == '__main__':
+    unittest.main()
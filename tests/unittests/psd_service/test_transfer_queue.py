@@ -0,0 +1,51 @@
+import shutil
+import tempfile
+import unittest
+
+from psd_service import transfer_queue
+
+
+class TransferQueueTest(unittest.TestCase):
+
+    def setUp(self, *args, **kwargs):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self, *args, **kwargs):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def assert_queue_behaviour(self, queue):
+        for i in range(3):
+            queue.send({'id': i})
+        received = queue.receive(max_messages=2)
+        self.assertEqual([{'id': 0}, {'id': 1}], [message for message, _ in received])
+
+        queue.delete(received[0][1])
+        queue.release(received[1][1])  # comes back first
+        received = queue.receive()
+        self.assertEqual([{'id': 1}, {'id': 2}], [message for message, _ in received])
+        self.assertEqual([], queue.receive())  # in flight messages are not delivered twice
+
+        for _, receipt in received:
+            queue.delete(receipt)
+        self.assertEqual([], queue.receive())
+
+    def test_in_process_queue(self, *args, **kwargs):
+        queue = transfer_queue.InProcessTransferQueue()
+        self.assert_queue_behaviour(queue)
+        self.assertEqual(0, len(queue))
+
+    def test_file_queue(self, *args, **kwargs):
+        self.assert_queue_behaviour(transfer_queue.FileTransferQueue(self.path))
+
+    def test_file_queue_is_shared(self, *args, **kwargs):
+        transfer_queue.FileTransferQueue(self.path).send({'id': 'shared'})
+        other_queue = transfer_queue.FileTransferQueue(self.path)
+        self.assertEqual([{'id': 'shared'}], [message for message, _ in other_queue.receive()])
+
+    def test_build_transfer_queue(self, *args, **kwargs):
+        self.assertIsInstance(transfer_queue.build_transfer_queue('memory'), transfer_queue.InProcessTransferQueue)
+        self.assertRaises(ValueError, transfer_queue.build_transfer_queue, 'unknown')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import json
+import unittest
+from unittest import mock
+
+from psd_service.exceptions import ConcurrencyException
+
+with mock.patch('boto3.client'):  # no client is needed, every test mocks the transfers
+    from psd_service import transfer_queue
+    from psd_service import transfer_worker
+
+
+def build_sqs_event(*messages):
+    return {'Records': [{'messageId': f'message-{message["id"]}', 'body': json.dumps(message)}
+                        for message in messages]}
+
+
+class TransferWorkerTest(unittest.TestCase):
+
+    def setUp(self, *args, **kwargs):
+        self.queue = transfer_queue.InProcessTransferQueue()
+
+    def tearDown(self, *args, **kwargs):
+        pass  # nothing to flush or destroy
+
+    @mock.patch('psd_service.transactions.process_queued_transfer')
+    def test_handler(self, process_queued_transfer, *args, **kwargs):
+        process_queued_transfer.side_effect = [None, ConcurrencyException('Transfer was cancelled'), None]
+        response = transfer_worker.handler(build_sqs_event({'id': 1}, {'id': 2}, {'id': 3}), None)
+        self.assertEqual({'batchItemFailures': [{'itemIdentifier': 'message-2'}]}, response)  # only it comes back
+        self.assertEqual([{'id': 1}, {'id': 2}, {'id': 3}],
+                         [call.args[0] for call in process_queued_transfer.call_args_list])
+
+    @mock.patch('psd_service.transactions.process_queued_transfer')
+    def test_drain_queue(self, process_queued_transfer, *args, **kwargs):
+        for i in range(3):
+            self.queue.send({'id': i})
+        self.assertEqual(3, transfer_worker.drain_queue(self.queue))
+        self.assertEqual(0, len(self.queue))  # processed messages are deleted
+
+    @mock.patch('psd_service.transactions.process_queued_transfer')
+    def test_drain_queue_releases_on_error(self, process_queued_transfer, *args, **kwargs):
+        for i in range(3):
+            self.queue.send({'id': i})
+        process_queued_transfer.side_effect = [None, ConcurrencyException('Transfer was cancelled')]
+        self.assertEqual(1, transfer_worker.drain_queue(self.queue))  # stops at the failed one
+        self.assertEqual([{'id': 1}, {'id': 2}], [message for message, _ in self.queue.receive()])  # released
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+from psd_service.exceptions import ConcurrencyException, NotFoundException
+from psd_service.records import User
+
+with mock.patch('boto3.client'):  # no client is needed, every test mocks the dynamodb calls
+    from psd_service import users
+
+USERNAME = 'someone'
+
+
+def build_user_item(username, **fields):
+    user_id = users.uuid_u.generate_uuid_from_str(username)
+    return User(id=user_id, username=username, passwordHash='hash', salt='salt', balance=10.0, version=1,
+                **fields).to_dynamo()
+
+
+def build_batch_get_item(*user_ids):
+    # answers the keys asked for with the users that exist, as a BatchGetItem would
+    def batch_get_item(RequestItems):
+        table_name, keys_and_attributes = list(RequestItems.items())[0]
+        items = [User(id=key['id']['S'], balance=1.0, version=1).to_dynamo()
+                 for key in keys_and_attributes['Keys'] if key['id']['S'] in user_ids]
+        return {'Responses': {table_name: items}}
+    return batch_get_item
+
+
+NO_DELAY_POLICY = users.retry_u.RetryPolicy(max_attempts=2, base_delay_seconds=0,
+                                            retry_on=(users.retry_u.CONCURRENCY,))
+
+
+def build_shard_page(**shard_balances):
+    # a page of the shards of `user`, keyed as `s<shard>` to be usable as keyword arguments
+    return {'Items': [{'userId': {'S': 'user'}, 'shard': {'N': shard[1:]}, 'balance': {'N': balance}}
+                      for shard, balance in shard_balances.items()]}
+
+
+def build_sweep_cancellation():
+    # the first shard changed since it was read
+    return ClientError({'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+                        'CancellationReasons': [{'Code': 'ConditionalCheckFailed'}, {'Code': 'None'}]},
+                       'TransactWriteItems')
+
+
+class UsersTest(unittest.TestCase):
+
+    def setUp(self, *args, **kwargs):
+        users.user_cache.clear()
+        users.balance_shards.shard_balance_cache.clear()
+
+    def tearDown(self, *args, **kwargs):
+        users.user_cache.clear()
+        users.balance_shards.shard_balance_cache.clear()
+
+    def test_get_user_from_username(self, *args, **kwargs):
+        client = mock.Mock()
+        client.get_item.return_value = {'Item': build_user_item(USERNAME)}
+        with mock.patch.object(users, 'dynamodb', client):
+            user = users.get_user_from_username(USERNAME)
+        self.assertEqual(USERNAME, user.username)
+        self.assertEqual('hash', user.passwordHash)
+        user_id = users.uuid_u.generate_uuid_from_str(USERNAME)
+        self.assertEqual({'S': user_id}, client.get_item.call_args.kwargs['Key']['id'])
+        client.query.assert_not_called()  # the key derived from the username was enough
+
+    def test_get_user_from_username_falls_back_to_index(self, *args, **kwargs):
+        for get_item_response in ({'Item': build_user_item('someone else')}, {}):  # another user, no user
+            client = mock.Mock()
+            client.get_item.return_value = get_item_response
+            client.query.return_value = {'Count': 1, 'Items': [build_user_item(USERNAME)]}
+            with mock.patch.object(users, 'dynamodb', client):
+                user = users.get_user_from_username(USERNAME)
+            self.assertEqual(USERNAME, user.username)
+            self.assertEqual(users.DYNAMODB_USERS_USERNAME_INDEX, client.query.call_args.kwargs['IndexName'])
+            self.assertEqual({':username': {'S': USERNAME}},
+                             client.query.call_args.kwargs['ExpressionAttributeValues'])
+
+    def test_get_user_from_username_not_found(self, *args, **kwargs):
+        client = mock.Mock()
+        client.get_item.return_value = {}
+        client.query.return_value = {'Count': 0, 'Items': []}
+        with mock.patch.object(users, 'dynamodb', client):
+            with self.assertRaises(NotFoundException) as context:
+                users.get_user_from_username(USERNAME)
+        self.assertEqual(f'User with username {USERNAME} does not exists', str(context.exception))
+
+    def test_get_user_from_id_is_cached(self, *args, **kwargs):
+        client = mock.Mock()
+        client.get_item.return_value = {'Item': build_user_item(USERNAME)}
+        user_id = users.uuid_u.generate_uuid_from_str(USERNAME)
+        with mock.patch.object(users, 'dynamodb', client):
+            first_user = users.get_user_from_id(user_id)
+            second_user = users.get_user_from_id(user_id)
+        self.assertEqual(first_user, second_user)
+        self.assertEqual(1, client.get_item.call_count)  # the second read is a hit
+        self.assertFalse(second_user.has('passwordHash'))  # only public fields are kept in memory
+
+    def test_get_user_from_id_bypasses_the_cache(self, *args, **kwargs):
+        client = mock.Mock()
+        client.get_item.return_value = {'Item': build_user_item(USERNAME)}
+        user_id = users.uuid_u.generate_uuid_from_str(USERNAME)
+        with mock.patch.object(users, 'dynamodb', client):
+            users.get_user_from_id(user_id)
+            users.get_user_from_id(user_id, consistent_read=True)
+            self.assertTrue(client.get_item.call_args.kwargs['ConsistentRead'])
+            user = users.get_user_from_id(user_id, get_sensitive_info=True)
+        self.assertEqual(3, client.get_item.call_count)
+        self.assertEqual('hash', user.passwordHash)
+        self.assertFalse(users.user_cache.get(user_id).has('passwordHash'))  # sensitive reads are never cached
+
+    def test_invalidate_cached_users(self, *args, **kwargs):
+        users.cache_user(User(id='a', balance=1.0, version=1))
+        users.cache_user(User(id='b', balance=1.0, version=1))
+        users.invalidate_cached_users(['a'])
+        self.assertIsNone(users.user_cache.get('a'))
+        self.assertIsNotNone(users.user_cache.get('b'))
+
+    def test_get_users_by_ids(self, *args, **kwargs):
+        users.cache_user(User(id='cached', balance=2.0, version=1))
+        client = mock.Mock()
+        client.batch_get_item.side_effect = build_batch_get_item('a', 'b')
+        with mock.patch.object(users, 'dynamodb', client):
+            found_users = users.get_users_by_ids(['cached', 'a', 'b', 'missing', 'a'])
+        self.assertEqual({'cached', 'a', 'b'}, set(found_users.keys()))  # missing users are left out
+        self.assertEqual(2.0, found_users['cached'].balance)
+        keys = client.batch_get_item.call_args.kwargs['RequestItems'][users.DYNAMODB_USERS]['Keys']
+        self.assertEqual(['a', 'b', 'missing'], [key['id']['S'] for key in keys])  # the cached one is not read
+        self.assertIsNotNone(users.user_cache.get('a'))  # read users are cached
+
+        client.batch_get_item.reset_mock()
+        with mock.patch.object(users, 'dynamodb', client):
+            users.get_users_by_ids(['cached', 'a'])
+        client.batch_get_item.assert_not_called()
+
+    def test_get_users_by_ids_consistent_read(self, *args, **kwargs):
+        users.cache_user(User(id='a', balance=2.0, version=1))
+        client = mock.Mock()
+        client.batch_get_item.side_effect = build_batch_get_item('a')
+        with mock.patch.object(users, 'dynamodb', client):
+            found_users = users.get_users_by_ids(['a'], consistent_read=True)
+        self.assertEqual(1.0, found_users['a'].balance)  # read again, not served from memory
+        keys_and_attributes = client.batch_get_item.call_args.kwargs['RequestItems'][users.DYNAMODB_USERS]
+        self.assertTrue(keys_and_attributes['ConsistentRead'])
+
+    def test_get_users_by_ids_in_batches(self, *args, **kwargs):
+        user_ids = [f'user-{i}' for i in range(users.dynamo_u.BATCH_GET_SIZE + 1)]
+        client = mock.Mock()
+        client.batch_get_item.side_effect = build_batch_get_item(*user_ids)
+        with mock.patch.object(users, 'dynamodb', client):
+            found_users = users.get_users_by_ids(user_ids)
+        self.assertEqual(len(user_ids), len(found_users))
+        self.assertEqual([users.dynamo_u.BATCH_GET_SIZE, 1],
+                         [len(call.kwargs['RequestItems'][users.DYNAMODB_USERS]['Keys'])
+                          for call in client.batch_get_item.call_args_list])  # BatchGetItem reads 100 keys at most
+
+    def test_build_user_update(self, *args, **kwargs):
+        update = users.build_user_update('user', set_values={'name': 'Some Name'},
+                                         add_values={'balance': 10.5, 'version': 1})
+        self.assertEqual({'id': {'S': 'user'}}, update['Key'])
+        self.assertEqual('SET #s0 = :s0 ADD #a0 :a0, #a1 :a1', update['UpdateExpression'])
+        self.assertEqual({'#s0': 'name', '#a0': 'balance', '#a1': 'version'}, update['ExpressionAttributeNames'])
+        self.assertEqual({':s0': {'S': 'Some Name'}, ':a0': {'N': '10.5'}, ':a1': {'N': '1'}},
+                         update['ExpressionAttributeValues'])
+        self.assertNotIn('ConditionExpression', update)
+        self.assertNotIn('ReturnValuesOnConditionCheckFailure', update)
+
+    def test_build_user_update_with_condition(self, *args, **kwargs):
+        update = users.build_user_update('user', set_values={'balanceShards': 4},
+                                         condition_expression='version = :version', condition_values={':version': 3},
+                                         return_old_on_failure=True)
+        self.assertEqual('SET #s0 = :s0', update['UpdateExpression'])
+        self.assertEqual('version = :version', update['ConditionExpression'])
+        self.assertEqual({':s0': {'N': '4'}, ':version': {'N': '3'}}, update['ExpressionAttributeValues'])
+        self.assertEqual('ALL_OLD', update['ReturnValuesOnConditionCheckFailure'])
+
+    def test_build_balance_update_debit(self, *args, **kwargs):
+        update = users.build_balance_update('user', -5.0)
+        self.assertEqual('ADD #a0 :a0, #a1 :a1', update['UpdateExpression'])
+        self.assertEqual({'#a0': 'balance', '#a1': 'version'}, update['ExpressionAttributeNames'])
+        self.assertEqual('balance >= :needed', update['ConditionExpression'])
+        self.assertEqual({':a0': {'N': '-5.0'}, ':a1': {'N': '1'}, ':needed': {'N': '5.0'}},
+                         update['ExpressionAttributeValues'])
+        self.assertEqual('ALL_OLD', update['ReturnValuesOnConditionCheckFailure'])  # tells missing from poor apart
+
+    def test_build_balance_update_credit(self, *args, **kwargs):
+        update = users.build_balance_update('user', 5.0)
+        self.assertEqual('attribute_exists(id) AND attribute_not_exists(balanceShards)', update['ConditionExpression'])
+        self.assertEqual({':a0': {'N': '5.0'}, ':a1': {'N': '1'}}, update['ExpressionAttributeValues'])
+        self.assertEqual('ALL_OLD', update['ReturnValuesOnConditionCheckFailure'])  # tells sharded from missing apart
+
+    def test_sweep_balance_shards(self, *args, **kwargs):
+        shards_client, users_client = mock.Mock(), mock.Mock()
+        shards_client.query.return_value = build_shard_page(s0='10.5', s1='0', s2='0.25')
+        users.balance_shards.shard_balance_cache.put('user', 99.0)
+        with mock.patch.object(users.balance_shards, 'dynamodb', shards_client), \
+                mock.patch.object(users, 'dynamodb', users_client):
+            self.assertTrue(users.sweep_balance_shards('user'))
+        self.assertTrue(shards_client.query.call_args.kwargs['ConsistentRead'])
+        transact_items = users_client.transact_write_items.call_args.kwargs['TransactItems']
+        self.assertEqual(['0', '2'], [item['Update']['Key']['shard']['N'] for item in transact_items[:2]])
+        main_update = transact_items[2]['Update']
+        self.assertEqual({'S': 'user'}, main_update['Key']['id'])
+        self.assertEqual({':a0': {'N': '10.75'}, ':a1': {'N': '1'}}, main_update['ExpressionAttributeValues'])
+        self.assertIsNone(users.balance_shards.shard_balance_cache.get('user'))  # the shards were emptied
+
+    def test_sweep_balance_shards_empty(self, *args, **kwargs):
+        shards_client, users_client = mock.Mock(), mock.Mock()
+        shards_client.query.return_value = build_shard_page(s0='0')
+        with mock.patch.object(users.balance_shards, 'dynamodb', shards_client), \
+                mock.patch.object(users, 'dynamodb', users_client):
+            self.assertFalse(users.sweep_balance_shards('user'))
+        users_client.transact_write_items.assert_not_called()
+
+    @mock.patch('psd_service.users.SWEEP_RETRY_POLICY', NO_DELAY_POLICY)
+    def test_sweep_balance_shards_concurrent_credit(self, *args, **kwargs):
+        shards_client, users_client = mock.Mock(), mock.Mock()
+        shards_client.query.side_effect = [build_shard_page(s0='10'), build_shard_page(s0='12')]
+        users_client.transact_write_items.side_effect = [build_sweep_cancellation(), None]
+        with mock.patch.object(users.balance_shards, 'dynamodb', shards_client), \
+                mock.patch.object(users, 'dynamodb', users_client):
+            self.assertTrue(users.sweep_balance_shards('user'))
+        main_update = users_client.transact_write_items.call_args.kwargs['TransactItems'][1]['Update']
+        self.assertEqual({'N': '12.0'}, main_update['ExpressionAttributeValues'][':a0'])  # the shards are read again
+
+    @mock.patch('psd_service.users.SWEEP_RETRY_POLICY', NO_DELAY_POLICY)
+    def test_sweep_balance_shards_keeps_being_cancelled(self, *args, **kwargs):
+        shards_client, users_client = mock.Mock(), mock.Mock()
+        shards_client.query.return_value = build_shard_page(s0='10')
+        users_client.transact_write_items.side_effect = build_sweep_cancellation()
+        with mock.patch.object(users.balance_shards, 'dynamodb', shards_client), \
+                mock.patch.object(users, 'dynamodb', users_client):
+            with self.assertRaises(ConcurrencyException):
+                users.sweep_balance_shards('user')
+        self.assertEqual(2, users_client.transact_write_items.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+
+from psd_service import utils_cache as cache_u
+
+
+class MockedClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self, *args, **kwargs):
+        return self.now
+
+
+class UtilsCacheTest(unittest.TestCase):
+
+    def setUp(self, *args, **kwargs):
+        self.clock = MockedClock()
+
+    def tearDown(self, *args, **kwargs):
+        pass  # nothing to flush or destroy
+
+    def test_get_and_put(self, *args, **kwargs):
+        cache = cache_u.LRUCache(max_size=2, ttl_seconds=10, clock=self.clock)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual({'size': 1, 'max_size': 2, 'hits': 1, 'misses': 1, 'evictions': 0}, cache.get_stats())
+
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1)
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
+
+    def test_lru_eviction(self, *args, **kwargs):
+        cache = cache_u.LRUCache(max_size=2, ttl_seconds=10, clock=self.clock)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')  # b is now the least recently used
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(1, cache.get_stats()['evictions'])
+
+    def test_ttl(self, *args, **kwargs):
+        cache = cache_u.LRUCache(max_size=2, ttl_seconds=10, clock=self.clock)
+        cache.put('a', 1, version=1)
+        self.clock.now = 9.9
+        self.assertEqual(1, cache.get('a'))
+        self.clock.now = 10
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.get_version('a'))
+        self.assertEqual(0, cache.get_stats()['size'])
+
+    def test_versions(self, *args, **kwargs):
+        cache = cache_u.LRUCache(max_size=2, ttl_seconds=10, clock=self.clock)
+        self.assertTrue(cache.put('a', 'v2', version=2))
+        self.assertFalse(cache.put('a', 'v1', version=1))
+        self.assertEqual('v2', cache.get('a'))
+        self.assertEqual(2, cache.get_version('a'))
+        self.assertTrue(cache.put('a', 'v3', version=3))
+        self.assertEqual('v3', cache.get('a'))
+        self.assertTrue(cache.put('a', 'unversioned'))
+        self.assertEqual('unversioned', cache.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
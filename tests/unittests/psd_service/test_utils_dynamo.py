@@ -4,7 +4,7 @@ from unittest import mock
 
 from botocore.exceptions import ClientError
 
-from psd_service.exceptions import CannotSaveException, NotFoundException
+from psd_service.exceptions import CannotSaveException, NotFoundException, BadRequestException
 
 GLOBAL_MOCKED_KWARGS = {}
 
@@ -102,6 +102,32 @@ class UtilsDynamoTest(unittest.TestCase):
         item = dynamo_u.decode_item_from_dynamo(dynamo_item)
         self.assertEqual(expected_item, item)
 
+    def test_encode_and_decode_nested_item(self, *args, **kwargs):
+        item = {
+            'list': [1, 0.1, 'a', None, True],
+            'map': {'decimal': Decimal('2.5'), 'small': 1e-07, 'empty': {}},
+        }
+        expected_dynamo_item = {
+            'list': {'L': [{'N': '1'}, {'N': '0.1'}, {'S': 'a'}, {'NULL': True}, {'BOOL': True}]},
+            'map': {'M': {'decimal': {'N': '2.5'}, 'small': {'N': '1E-7'}, 'empty': {'M': {}}}}
+        }
+        expected_item = {
+            'list': [1.0, 0.1, 'a', None, True],
+            'map': {'decimal': 2.5, 'small': 1e-07, 'empty': {}},
+        }
+        dynamo_item = dynamo_u.encode_item_for_dynamo(item)
+        self.assertEqual(expected_dynamo_item, dynamo_item)
+        decoded_item = dynamo_u.decode_item_from_dynamo(dynamo_item)
+        self.assertEqual(expected_item, decoded_item)
+        self.assertTrue(type(decoded_item['list'][0]) is float)
+
+    def test_encode_item_for_dynamo_when_fail(self, *args, **kwargs):
+        self.assertRaises(TypeError, dynamo_u.encode_item_for_dynamo, {'field': float('nan')})
+        self.assertRaises(TypeError, dynamo_u.encode_item_for_dynamo, {'field': 1e200})
+        self.assertRaises(TypeError, dynamo_u.encode_item_for_dynamo, {'field': 10 ** 40})
+        self.assertRaises(TypeError, dynamo_u.encode_item_for_dynamo, {'field': object()})
+        self.assertRaises(TypeError, dynamo_u.decode_item_from_dynamo, {'field': {'B': b'bytes'}})
+
     def test_assert_valid_dynamo_put_response(self, *args, **kwargs):
         good_response = {'ResponseMetadata': {'HTTPStatusCode': 200}}
         bad_response_0 = {'ResponseMetadata': {'HTTPStatusCode': 400}}
@@ -155,6 +181,120 @@ class UtilsDynamoTest(unittest.TestCase):
         self.assertTrue(expected_object_2_float, item_3)
         self.assertTrue(type(item_3['Value']) is float)
 
+    @mock.patch('time.sleep')
+    def test_batch_write_items(self, *args, **kwargs):
+        items = [{'id': str(i)} for i in range(30)]
+        client = mock.MagicMock()
+        unprocessed = {'table': [{'PutRequest': {'Item': {'id': {'S': '0'}}}}]}
+        client.batch_write_item.side_effect = [{'UnprocessedItems': unprocessed}, {'UnprocessedItems': {}}, {}]
+        dynamo_u.batch_write_items(client, 'table', items)
+        self.assertEqual(3, client.batch_write_item.call_count)
+        self.assertEqual(25, len(client.batch_write_item.call_args_list[0][1]['RequestItems']['table']))
+        self.assertEqual(unprocessed, client.batch_write_item.call_args_list[1][1]['RequestItems'])
+        self.assertEqual(5, len(client.batch_write_item.call_args_list[2][1]['RequestItems']['table']))
+
+    @mock.patch('time.sleep')
+    def test_batch_write_items_when_fail(self, *args, **kwargs):
+        client = mock.MagicMock()
+        unprocessed = {'table': [{'PutRequest': {'Item': {'id': {'S': '0'}}}}]}
+        client.batch_write_item.return_value = {'UnprocessedItems': unprocessed}
+        self.assertRaises(CannotSaveException, dynamo_u.batch_write_items, client, 'table', [{'id': '0'}])
+        self.assertEqual(dynamo_u.BATCH_ATTEMPTS, client.batch_write_item.call_count)
+
+    def test_build_projection_expression(self, *args, **kwargs):
+        projection_expression, expression_attribute_names = dynamo_u.build_projection_expression(('id', 'name'))
+        self.assertEqual('#p0, #p1', projection_expression)
+        self.assertEqual({'#p0': 'id', '#p1': 'name'}, expression_attribute_names)
+
+    @mock.patch('time.sleep')
+    def test_batch_get_items(self, *args, **kwargs):
+        keys = [{'id': {'S': str(i)}} for i in range(101)]
+        client = mock.MagicMock()
+        unprocessed = {'table': {'Keys': [{'id': {'S': '1'}}]}}
+        client.batch_get_item.side_effect = [
+            {'Responses': {'table': [{'id': {'S': '0'}}]}, 'UnprocessedKeys': unprocessed},
+            {'Responses': {'table': [{'id': {'S': '1'}}]}, 'UnprocessedKeys': {}},
+            {'Responses': {'table': [{'id': {'S': '100'}}]}}
+        ]
+        items = dynamo_u.batch_get_items(client, 'table', keys, projection_expression='#p0',
+                                         expression_attribute_names={'#p0': 'id'})
+        self.assertEqual([{'id': '0'}, {'id': '1'}, {'id': '100'}], items)
+        first_request = client.batch_get_item.call_args_list[0][1]['RequestItems']['table']
+        self.assertEqual(100, len(first_request['Keys']))
+        self.assertEqual('#p0', first_request['ProjectionExpression'])
+        self.assertEqual(unprocessed, client.batch_get_item.call_args_list[1][1]['RequestItems'])
+
+        client.batch_get_item.side_effect = None
+        client.batch_get_item.return_value = {'Responses': {}, 'UnprocessedKeys': unprocessed}
+        self.assertRaises(Exception, dynamo_u.batch_get_items, client, 'table', keys[:1])
+
+    def test_iterate_scan_pages(self, *args, **kwargs):
+        pages = [
+            {'Items': [{'id': {'S': '1'}}], 'LastEvaluatedKey': {'id': {'S': '1'}}},
+            {'Items': [{'id': {'S': '2'}}], 'LastEvaluatedKey': {'id': {'S': '2'}}},
+            {'Items': []},
+        ]
+        client = mock.MagicMock()
+        client.scan.side_effect = pages
+        scanned_pages = list(dynamo_u.iterate_scan_pages(client, TableName='table'))
+        self.assertEqual(pages, scanned_pages)
+        self.assertEqual(3, client.scan.call_count)
+        self.assertNotIn('ExclusiveStartKey', client.scan.call_args_list[0][1])
+        self.assertEqual({'id': {'S': '2'}}, client.scan.call_args_list[2][1]['ExclusiveStartKey'])
+
+    def test_iterate_query_pages(self, *args, **kwargs):
+        pages = [
+            {'Items': [{'id': {'S': '1'}}], 'LastEvaluatedKey': {'id': {'S': '1'}}},
+            {'Items': [{'id': {'S': '2'}}]},
+        ]
+        client = mock.MagicMock()
+        client.query.side_effect = pages
+        queried_pages = list(dynamo_u.iterate_query_pages(client, TableName='table', IndexName='index'))
+        self.assertEqual(pages, queried_pages)
+        self.assertEqual('index', client.query.call_args_list[1][1]['IndexName'])
+        self.assertEqual({'id': {'S': '1'}}, client.query.call_args_list[1][1]['ExclusiveStartKey'])
+
+    def test_parallel_scan(self, *args, **kwargs):
+        def scan(**scan_kwargs):
+            segment = scan_kwargs['Segment']
+            self.assertEqual(3, scan_kwargs['TotalSegments'])
+            self.assertEqual('id', scan_kwargs['ProjectionExpression'])
+            if 'ExclusiveStartKey' not in scan_kwargs:
+                return {'Items': [{'id': {'S': f'{segment}-0'}}], 'LastEvaluatedKey': {'id': {'S': f'{segment}-0'}}}
+            return {'Items': [{'id': {'S': f'{segment}-1'}}]}
+
+        client = mock.MagicMock()
+        client.scan.side_effect = scan
+        items = list(dynamo_u.parallel_scan(client, 'table', total_segments=3, projection_expression='id'))
+        expected_items = [{'id': f'{segment}-{page}'} for segment in range(3) for page in range(2)]
+        self.assertEqual(6, client.scan.call_count)
+        self.assertEqual(sorted(expected_items, key=lambda i: i['id']), sorted(items, key=lambda i: i['id']))
+
+        client.scan.side_effect = [{'Items': [{'id': {'S': '0'}}]}]
+        items = list(dynamo_u.parallel_scan(client, 'table', total_segments=1, decode=False))
+        self.assertEqual([{'id': {'S': '0'}}], items)
+
+    def test_parallel_scan_when_fail(self, *args, **kwargs):
+        client = mock.MagicMock()
+        client.scan.side_effect = ClientError({'Error': {'Code': 'ResourceNotFoundException'}}, 'scan')
+        self.assertRaises(ClientError, list, dynamo_u.parallel_scan(client, 'table', total_segments=2))
+
+    def test_encode_and_decode_cursor(self, *args, **kwargs):
+        last_evaluated_key = {'id': {'S': '4af4de19-255d-447a-bccd-a1dd34ca7ef6'}}
+        cursor = dynamo_u.encode_cursor(last_evaluated_key)
+        self.assertIsInstance(cursor, str)
+        self.assertEqual(last_evaluated_key, dynamo_u.decode_cursor(cursor))
+        self.assertEqual(last_evaluated_key, dynamo_u.decode_cursor(cursor, key_names=('id',)))
+        self.assertIsNone(dynamo_u.encode_cursor(None))
+        self.assertIsNone(dynamo_u.decode_cursor(None))
+
+        self.assertRaises(BadRequestException, dynamo_u.decode_cursor, cursor, key_names=('id', 'occurredAtUTC'))
+        self.assertRaises(BadRequestException, dynamo_u.decode_cursor, 'not a cursor')
+        self.assertRaises(BadRequestException, dynamo_u.decode_cursor, dynamo_u.encode_cursor(['a list']))
+        for key_value in ('abc', {'S': 1}, {'S': 'abc', 'N': '1'}, {'X': 'abc'}, None):  # not as sent to dynamo
+            self.assertRaises(BadRequestException, dynamo_u.decode_cursor, dynamo_u.encode_cursor({'id': key_value}),
+                              key_names=('id',))
+
 
 if __name__ == '__main__':
     unittest.main()
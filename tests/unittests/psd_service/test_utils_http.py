@@ -1,8 +1,14 @@
+import gzip
+import io
 import json
 import unittest
+import zlib
+from unittest import mock
+
+from flask import Flask
 
 from psd_service import utils_http as http_u
-from psd_service.exceptions import BadRequestException
+from psd_service.exceptions import BadRequestException, PayloadTooLargeException
 
 
 class MockedHttpResponse(object):
@@ -43,7 +49,8 @@ class UtilsHTTPTest(unittest.TestCase):
         expected_body = '{"message": "this is a test"}'
         expected_headers['Content-Type'] = 'application/json'
         expected_headers['Content-Length'] = '29'
-        res = http_u.generate_response(400, json_body)
+        with mock.patch.object(http_u, 'JSON_BACKEND', 'json'):
+            res = http_u.generate_response(400, json_body)
         self.assertEqual(400, res.status_code)
         self.assertEqual(expected_headers, dict(res.headers))
         self.assertEqual('application/json', res.mimetype)
@@ -154,6 +161,210 @@ class UtilsHTTPTest(unittest.TestCase):
 
         self.assertRaises(Exception, http_u.parse_http_response_to_json, MockedHttpResponse(400))
 
+    def test_generate_streamed_json_response(self, *args, **kwargs):
+        items = (f'item {i}' for i in range(3))
+        res = http_u.generate_streamed_json_response(200, 'items', items, json_body={'cursor': None})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual('application/json', res.mimetype)
+        self.assertTrue(res.is_streamed)
+        self.assertEqual({'items': ['item 0', 'item 1', 'item 2'], 'cursor': None}, json.loads(res.get_data()))
+
+        res = http_u.generate_streamed_json_response(200, 'items', iter([]))
+        self.assertEqual({'items': []}, json.loads(res.get_data()))
+
+    def test_get_int_query_param(self, *args, **kwargs):
+        query_params = {'limit': '10', 'bad': 'ten'}
+        self.assertEqual(10, http_u.get_int_query_param(query_params, 'limit'))
+        self.assertEqual(10, http_u.get_int_query_param(query_params, 'limit', min_value=1, max_value=10))
+        self.assertEqual(5, http_u.get_int_query_param(query_params, 'missing', default=5))
+        self.assertIsNone(http_u.get_int_query_param(query_params, 'missing'))
+        self.assertRaises(BadRequestException, http_u.get_int_query_param, query_params, 'bad')
+        self.assertRaises(BadRequestException, http_u.get_int_query_param, query_params, 'limit', min_value=11)
+        self.assertRaises(BadRequestException, http_u.get_int_query_param, query_params, 'limit', max_value=9)
+
+    def test_get_datetime_query_param(self, *args, **kwargs):
+        query_params = {'naive': '2022-02-10T10:00:00', 'utc': '2022-02-10T10:00:00Z',
+                        'offset': '2022-02-10T07:00:00-03:00', 'bad': 'yesterday'}
+        self.assertEqual('2022-02-10T10:00:00', http_u.get_datetime_query_param(query_params, 'naive'))
+        self.assertEqual('2022-02-10T10:00:00', http_u.get_datetime_query_param(query_params, 'utc'))
+        self.assertEqual('2022-02-10T10:00:00', http_u.get_datetime_query_param(query_params, 'offset'))
+        self.assertIsNone(http_u.get_datetime_query_param(query_params, 'missing'))
+        self.assertRaises(BadRequestException, http_u.get_datetime_query_param, query_params, 'bad')
+
+    def test_get_fields_query_param(self, *args, **kwargs):
+        allowed_fields = ('id', 'name', 'balance')
+        query_params = {'fields': 'name, balance,name', 'empty': '', 'unknown': 'name,salt'}
+        self.assertEqual(('name', 'balance'), http_u.get_fields_query_param(query_params, allowed_fields))
+        self.assertIsNone(http_u.get_fields_query_param(query_params, allowed_fields, name='missing'))
+        self.assertRaises(BadRequestException, http_u.get_fields_query_param, query_params, allowed_fields,
+                          name='empty')
+        self.assertRaises(BadRequestException, http_u.get_fields_query_param, query_params, allowed_fields,
+                          name='unknown')
+
+    def test_get_bool_query_param(self, *args, **kwargs):
+        query_params = {'yes': 'True', 'one': '1', 'no': 'false'}
+        self.assertTrue(http_u.get_bool_query_param(query_params, 'yes'))
+        self.assertTrue(http_u.get_bool_query_param(query_params, 'one'))
+        self.assertFalse(http_u.get_bool_query_param(query_params, 'no'))
+        self.assertFalse(http_u.get_bool_query_param(query_params, 'missing'))
+        self.assertTrue(http_u.get_bool_query_param(query_params, 'missing', default=True))
+
+    def test_prefers_async_response(self, *args, **kwargs):
+        self.assertTrue(http_u.prefers_async_response({'Prefer': 'respond-async'}))
+        self.assertTrue(http_u.prefers_async_response({'Prefer': 'return=minimal, Respond-Async; wait=10'}))
+        self.assertFalse(http_u.prefers_async_response({'Prefer': 'return=minimal'}))
+        self.assertFalse(http_u.prefers_async_response({}))
+
+    def test_generate_streamed_ndjson_response(self, *args, **kwargs):
+        app = Flask(__name__)
+        items = ['a', {'line': 2, 'error': 'bad'}] + [f'item {i}' for i in range(5000)]
+        with app.test_request_context():
+            res = http_u.generate_streamed_ndjson_response(200, iter(items))
+            chunks = list(res.response)
+        self.assertEqual('application/x-ndjson', res.mimetype)
+        self.assertGreater(len(chunks), 1)  # sent while the items are consumed
+        self.assertEqual(items, [json.loads(line) for line in ''.join(chunks).splitlines()])
+        with app.test_request_context():
+            self.assertEqual([], list(http_u.generate_streamed_ndjson_response(200, iter([])).response))
+
+    def test_read_request_body(self, *args, **kwargs):
+        app = Flask(__name__)
+        with app.test_request_context(method='POST', data=b'0123456789'):
+            self.assertEqual(b'0123456789', http_u.read_request_body(10))
+        with app.test_request_context(method='POST', data=b'0123456789'):
+            self.assertRaises(PayloadTooLargeException, http_u.read_request_body, 9)
+        with app.test_request_context(method='POST', input_stream=io.BytesIO(b'0123456789'),
+                                      environ_base={'wsgi.input_terminated': True}):  # chunked, no length
+            self.assertRaises(PayloadTooLargeException, http_u.read_request_body, 9)
+
+    def test_is_not_modified(self, *args, **kwargs):
+        self.assertTrue(http_u.is_not_modified({'If-None-Match': 'W/"3"'}, etag='3'))
+        self.assertTrue(http_u.is_not_modified({'If-None-Match': '"2", W/"3"'}, etag='3'))
+        self.assertTrue(http_u.is_not_modified({'If-None-Match': '*'}, etag='3'))
+        self.assertFalse(http_u.is_not_modified({'If-None-Match': 'W/"2"'}, etag='3'))
+        self.assertFalse(http_u.is_not_modified({'If-None-Match': 'W/"2"'}))
+        self.assertFalse(http_u.is_not_modified({}, etag='3'))
+
+        last_modified = '2015-10-21T07:28:00.250000'
+        self.assertTrue(http_u.is_not_modified({'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'},
+                                               last_modified=last_modified))
+        self.assertFalse(http_u.is_not_modified({'If-Modified-Since': 'Wed, 21 Oct 2015 07:27:59 GMT'},
+                                                last_modified=last_modified))
+        self.assertFalse(http_u.is_not_modified({'If-Modified-Since': 'not a date'}, last_modified=last_modified))
+        self.assertFalse(http_u.is_not_modified({'If-None-Match': 'W/"2"',
+                                                 'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'},
+                                                etag='3', last_modified=last_modified))  # the etag wins
+
+    def test_compute_etag(self, *args, **kwargs):
+        page = {'transactions': [{'id': 't1', 'amount': 1.5}, {'id': 't2', 'amount': 2.0}], 'cursor': 'abc'}
+        self.assertEqual(http_u.compute_etag(page), http_u.compute_etag(
+            {'cursor': 'abc', 'transactions': [{'amount': 1.5, 'id': 't1'}, {'amount': 2.0, 'id': 't2'}]}))
+        self.assertNotEqual(http_u.compute_etag(page), http_u.compute_etag({**page, 'cursor': None}))
+        self.assertNotEqual(http_u.compute_etag(page), http_u.compute_etag(
+            {**page, 'transactions': page['transactions'][:1]}))  # a page the indices had not caught up with
+
+    def test_generate_not_modified_response(self, *args, **kwargs):
+        res = http_u.generate_not_modified_response(etag='3', last_modified='2015-10-21T07:28:00')
+        self.assertEqual(304, res.status_code)
+        self.assertEqual(b'', res.data)
+        self.assertEqual('W/"3"', res.headers['ETag'])
+        self.assertEqual('Wed, 21 Oct 2015 07:28:00 GMT', res.headers['Last-Modified'])
+        self.assertEqual('*', res.headers['Access-Control-Allow-Origin'])
+
+        res = http_u.add_validators(http_u.generate_ok_response(msg='ok'), etag='4')
+        self.assertEqual('W/"4"', res.headers['ETag'])
+        self.assertNotIn('Last-Modified', res.headers)
+
+    def test_encode_json(self, *args, **kwargs):
+        body = {'ids': ['a', 'b'], 'amount': 1.5, 1: None}
+        with mock.patch.object(http_u, 'JSON_BACKEND', 'json'):
+            self.assertEqual(json.loads(json.dumps(body)), json.loads(http_u.encode_json(body)))
+        if http_u.orjson is not None:
+            with mock.patch.object(http_u, 'JSON_BACKEND', 'orjson'):
+                self.assertEqual(json.loads(json.dumps(body)), json.loads(http_u.encode_json(body)))
+
+    def test_negotiate_encoding(self, *args, **kwargs):
+        self.assertEqual('gzip', http_u.negotiate_encoding('gzip, deflate, br'))
+        self.assertEqual('deflate', http_u.negotiate_encoding('gzip;q=0.5, deflate'))
+        self.assertEqual('deflate', http_u.negotiate_encoding('gzip;q=0, *'))
+        self.assertEqual('gzip', http_u.negotiate_encoding('*'))
+        self.assertIsNone(http_u.negotiate_encoding('br, identity'))
+        self.assertIsNone(http_u.negotiate_encoding('gzip;q=0'))
+        self.assertIsNone(http_u.negotiate_encoding(None))
+
+    def test_generate_compressed_response(self, *args, **kwargs):
+        app = Flask(__name__)
+        body = {'ids': [f'id-{i}' for i in range(1000)]}
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            res = http_u.generate_response(200, body)
+        self.assertEqual('gzip', res.headers['Content-Encoding'])
+        self.assertEqual('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(body, json.loads(gzip.decompress(res.data)))
+        self.assertEqual(json.dumps(body), json.dumps(json.loads(http_u.get_uncompressed_text(res))))
+
+        with app.test_request_context(headers={'Accept-Encoding': 'deflate'}):
+            res = http_u.generate_response(200, body)
+        self.assertEqual(body, json.loads(zlib.decompress(res.data)))
+
+        with app.test_request_context():
+            res = http_u.generate_response(200, body)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual('Accept-Encoding', res.headers['Vary'])
+
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            res = http_u.generate_response(200, {'message': 'small'})
+        self.assertNotIn('Content-Encoding', res.headers)  # below the threshold
+        self.assertNotIn('Vary', res.headers)
+
+    def test_generate_compressed_streamed_json_response(self, *args, **kwargs):
+        app = Flask(__name__)
+        items = [{'id': i} for i in range(5000)]
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            res = http_u.generate_streamed_json_response(200, 'items', iter(items), json_body={'cursor': None})
+            data = b''.join(res.response)
+        self.assertEqual('gzip', res.headers['Content-Encoding'])
+        self.assertEqual({'items': items, 'cursor': None}, json.loads(gzip.decompress(data)))
+
+    def test_build_http_session(self, *args, **kwargs):
+        session = http_u.build_http_session()
+        adapter = session.get_adapter('https://example.com')
+        self.assertIs(adapter, session.get_adapter('http://example.com'))
+        self.assertEqual(http_u.HTTP_MAX_RETRIES, adapter.max_retries.total)
+        self.assertIn('GET', adapter.max_retries.allowed_methods)
+        self.assertNotIn('POST', adapter.max_retries.allowed_methods)  # never retries what may not be idempotent
+        with mock.patch.object(http_u, 'http_session', None):
+            self.assertIs(http_u.get_http_session(), http_u.get_http_session())
+
+    def test_get_http_timeout(self, *args, **kwargs):
+        self.assertEqual((http_u.HTTP_CONNECT_TIMEOUT_SECONDS, http_u.HTTP_READ_TIMEOUT_SECONDS),
+                         http_u.get_http_timeout())
+        self.assertEqual((2, 2), http_u.get_http_timeout(2))
+        with mock.patch.object(http_u.retry_u, 'get_remaining_seconds', return_value=1.5):
+            self.assertEqual((1, 1.5 - http_u.retry_u.DEADLINE_MARGIN_SECONDS), http_u.get_http_timeout((1, 5)))
+
+    def test_http_request(self, *args, **kwargs):
+        session = mock.Mock()
+        session.request.side_effect = [MockedHttpResponse(200), MockedHttpResponse(503), ConnectionError('reset')]
+        http_u.reset_http_stats()
+        try:
+            with mock.patch.object(http_u, 'http_session', session):
+                response = http_u.http_get('https://example.com/path?q=1', bearer_token='token', timeout=1,
+                                           headers={'Accept': 'application/json'}, params={'a': 'b'})
+                self.assertEqual(200, response.status_code)
+                http_u.http_request('PUT', 'https://example.com/other')
+                with self.assertRaises(ConnectionError):
+                    http_u.http_get('http://other.com')
+            session.request.assert_any_call('GET', 'https://example.com/path?q=1', timeout=(1, 1), params={'a': 'b'},
+                                            headers={'Authorization': 'Bearer token', 'Accept': 'application/json'})
+            stats = http_u.get_http_stats()
+        finally:
+            http_u.reset_http_stats()
+        self.assertEqual({'example.com', 'other.com'}, set(stats.keys()))
+        self.assertEqual(2, stats['example.com']['requests'])
+        self.assertEqual(1, stats['example.com']['errors'])
+        self.assertEqual(1, stats['other.com']['errors'])
+        self.assertGreaterEqual(stats['example.com']['max_ms'], stats['example.com']['avg_ms'])
+
     def test_get_common_headers_with_authorization(self, *args, **kwargs):
         headers = http_u.get_common_headers_with_authorization()
         self.assertEqual({}, headers)
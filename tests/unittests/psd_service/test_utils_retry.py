@@ -0,0 +1,103 @@
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+from psd_service import utils_retry as retry_u
+from psd_service.exceptions import ConcurrencyException, NotFoundException
+
+
+def client_error(code, reasons=None):
+    response = {'Error': {'Code': code}}
+    if reasons is not None:
+        response['CancellationReasons'] = [{'Code': reason} for reason in reasons]
+    return ClientError(response, 'operation')
+
+
+class MockedLambdaContext(object):
+    def __init__(self, remaining_millis):
+        self.remaining_millis = remaining_millis
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_millis
+
+
+class UtilsRetryTest(unittest.TestCase):
+
+    def setUp(self, *args, **kwargs):
+        retry_u.reset_retry_stats()
+        retry_u.clear_deadline()
+
+    def tearDown(self, *args, **kwargs):
+        retry_u.reset_retry_stats()
+        retry_u.clear_deadline()
+
+    def test_classify_error(self, *args, **kwargs):
+        self.assertEqual(retry_u.CONCURRENCY, retry_u.classify_error(ConcurrencyException('conflict')))
+        self.assertEqual(retry_u.CONDITIONAL_CHECK,
+                         retry_u.classify_error(client_error('ConditionalCheckFailedException')))
+        self.assertEqual(retry_u.THROTTLING,
+                         retry_u.classify_error(client_error('ProvisionedThroughputExceededException')))
+        self.assertEqual(retry_u.THROTTLING, retry_u.classify_error(
+            client_error('TransactionCanceledException', reasons=['None', 'ThrottlingError'])))
+        self.assertEqual(retry_u.CONCURRENCY, retry_u.classify_error(
+            client_error('TransactionCanceledException', reasons=['TransactionConflict', 'None'])))
+        self.assertIsNone(retry_u.classify_error(
+            client_error('TransactionCanceledException', reasons=['ConditionalCheckFailed'])))
+        self.assertIsNone(retry_u.classify_error(client_error('ResourceNotFoundException')))
+        self.assertIsNone(retry_u.classify_error(NotFoundException('missing')))
+
+    def test_compute_delay(self, *args, **kwargs):
+        policy = retry_u.RetryPolicy(base_delay_seconds=0.01, max_delay_seconds=0.1)
+        for attempt in range(1, 10):
+            for _ in range(50):
+                delay = policy.compute_delay(attempt)
+                self.assertGreaterEqual(delay, 0)
+                self.assertLessEqual(delay, min(0.1, 0.01 * 2 ** attempt))
+
+    @mock.patch('time.sleep')
+    def test_retry_until_success(self, sleep, *args, **kwargs):
+        function = mock.Mock(side_effect=[client_error('ThrottlingException'), ConcurrencyException('conflict'), 'ok'])
+        self.assertEqual('ok', retry_u.retry_call(function, 'site'))
+        self.assertEqual(3, function.call_count)
+        self.assertEqual(2, sleep.call_count)
+        self.assertEqual({'attempts': 3, 'successes': 1, 'retries': 2, retry_u.THROTTLING: 1,
+                          retry_u.CONCURRENCY: 1}, retry_u.get_retry_stats()['site'])
+
+    @mock.patch('time.sleep')
+    def test_give_up_after_max_attempts(self, sleep, *args, **kwargs):
+        function = mock.Mock(side_effect=ConcurrencyException('conflict'))
+        policy = retry_u.RetryPolicy(max_attempts=3)
+        self.assertRaises(ConcurrencyException, retry_u.retry_call, function, 'site', policy=policy)
+        self.assertEqual(3, function.call_count)
+        self.assertEqual(2, sleep.call_count)
+        stats = retry_u.get_retry_stats()['site']
+        self.assertEqual(1, stats['give_ups'])
+        self.assertEqual(2, stats['retries'])
+
+    @mock.patch('time.sleep')
+    def test_errors_out_of_the_policy_are_not_retried(self, sleep, *args, **kwargs):
+        policy = retry_u.RetryPolicy(retry_on=(retry_u.THROTTLING,))
+        function = mock.Mock(side_effect=client_error('ConditionalCheckFailedException'))
+        self.assertRaises(ClientError, retry_u.retry_call, function, 'site', policy=policy)
+        function = mock.Mock(side_effect=NotFoundException('missing'))
+        self.assertRaises(NotFoundException, retry_u.retry_call, function, 'site', policy=policy)
+        sleep.assert_not_called()
+        self.assertEqual({'attempts': 2, 'failures': 2}, retry_u.get_retry_stats()['site'])
+
+    @mock.patch('time.sleep')
+    def test_give_up_near_the_deadline(self, sleep, *args, **kwargs):
+        retry_u.set_deadline_from_lambda_context(MockedLambdaContext(remaining_millis=100))
+        self.assertLess(retry_u.get_remaining_seconds(), retry_u.DEADLINE_MARGIN_SECONDS)
+        function = mock.Mock(side_effect=client_error('ThrottlingException'))
+        self.assertRaises(ClientError, retry_u.retry_call, function, 'site')
+        self.assertEqual(1, function.call_count)
+        sleep.assert_not_called()
+        self.assertEqual(1, retry_u.get_retry_stats()['site']['give_ups'])
+
+        retry_u.set_deadline_from_lambda_context(None)  # running outside lambda
+        self.assertIsNone(retry_u.get_remaining_seconds())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
 import unittest
+from datetime import datetime as dt
+from unittest import mock
 
 from psd_service import utils_uuid as uuid_u
 
@@ -38,6 +40,25 @@ class UtilsUUIDTest(unittest.TestCase):
         self.assertTrue(uuid_u.check_if_valid_uuid(uuid))
         self.assertEqual(expected_uuid, uuid)
 
+    def test_generate_time_ordered_uuid(self, *args, **kwargs):
+        uuids = [uuid_u.generate_time_ordered_uuid() for _ in range(5000)]
+        self.assertEqual(sorted(uuids), uuids)  # in order, even within the same millisecond
+        self.assertEqual(len(uuids), len(set(uuids)))
+        self.assertTrue(uuid_u.check_if_valid_uuid(uuids[0]))
+        self.assertTrue(uuid_u.check_if_valid_time_ordered_uuid(uuids[0]))
+        self.assertFalse(uuid_u.check_if_valid_time_ordered_uuid('4af4de19-255d-447a-bccd-a1dd34ca7ef6'))
+        self.assertFalse(uuid_u.check_if_valid_time_ordered_uuid('something else'))
+
+    def test_generate_time_ordered_uuid_counter_overflow(self, *args, **kwargs):
+        with mock.patch('time.time_ns', return_value=1577836800000 * 1_000_000), \
+                mock.patch.object(uuid_u, 'last_time_ordered_uuid_timestamp_ms', 0):
+            uuids = [uuid_u.generate_time_ordered_uuid() for _ in range(uuid_u.MAX_TIME_ORDERED_UUID_COUNTER + 2)]
+        self.assertEqual(sorted(uuids), uuids)
+        self.assertEqual(dt(2020, 1, 1, 0, 0, 0, 1000), uuid_u.get_time_ordered_uuid_datetime(uuids[-1]))
+
+    def test_get_time_ordered_uuid_datetime(self, *args, **kwargs):
+        self.assertEqual(dt(2020, 1, 1), uuid_u.get_time_ordered_uuid_datetime('016f5e66-e800-7000-8000-000000000000'))
+
 
 if __name__ == '__main__':
     unittest.main()